@@ -0,0 +1,374 @@
+import os
+import time
+import atexit
+import threading
+
+import numpy as np
+
+from .config import (
+    EMBEDDING_DIM, ANN_INDEX_ENABLED, ANN_INDEX_PATH, ANN_NLIST, ANN_NPROBE, ANN_SAVE_INTERVAL_S, ANN_RETRAIN_GROWTH,
+)
+from . import supabase as supabase_db
+from .vector_index import top_k_indices
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (matrix / norms).astype(np.float32, copy=False)
+
+
+def spherical_kmeans(vectors: np.ndarray, k: int, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    # K-means sobre vectores normalizados usando similitud coseno (producto punto)
+    rng = np.random.default_rng(seed)
+    k = min(k, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), size=k, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        counts = np.bincount(assignment, minlength=k)
+        empty = counts == 0
+        # Los centroides vacíos se re-siembran con vectores aleatorios
+        sums[empty] = vectors[rng.choice(len(vectors), size=int(empty.sum()), replace=False)]
+        centroids = _normalize(sums)
+    return centroids
+
+
+class _InvertedList:
+    # Lista invertida con arreglos que crecen por duplicación (inserciones amortizadas O(1))
+
+    def __init__(self, dim: int, capacity: int = 16):
+        self.size = 0
+        self.vectors = np.empty((capacity, dim), dtype=np.float32)
+        self.chunk_ids = np.empty(capacity, dtype=np.int64)
+        self.material_ids = np.empty(capacity, dtype=np.int64)
+        self.user_codes = np.empty(capacity, dtype=np.int32)
+
+    def _grow(self, needed: int):
+        capacity = len(self.chunk_ids)
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        for name in ("vectors", "chunk_ids", "material_ids", "user_codes"):
+            old = getattr(self, name)
+            new = np.empty((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    def add(self, vectors, chunk_ids, material_ids, user_codes):
+        n = len(chunk_ids)
+        self._grow(self.size + n)
+        end = self.size + n
+        self.vectors[self.size:end] = vectors
+        self.chunk_ids[self.size:end] = chunk_ids
+        self.material_ids[self.size:end] = material_ids
+        self.user_codes[self.size:end] = user_codes
+        self.size = end
+
+    def view(self):
+        n = self.size
+        return self.vectors[:n], self.chunk_ids[:n], self.material_ids[:n], self.user_codes[:n]
+
+
+class IVFIndex:
+    """
+    Índice aproximado (IVF) sobre todos los chunks de todos los materiales.
+
+    Los vectores se reparten en `nlist` listas invertidas según su centroide más cercano
+    (k-means esférico). Una búsqueda solo revisa las `nprobe` listas más cercanas a la
+    consulta: `nprobe` es la perilla entre recall y latencia (nprobe = nlist equivale a búsqueda exacta).
+
+    Hasta reunir suficientes vectores para entrenar los centroides, todo se guarda
+    en una única lista y la búsqueda es exacta. El entrenamiento (y el re-entrenamiento cuando
+    el índice crece `retrain_growth` veces) corre en un hilo aparte, fuera del lock: las
+    inserciones y búsquedas siguen con las listas anteriores hasta el cambio final.
+
+    Los chunks embebidos antes de habilitar el índice (o después del último guardado en disco)
+    se cargan desde Supabase la primera vez que se busca en la biblioteca de su usuario (ensure_user).
+    """
+
+    def __init__(self, dim: int = EMBEDDING_DIM, nlist: int = ANN_NLIST, train_size: int | None = None,
+                 retrain_growth: float = ANN_RETRAIN_GROWTH):
+        self.dim = dim
+        self.nlist = nlist
+        self.train_size = train_size or nlist * 32
+        self.retrain_growth = retrain_growth
+        self.centroids: np.ndarray | None = None
+        self.lists: list[_InvertedList] = [_InvertedList(dim)]
+        self.user_codes: dict[str, int] = {}
+        self._lock = threading.RLock()
+        self._dirty = False
+        self._last_save = time.monotonic()
+        # Entrenamiento en segundo plano: tamaño del índice al último entrenamiento, hilo en curso y
+        # un contador de remove() (un remove durante el entrenamiento obliga a repetir la redistribución)
+        self._trained_size = 0
+        self._training_thread: threading.Thread | None = None
+        self._removals = 0
+        # Ids indexados de cada material (arreglos ordenados) para no duplicar chunks
+        self._material_chunks: dict[int, np.ndarray] = {}
+        # Usuarios ya cargados desde Supabase en este proceso
+        self._loaded_users: set[str] = set()
+        self._user_locks: dict[str, threading.Lock] = {}
+
+    def __len__(self):
+        return sum(lst.size for lst in self.lists)
+
+    @property
+    def trained(self) -> bool:
+        return self.centroids is not None
+
+    def _user_code(self, user_id: str) -> int:
+        code = self.user_codes.get(user_id)
+        if code is None:
+            code = len(self.user_codes)
+            self.user_codes[user_id] = code
+        return code
+
+    @staticmethod
+    def _distribute(lists: list[_InvertedList], centroids: np.ndarray, vectors, chunk_ids, materials, users):
+        # Agrega cada vector a la lista de su centroide más cercano
+        if len(chunk_ids) == 0:
+            return
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        for list_id in np.unique(assignment):
+            mask = assignment == list_id
+            lists[list_id].add(vectors[mask], chunk_ids[mask], materials[mask], users[mask])
+
+    def add(self, chunk_ids: list[int], embeddings, material_id: int, user_id: str):
+        # Inserción incremental (se llama desde create_embeddings por cada lote). Los chunks que el
+        # material ya tiene en el índice se ignoran: la carga desde Supabase (ensure_user) puede
+        # cruzarse con create_embeddings y ver el mismo chunk
+        if len(chunk_ids) == 0:
+            return
+        vectors = _normalize(embeddings)
+        chunk_ids = np.asarray(chunk_ids, dtype=np.int64)
+        with self._lock:
+            indexed = self._material_chunks.get(material_id)
+            if indexed is not None:
+                new = ~np.isin(chunk_ids, indexed, assume_unique=True)
+                if not new.all():
+                    vectors, chunk_ids = vectors[new], chunk_ids[new]
+                    if len(chunk_ids) == 0:
+                        return
+                self._material_chunks[material_id] = np.union1d(indexed, chunk_ids)
+            else:
+                self._material_chunks[material_id] = np.unique(chunk_ids)
+            code = self._user_code(str(user_id))
+            materials = np.full(len(chunk_ids), material_id, dtype=np.int64)
+            users = np.full(len(chunk_ids), code, dtype=np.int32)
+            if not self.trained:
+                self.lists[0].add(vectors, chunk_ids, materials, users)
+            else:
+                self._distribute(self.lists, self.centroids, vectors, chunk_ids, materials, users)
+            self._dirty = True
+            if self._needs_training():
+                self._training_thread = threading.Thread(target=self.train, daemon=True)
+                self._training_thread.start()
+
+    def _needs_training(self) -> bool:
+        # Llamar con el lock tomado
+        if self._training_thread is not None and self._training_thread.is_alive():
+            return False
+        if not self.trained:
+            return self.lists[0].size >= self.train_size
+        return self.retrain_growth > 0 and len(self) >= self._trained_size * self.retrain_growth
+
+    def wait_for_training(self, timeout: float | None = None):
+        # Espera a que termine el entrenamiento en segundo plano, si hay uno en curso
+        thread = self._training_thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def ensure_user(self, user_id: str):
+        """
+        Carga desde Supabase (una vez por proceso y usuario) los chunks con embedding de todos
+        los materiales de user_id que falten en el índice. Sin esto la búsqueda en la biblioteca
+        no vería los materiales embebidos antes de habilitar el índice ni los que quedaron sin
+        guardar en disco cuando el proceso se reinició.
+        """
+        user_id = str(user_id)
+        if user_id in self._loaded_users:
+            return
+        with self._lock:
+            user_lock = self._user_locks.setdefault(user_id, threading.Lock())
+        with user_lock:
+            if user_id in self._loaded_users:
+                return
+            for material_id in supabase_db.get_user_material_ids(user_id):
+                rows = supabase_db.get_chunk_embeddings(material_id)
+                if rows:
+                    self.add([row["id"] for row in rows], [row["embedding"] for row in rows], material_id, user_id)
+            self._loaded_users.add(user_id)
+
+    def remove(self, chunk_ids: list[int]):
+        # Elimina chunks del índice (p. ej. al reemplazar el PDF de un material). O(n): recorre todas las listas.
+        if not chunk_ids:
+            return
+        chunk_ids = np.asarray(chunk_ids, dtype=np.int64)
+        with self._lock:
+            for i, lst in enumerate(self.lists):
+                vectors, ids, materials, users = lst.view()
+                keep = ~np.isin(ids, chunk_ids)
+                if keep.all():
+                    continue
+                new_list = _InvertedList(self.dim, capacity=max(16, int(keep.sum())))
+                new_list.add(vectors[keep], ids[keep], materials[keep], users[keep])
+                self.lists[i] = new_list
+                self._removals += 1
+            for material_id, indexed in self._material_chunks.items():
+                self._material_chunks[material_id] = np.setdiff1d(indexed, chunk_ids, assume_unique=True)
+            self._dirty = True
+
+    def train(self, max_attempts: int = 3):
+        """
+        (Re)entrena los centroides con una muestra de los vectores actuales y los redistribuye.
+        El k-means y la asignación de lo ya indexado corren sin el lock (sobre vistas que las
+        inserciones no modifican); con el lock solo se reparte lo agregado mientras tanto y se
+        cambian las listas. Si un remove() cambió las listas en el medio, se vuelve a intentar.
+        """
+        rng = np.random.default_rng(0)
+        for _ in range(max_attempts):
+            with self._lock:
+                removals = self._removals
+                lists = list(self.lists)
+                views = [lst.view() for lst in lists]
+            total = sum(len(view[1]) for view in views)
+            if total == 0:
+                return
+            # Muestra de entrenamiento proporcional al tamaño de cada lista
+            sample = np.concatenate([
+                vectors if len(vectors) * self.train_size <= total
+                else vectors[rng.choice(len(vectors), len(vectors) * self.train_size // total, replace=False)]
+                for vectors, _, _, _ in views
+            ])
+            centroids = spherical_kmeans(sample, self.nlist)
+            new_lists = [_InvertedList(self.dim) for _ in range(len(centroids))]
+            for view in views:
+                self._distribute(new_lists, centroids, *view)
+
+            with self._lock:
+                if self._removals != removals:
+                    continue
+                for lst, (_, ids, _, _) in zip(lists, views):
+                    vectors, chunk_ids, materials, users = lst.view()
+                    done = len(ids)
+                    self._distribute(new_lists, centroids, vectors[done:], chunk_ids[done:], materials[done:], users[done:])
+                self.centroids = centroids
+                self.lists = new_lists
+                self._trained_size = len(self)
+                self._dirty = True
+                return
+
+    def search(self, query_embedding, k: int = 4, nprobe: int = ANN_NPROBE,
+               user_id: str | None = None, material_ids: list[int] | None = None) -> list[dict]:
+        query = _normalize(query_embedding)
+        with self._lock:
+            if user_id is not None:
+                user_code = self.user_codes.get(str(user_id))
+                if user_code is None:
+                    return []
+            if self.trained:
+                probe = top_k_indices(self.centroids @ query, max(1, nprobe))
+                lists = [self.lists[i] for i in probe]
+            else:
+                lists = self.lists
+            # Las vistas [:size] no cambian con inserciones posteriores, así que el
+            # cálculo puede hacerse fuera del lock sin bloquear a otros lectores/escritores
+            views = [lst.view() for lst in lists]
+
+        scores, chunk_ids, materials = [], [], []
+        for vectors, ids, mats, users in views:
+            if len(ids) == 0:
+                continue
+            mask = None
+            if user_id is not None:
+                mask = users == user_code
+            if material_ids is not None:
+                in_materials = np.isin(mats, material_ids)
+                mask = in_materials if mask is None else mask & in_materials
+            if mask is not None:
+                vectors, ids, mats = vectors[mask], ids[mask], mats[mask]
+                if len(ids) == 0:
+                    continue
+            scores.append(vectors @ query)
+            chunk_ids.append(ids)
+            materials.append(mats)
+
+        if not scores:
+            return []
+        scores = np.concatenate(scores)
+        chunk_ids = np.concatenate(chunk_ids)
+        materials = np.concatenate(materials)
+        return [
+            {"id": int(chunk_ids[i]), "material_id": int(materials[i]), "similarity": float(scores[i])}
+            for i in top_k_indices(scores, k)
+        ]
+
+    def save(self, path: str):
+        # Guarda todo en un único .npz: listas concatenadas + offsets de cada lista
+        with self._lock:
+            sizes = np.array([lst.size for lst in self.lists], dtype=np.int64)
+            views = [lst.view() for lst in self.lists]
+            arrays = {
+                "dim": np.array(self.dim),
+                "nlist": np.array(self.nlist),
+                "sizes": sizes,
+                "vectors": np.concatenate([v[0] for v in views]) if len(self) else np.empty((0, self.dim), np.float32),
+                "chunk_ids": np.concatenate([v[1] for v in views]),
+                "material_ids": np.concatenate([v[2] for v in views]),
+                "user_codes": np.concatenate([v[3] for v in views]),
+                "user_ids": np.array(list(self.user_codes.keys()), dtype=str),
+            }
+            if self.trained:
+                arrays["centroids"] = self.centroids
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            tmp_path = path + ".tmp.npz"
+            np.savez(tmp_path, **arrays)
+            os.replace(tmp_path, path)
+            self._dirty = False
+            self._last_save = time.monotonic()
+
+    def maybe_save(self, path: str, interval_s: float = ANN_SAVE_INTERVAL_S):
+        # Guardado periódico: evita reescribir el índice completo después de cada material
+        if path and self._dirty and time.monotonic() - self._last_save >= interval_s:
+            self.save(path)
+
+    @classmethod
+    def load(cls, path: str):
+        data = np.load(path)
+        index = cls(dim=int(data["dim"]), nlist=int(data["nlist"]))
+        index.user_codes = {u: i for i, u in enumerate(data["user_ids"].tolist())}
+        if "centroids" in data:
+            index.centroids = data["centroids"]
+            index._trained_size = int(data["sizes"].sum())
+        # Cada acceso a data[...] vuelve a leer el arreglo del .npz, así que se leen una sola vez
+        sizes = data["sizes"]
+        vectors, chunk_ids = data["vectors"], data["chunk_ids"]
+        material_ids, user_codes = data["material_ids"], data["user_codes"]
+        offsets = np.concatenate([[0], np.cumsum(sizes)])
+        if len(chunk_ids):
+            order = np.lexsort((chunk_ids, material_ids))
+            materials, starts = np.unique(material_ids[order], return_index=True)
+            for material_id, group in zip(materials.tolist(), np.split(chunk_ids[order], starts[1:])):
+                index._material_chunks[material_id] = group
+        index.lists = []
+        for i in range(len(sizes)):
+            lst = _InvertedList(index.dim, capacity=max(16, int(sizes[i])))
+            s, e = offsets[i], offsets[i + 1]
+            lst.add(vectors[s:e], chunk_ids[s:e], material_ids[s:e], user_codes[s:e])
+            index.lists.append(lst)
+        return index
+
+
+# Instancia única del índice ANN (None si está deshabilitado)
+ann_index = None
+if ANN_INDEX_ENABLED:
+    try:
+        ann_index = IVFIndex.load(ANN_INDEX_PATH) if os.path.exists(ANN_INDEX_PATH) else IVFIndex()
+    except Exception as e:
+        print(f"Error al cargar el índice ANN: {e}")
+        ann_index = IVFIndex()
+    atexit.register(lambda: ann_index.save(ANN_INDEX_PATH) if ann_index._dirty else None)
@@ -0,0 +1,119 @@
+import asyncio
+
+from .config import BATCH_GENERATION_CONCURRENCY
+from .gemini import aget_query_embeddings, agenerate_flashcards
+from .supabase_async import insert_tool
+from .context_builder import aretrieve_context_many, choose_retrieval_mode
+from .response_cache import flashcards_cache
+
+# Generación de flashcards por lotes: muchos pares (material, consulta) en una petición.
+# En lugar de N flujos RAG independientes:
+#   1. los embeddings de todas las consultas salen de una sola llamada a embed_content,
+#   2. la recuperación se hace una vez por material (un producto matriz-matriz con el índice local),
+#   3. las llamadas de generación se lanzan en paralelo con un semáforo (BATCH_GENERATION_CONCURRENCY)
+#      y cada resultado se entrega en cuanto termina,
+# así que el lote tarda aproximadamente lo que la petición individual más lenta.
+
+
+def _error(item: dict, status_code: int, detail: str) -> dict:
+    return {**item, "status": "error", "status_code": status_code, "detail": detail}
+
+
+async def _generate(item: dict, retrieval: asyncio.Task, position: int, embedding, semaphore: asyncio.Semaphore) -> dict:
+    # Flujo RAG de un ítem a partir de la recuperación de su material (compartida por sus consultas)
+    try:
+        built = (await retrieval)[position]
+        if isinstance(built, BaseException):
+            return _error(item, 500, f"Error en el proceso RAG: {built}")
+        if not built["selected"]:
+            return _error(item, 404, "No se encontraron fragmentos relevantes. ¿Se crearon los embeddings?")
+
+        async with semaphore:
+            flashcards_data = await agenerate_flashcards(context=built["context"], query=item["query"],
+                                                         num_flashcards=item["num_flashcards"])
+        if not flashcards_data.get('flashcards'):
+            return _error(item, 500, "El modelo no devolvió la estructura de flashcards esperada.")
+
+        save_count = await insert_tool(item["material_id"], "flashcards", flashcards_data)
+        flashcards_cache.store(item["material_id"], item["num_flashcards"], embedding, {
+            "flashcards": flashcards_data,
+            "context_chunks_count": built["selected"],
+            "context_tokens": built["context_tokens"],
+        }, item["query"])
+        return {
+            **item,
+            "status": "success",
+            "flashcards": flashcards_data,
+            "context_chunks_count": built["selected"],
+            "context_tokens": built["context_tokens"],
+            "retrieval_mode": built["retrieval_mode"],
+            "save_count": save_count,
+            "cache_hit": False,
+        }
+    except Exception as e:
+        print(f"Error en la generación por lotes (material {item['material_id']}): {e}")
+        return _error(item, 500, f"Error en el proceso RAG: {str(e)}")
+
+
+async def iter_flashcards_batch(items: list[dict], concurrency: int = BATCH_GENERATION_CONCURRENCY):
+    """
+    Genera flashcards para cada ítem {material_id, query, num_flashcards, top_k} y entrega
+    (async generator) un dict por ítem EN ORDEN DE TERMINACIÓN, con su 'index' en la lista,
+    'status' ("success" o "error", con status_code y detail como las rutas individuales)
+    y 'cache_hit'. Los aciertos de la caché se entregan primero, sin recuperación ni LLM.
+    Un ítem que falla no afecta al resto; si el consumidor deja de iterar, lo pendiente se cancela.
+    """
+    items = [{"index": i, **item} for i, item in enumerate(items)]
+    modes = [choose_retrieval_mode(item["query"]) for item in items]
+
+    # 1. Embeddings de todas las consultas no léxicas en una sola tanda
+    embeddings = [None] * len(items)
+    dense = [i for i, mode in enumerate(modes) if mode != "lexical"]
+    if dense:
+        try:
+            found = await aget_query_embeddings([items[i]["query"] for i in dense])
+        except Exception as e:
+            print(f"Error al generar los embeddings del lote: {e}")
+            found = [[] for _ in dense]
+        for i, embedding in zip(dense, found):
+            embeddings[i] = embedding
+
+    # 2. Caché semántica y agrupación por material de lo que hay que generar
+    pending: dict[int, list[int]] = {}
+    for i, item in enumerate(items):
+        if modes[i] != "lexical" and not embeddings[i]:
+            yield _error(item, 500, "Fallo al generar el embedding de la consulta.")
+            continue
+        cached = flashcards_cache.lookup(item["material_id"], item["num_flashcards"], embeddings[i], item["query"])
+        if cached is not None:
+            yield {
+                **item,
+                "status": "success",
+                "flashcards": cached["flashcards"],
+                "context_chunks_count": cached["context_chunks_count"],
+                "context_tokens": cached.get("context_tokens"),
+                "save_count": 0,
+                "cache_hit": True,
+            }
+            continue
+        pending.setdefault(item["material_id"], []).append(i)
+
+    # 3. Una recuperación por material (todas a la vez) y la generación de cada ítem en cuanto
+    #    la recuperación de su material termina
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    retrievals, tasks = [], []
+    try:
+        for material_id, indices in pending.items():
+            retrieval = asyncio.create_task(aretrieve_context_many(
+                [items[i]["query"] for i in indices], material_id, [items[i]["top_k"] for i in indices],
+                query_embeddings=[embeddings[i] for i in indices], modes=[modes[i] for i in indices],
+            ))
+            retrievals.append(retrieval)
+            tasks += [asyncio.create_task(_generate(items[i], retrieval, position, embeddings[i], semaphore))
+                      for position, i in enumerate(indices)]
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks + retrievals:
+            task.cancel()
+
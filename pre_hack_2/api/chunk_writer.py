@@ -0,0 +1,208 @@
+import json
+import time
+import random
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+from postgrest.exceptions import APIError
+
+# Errores de PostgREST/Postgres que indican un problema transitorio (la transacción no se aplicó
+# o no sabemos si se aplicó): conexión, timeout, serialización, deadlock, demasiadas conexiones
+RETRYABLE_PG_CODES = {"40001", "40P01", "57014", "53300", "PGRST000", "PGRST001", "PGRST002", "PGRST003"}
+RETRYABLE_STATUS = {429, 500, 502, 503, 504, 520}
+
+
+def is_retryable(error: BaseException) -> bool:
+    if isinstance(error, APIError):
+        code = str(error.code or "")
+        return code in RETRYABLE_PG_CODES or code.startswith("08") or (code.isdigit() and int(code) in RETRYABLE_STATUS)
+    return isinstance(error, (httpx.TransportError, ConnectionError, TimeoutError))
+
+
+def is_too_large(error: BaseException) -> bool:
+    # 413 del gateway (cuerpo no JSON: postgrest-py pone el status HTTP como code)
+    return isinstance(error, APIError) and str(error.code) == "413"
+
+
+def row_bytes(row: dict) -> int:
+    # Tamaño aproximado de la fila en el cuerpo JSON del INSERT
+    return len(json.dumps(row)) + 1
+
+
+class _WriteState:
+    """
+    Estado compartido de una llamada a write(): conteo de filas por chunk_hash ya escritas,
+    qué chunk_hash siguen en lotes sin resolver, y los lotes fallidos o de resultado dudoso.
+    """
+
+    def __init__(self, batches: list[list[dict]], existing: Counter, on_written=None):
+        self.lock = threading.Lock()
+        self.existing = existing
+        self.on_written = on_written
+        self.pending = Counter(row["chunk_hash"] for batch in batches for row in batch)
+        self.stats = Counter()
+        self.failed = []
+        self.unknown = []
+
+    def settle(self, batch: list[dict], committed: bool, ids: list | None = None):
+        # ids: los que devolvió el INSERT, o None si el lote se dio por escrito al comprobarlo por hash
+        with self.lock:
+            hashes = Counter(row["chunk_hash"] for row in batch)
+            self.pending.subtract(hashes)
+            if committed:
+                self.existing.update(hashes)
+                self.stats["inserted"] += len(ids) if ids is not None else len(batch)
+        if committed and self.on_written is not None:
+            self.on_written(batch, ids)
+
+    def fail(self, index: int, batch: list[dict], error):
+        print(f"Error al insertar el lote {index} de chunks: {error}")
+        with self.lock:
+            self.failed.append({"batch": index, "chunk_hashes": [row["chunk_hash"] for row in batch], "error": str(error)})
+
+
+class ChunkWriter:
+    """
+    Escritura masiva de filas de material_chunks.
+
+    - Divide las filas en lotes acotados por número de filas y por bytes (límite de payload
+      de PostgREST); un 413 parte el lote en dos.
+    - Envía como máximo `concurrency` lotes a la vez (pool de hilos).
+    - Reintenta con backoff (jitter completo) los errores transitorios. Cada INSERT es una
+      transacción, así que un lote queda escrito entero o nada; antes de reintentar se comprueba
+      por chunk_hash si el intento anterior llegó a escribirse (p. ej. timeout tras el commit),
+      para no duplicar filas.
+    - Devuelve las filas escritas según el servidor (las que devuelve el INSERT), no len(chunks).
+
+    insert_rows(rows) -> list inserta un lote y retorna los ids de las filas escritas;
+    count_hashes(material_id, hashes) -> Counter cuenta las filas actuales por chunk_hash.
+    """
+
+    def __init__(self, insert_rows, count_hashes, batch_rows: int, batch_bytes: int, concurrency: int,
+                 max_retries: int, backoff_base_s: float, backoff_max_s: float):
+        self.insert_rows = insert_rows
+        self.count_hashes = count_hashes
+        self.batch_rows = max(1, batch_rows)
+        self.batch_bytes = max(1, batch_bytes)
+        self.concurrency = max(1, concurrency)
+        self.max_retries = max(0, max_retries)
+        self.backoff_base_s = backoff_base_s
+        self.backoff_max_s = backoff_max_s
+
+    def plan_batches(self, rows: list[dict]) -> list[list[dict]]:
+        batches, current, current_bytes = [], [], 0
+        for row in rows:
+            size = row_bytes(row)
+            if current and (len(current) >= self.batch_rows or current_bytes + size > self.batch_bytes):
+                batches.append(current)
+                current, current_bytes = [], 0
+            current.append(row)
+            current_bytes += size
+        if current:
+            batches.append(current)
+        return batches
+
+    def backoff_delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.backoff_max_s, self.backoff_base_s * (2 ** attempt)))
+
+    def _was_written(self, material_id: int, batch: list[dict], state: _WriteState) -> bool | None:
+        """
+        ¿Quedó escrito el lote en un intento anterior? Se usan como testigos los chunk_hash
+        que ningún otro lote sin resolver contiene: si hay más filas con ese hash que las
+        conocidas (previas + lotes confirmados), las añadió este lote.
+        Retorna None si todos sus hashes están compartidos con lotes aún en curso.
+        """
+        own = Counter(row["chunk_hash"] for row in batch)
+        with state.lock:
+            witnesses = [h for h, n in own.items() if state.pending[h] == n]
+        if not witnesses:
+            return None
+        witnesses = witnesses[:20]
+        current = self.count_hashes(material_id, witnesses)
+        with state.lock:
+            return any(current[h] > state.existing[h] for h in witnesses)
+
+    def _write_batch(self, material_id: int, index: int, batch: list[dict], state: _WriteState, verify_first: bool = False):
+        # No lanza: el resultado queda en state (filas escritas, lotes fallidos o dudosos)
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0 or verify_first:
+                written = self._was_written(material_id, batch, state)
+                if written is None:
+                    with state.lock:
+                        state.unknown.append((index, batch))
+                    return
+                if written:
+                    return state.settle(batch, committed=True)
+            try:
+                return state.settle(batch, committed=True, ids=self.insert_rows(batch))
+            except Exception as e:
+                if is_too_large(e) and len(batch) > 1:
+                    # El 413 llega antes de tocar la BD: se parte el lote y se escribe cada mitad
+                    with state.lock:
+                        state.stats["splits"] += 1
+                    half = len(batch) // 2
+                    self._write_batch(material_id, index, batch[:half], state)
+                    self._write_batch(material_id, index, batch[half:], state)
+                    return
+                if not is_retryable(e):
+                    state.settle(batch, committed=False)
+                    return state.fail(index, batch, e)
+                if attempt == self.max_retries:
+                    # Último intento ambiguo: se comprueba una vez más antes de darlo por perdido
+                    written = self._was_written(material_id, batch, state)
+                    if written:
+                        return state.settle(batch, committed=True)
+                    if written is None:
+                        with state.lock:
+                            state.unknown.append((index, batch))
+                        return
+                    state.settle(batch, committed=False)
+                    return state.fail(index, batch, e)
+                with state.lock:
+                    state.stats["retries"] += 1
+            time.sleep(self.backoff_delay(attempt))
+
+    def write(self, material_id: int, chunks: list[dict], existing: Counter | None = None, on_written=None) -> dict:
+        """
+        Inserta los chunks de un material. `existing` es el conteo por chunk_hash de las filas
+        que el material ya tiene (se actualiza con lo escrito, así quien inserta por tandas
+        puede reutilizarlo); si es None se consulta a la BD.
+        on_written(filas, ids) se llama (desde los hilos del pool) por cada lote escrito; ids es
+        None cuando el lote se confirmó por chunk_hash tras un intento dudoso.
+        Retorna {'inserted', 'batches', 'retries', 'splits', 'failed', 'failed_batches', ...}.
+        """
+        rows = [{"material_id": material_id, **chunk} for chunk in chunks]
+        if existing is None:
+            existing = self.count_hashes(material_id, sorted({row["chunk_hash"] for row in rows})) if rows else Counter()
+
+        batches = self.plan_batches(rows)
+        state = _WriteState(batches, existing, on_written)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for future in [executor.submit(self._write_batch, material_id, i, batch, state)
+                           for i, batch in enumerate(batches)]:
+                future.result()
+
+        # Lotes cuyos hashes estaban todos compartidos con otros lotes en curso: ahora que el resto
+        # está resuelto se comprueban de uno en uno y se reintentan solo si no llegaron a escribirse.
+        # Si siguen siendo ambiguos se reportan como fallidos en vez de arriesgar filas duplicadas.
+        unknown, state.unknown = sorted(state.unknown, key=lambda item: item[0]), []
+        for index, batch in unknown:
+            self._write_batch(material_id, index, batch, state, verify_first=True)
+        for index, batch in state.unknown:
+            state.fail(index, batch, "no se pudo comprobar si el lote quedó escrito")
+
+        elapsed = time.perf_counter() - start
+        inserted = state.stats["inserted"]
+        return {
+            "inserted": inserted,
+            "batches": len(batches),
+            "retries": state.stats["retries"],
+            "splits": state.stats["splits"],
+            "failed": sum(len(b["chunk_hashes"]) for b in state.failed),
+            "failed_batches": sorted(state.failed, key=lambda b: b["batch"]),
+            "elapsed_s": round(elapsed, 3),
+            "rows_per_sec": round(inserted / elapsed, 1) if elapsed > 0 else 0.0,
+        }
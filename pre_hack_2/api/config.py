@@ -15,4 +15,177 @@ EMBEDDING_MODEL = "text-embedding-004"
 EMBEDDING_DIM = 768
 
 # Configuración del modelo de generación 
-GENERATION_MODEL = "gemini-2.5-flash"
\ No newline at end of file
+GENERATION_MODEL = "gemini-2.5-flash"
+
+# Configuración del pipeline de embeddings por lotes
+# EMBEDDING_BATCH_SIZE: cuántos textos se envían en cada llamada a embed_content (máx. 100 en la API de Gemini)
+# EMBEDDING_CONCURRENCY: cuántos lotes se procesan a la vez
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "100"))
+EMBEDDING_CONCURRENCY = int(os.getenv("EMBEDDING_CONCURRENCY", "4"))
+
+# Caché local de embeddings por contenido (clave: EMBEDDING_MODEL + chunk_hash)
+EMBEDDING_CACHE_ENABLED = os.getenv("EMBEDDING_CACHE_ENABLED", "true").lower() == "true"
+# Un EMBEDDING_CACHE_DIR lo usa un solo proceso (flock): con varios workers, los demás arrancan sin caché
+# salvo que cada uno reciba su propio directorio
+EMBEDDING_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR", ".cache/embeddings")
+EMBEDDING_CACHE_MAX_MB = int(os.getenv("EMBEDDING_CACHE_MAX_MB", "256"))
+# El índice de la caché se reescribe como mucho cada EMBEDDING_CACHE_FLUSH_INTERVAL_S segundos (y al apagar)
+EMBEDDING_CACHE_FLUSH_INTERVAL_S = float(os.getenv("EMBEDDING_CACHE_FLUSH_INTERVAL_S", "30"))
+
+# Búsqueda vectorial (RAG)
+# VECTOR_SEARCH_BACKEND: "supabase" (RPC match_material_chunks) o "local" (índice NumPy en memoria)
+# VECTOR_INDEX_DIR: si se define, el índice local se guarda en disco y se carga con memory-map
+VECTOR_SEARCH_BACKEND = os.getenv("VECTOR_SEARCH_BACKEND", "supabase").lower()
+VECTOR_MATCH_THRESHOLD = float(os.getenv("VECTOR_MATCH_THRESHOLD", "0.5"))
+VECTOR_INDEX_DIR = os.getenv("VECTOR_INDEX_DIR", "")
+# Compresión del índice local (api/vector_index.py, MaterialIndex):
+# VECTOR_INDEX_STORAGE: "float32", "float16" o "int8" (cuantización escalar por fila) para la matriz que se recorre
+# VECTOR_INDEX_DIMS: conserva solo las primeras N dimensiones de cada embedding (0 = todas)
+# VECTOR_RESCORE_FACTOR: con compresión, los top_k * factor candidatos se reordenan con los vectores float32
+#   completos (0 = sin rescoring ni copia completa). Esa copia vive en disco (memory-map) si VECTOR_INDEX_DIR
+#   está definido; sin él queda en memoria y la compresión solo ahorra memoria con VECTOR_RESCORE_FACTOR=0
+VECTOR_INDEX_STORAGE = os.getenv("VECTOR_INDEX_STORAGE", "float32").lower()
+VECTOR_INDEX_DIMS = int(os.getenv("VECTOR_INDEX_DIMS", "0"))
+VECTOR_RESCORE_FACTOR = int(os.getenv("VECTOR_RESCORE_FACTOR", "4"))
+
+# Índice aproximado (IVF) sobre toda la biblioteca de chunks (búsqueda entre materiales)
+# ANN_NLIST: número de listas invertidas; ANN_NPROBE: listas revisadas por consulta (recall vs latencia)
+ANN_INDEX_ENABLED = os.getenv("ANN_INDEX_ENABLED", "false").lower() == "true"
+ANN_INDEX_PATH = os.getenv("ANN_INDEX_PATH", ".cache/ann_index.npz")
+ANN_NLIST = int(os.getenv("ANN_NLIST", "1024"))
+ANN_NPROBE = int(os.getenv("ANN_NPROBE", "16"))
+ANN_SAVE_INTERVAL_S = float(os.getenv("ANN_SAVE_INTERVAL_S", "60"))
+# Los centroides se re-entrenan (en segundo plano) cuando el índice crece este factor desde el último
+# entrenamiento (0 = entrenar solo una vez)
+ANN_RETRAIN_GROWTH = float(os.getenv("ANN_RETRAIN_GROWTH", "4"))
+
+# Memo en memoria (LRU + TTL) para los embeddings de las consultas de las rutas RAG
+QUERY_CACHE_MAX_ENTRIES = int(os.getenv("QUERY_CACHE_MAX_ENTRIES", "2048"))
+QUERY_CACHE_TTL_S = float(os.getenv("QUERY_CACHE_TTL_S", "3600"))
+
+# Caché semántica de flashcards: reutiliza la respuesta si la consulta está a distancia coseno <= RESPONSE_CACHE_MAX_DISTANCE
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "512"))
+RESPONSE_CACHE_MAX_DISTANCE = float(os.getenv("RESPONSE_CACHE_MAX_DISTANCE", "0.05"))
+RESPONSE_CACHE_TTL_S = float(os.getenv("RESPONSE_CACHE_TTL_S", "86400"))
+
+# Ingesta de PDFs por streaming: los chunks se insertan en lotes de INGEST_BATCH_SIZE a medida que se generan
+# INGEST_STORE_RAW_TEXT: guardar además el texto completo en materials.raw_text (requiere acumularlo en memoria)
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "200"))
+INGEST_STORE_RAW_TEXT = os.getenv("INGEST_STORE_RAW_TEXT", "false").lower() == "true"
+# Deduplicación de uploads: un PDF idéntico (sha256 de los bytes) a uno ya ingerido se clona
+# (chunks + embeddings, mismo archivo en Storage) en lugar de volver a procesarse.
+# Requiere la columna materials.content_hash (text, con índice)
+DEDUP_UPLOADS = os.getenv("DEDUP_UPLOADS", "true").lower() == "true"
+
+# Extracción de texto de PDFs en paralelo (pool de procesos)
+# Los PDFs más pequeños que PDF_PARALLEL_MIN_BYTES se siguen extrayendo en serie
+PDF_EXTRACT_WORKERS = int(os.getenv("PDF_EXTRACT_WORKERS", str(os.cpu_count() or 1)))
+PDF_PARALLEL_MIN_BYTES = int(os.getenv("PDF_PARALLEL_MIN_BYTES", str(2 * 1024 * 1024)))
+# INGEST_PREFETCH_BATCHES: lotes de chunks que la extracción puede adelantar mientras se espera a Supabase
+INGEST_PREFETCH_BATCHES = int(os.getenv("INGEST_PREFETCH_BATCHES", "2"))
+
+# Escritura masiva de chunks (api/chunk_writer.py): lotes de como máximo CHUNK_INSERT_BATCH_ROWS filas
+# y CHUNK_INSERT_BATCH_KB KB de JSON, CHUNK_INSERT_CONCURRENCY lotes a la vez, reintentos con backoff
+CHUNK_INSERT_BATCH_ROWS = int(os.getenv("CHUNK_INSERT_BATCH_ROWS", "500"))
+CHUNK_INSERT_BATCH_KB = int(os.getenv("CHUNK_INSERT_BATCH_KB", "1024"))
+CHUNK_INSERT_CONCURRENCY = int(os.getenv("CHUNK_INSERT_CONCURRENCY", "4"))
+CHUNK_INSERT_MAX_RETRIES = int(os.getenv("CHUNK_INSERT_MAX_RETRIES", "4"))
+CHUNK_INSERT_BACKOFF_BASE_S = float(os.getenv("CHUNK_INSERT_BACKOFF_BASE_S", "0.5"))
+CHUNK_INSERT_BACKOFF_MAX_S = float(os.getenv("CHUNK_INSERT_BACKOFF_MAX_S", "8"))
+
+# Jobs de ingesta en segundo plano (cola persistente en SQLite)
+INGEST_JOBS_DB = os.getenv("INGEST_JOBS_DB", ".cache/ingestion_jobs.sqlite3")
+INGEST_JOBS_DIR = os.getenv("INGEST_JOBS_DIR", ".cache/ingestion_jobs")
+INGEST_MAX_CONCURRENT_JOBS = int(os.getenv("INGEST_MAX_CONCURRENT_JOBS", "2"))
+# Un job fallido vuelve a la cola (reanudando desde su progreso) hasta INGEST_JOB_MAX_ATTEMPTS intentos,
+# esperando INGEST_JOB_RETRY_BACKOFF_S * 2^(intento - 1) segundos entre uno y otro. Al apagar, se espera
+# hasta INGEST_SHUTDOWN_TIMEOUT_S a que los jobs en curso lleguen a un punto de corte (fin de un lote)
+INGEST_JOB_MAX_ATTEMPTS = int(os.getenv("INGEST_JOB_MAX_ATTEMPTS", "3"))
+INGEST_JOB_RETRY_BACKOFF_S = float(os.getenv("INGEST_JOB_RETRY_BACKOFF_S", "30"))
+INGEST_SHUTDOWN_TIMEOUT_S = float(os.getenv("INGEST_SHUTDOWN_TIMEOUT_S", "30"))
+# Cada proceso marca como suyos los jobs que corre y refresca su latido (heartbeat_at) cada
+# INGEST_JOB_HEARTBEAT_S; un job 'running' sin latido en INGEST_JOB_STALE_S se da por huérfano
+# (su proceso murió) y vuelve a la cola. Así varios procesos (uvicorn --workers) comparten la cola
+INGEST_JOB_HEARTBEAT_S = float(os.getenv("INGEST_JOB_HEARTBEAT_S", "10"))
+INGEST_JOB_STALE_S = float(os.getenv("INGEST_JOB_STALE_S", "60"))
+
+# Chunker de la ingesta: "fixed" (ventanas de caracteres, split_text_simple),
+# "cdc" (definido por contenido: una edición solo cambia los chunks cercanos) o
+# "tokens" (presupuesto de CHUNK_MAX_TOKENS tokens estimados por chunk). Cambiarlo altera los límites de
+# los chunks que se ingieran desde entonces: "cdc" abarata replace_pdf, pero es opcional por despliegue
+CHUNKER = os.getenv("CHUNKER", "fixed").lower()
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "300"))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "50"))
+
+# Armado del contexto RAG (api/context_builder.py): se recuperan top_k * CONTEXT_CANDIDATES_FACTOR
+# candidatos, se descartan casi-duplicados (similitud >= CONTEXT_DEDUP_THRESHOLD), se diversifica
+# con MMR (CONTEXT_MMR_LAMBDA: 1 = solo relevancia, 0 = solo diversidad) y se llena hasta
+# CONTEXT_TOKEN_BUDGET tokens estimados, fusionando chunks contiguos que se solapan
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1000"))
+CONTEXT_CANDIDATES_FACTOR = int(os.getenv("CONTEXT_CANDIDATES_FACTOR", "3"))
+CONTEXT_MMR_LAMBDA = float(os.getenv("CONTEXT_MMR_LAMBDA", "0.7"))
+CONTEXT_DEDUP_THRESHOLD = float(os.getenv("CONTEXT_DEDUP_THRESHOLD", "0.9"))
+CONTEXT_MIN_OVERLAP_CHARS = int(os.getenv("CONTEXT_MIN_OVERLAP_CHARS", "20"))
+
+# Modo de recuperación de las rutas RAG: "dense" (embeddings), "lexical" (BM25 en memoria,
+# api/lexical_index.py) o "hybrid" (ambos, fusionados con reciprocal rank fusion: 1 / (RETRIEVAL_RRF_K + rango))
+# Salvo en "dense", las consultas de hasta LEXICAL_SHORT_QUERY_TERMS palabras van solo por BM25, sin embedding.
+# "lexical" e "hybrid" son opcionales: cada worker mantiene en memoria el texto de los materiales consultados
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "dense").lower()
+RETRIEVAL_RRF_K = int(os.getenv("RETRIEVAL_RRF_K", "60"))
+LEXICAL_SHORT_QUERY_TERMS = int(os.getenv("LEXICAL_SHORT_QUERY_TERMS", "3"))
+LEXICAL_BM25_K1 = float(os.getenv("LEXICAL_BM25_K1", "1.2"))
+LEXICAL_BM25_B = float(os.getenv("LEXICAL_BM25_B", "0.75"))
+
+# Generación por lotes (POST /flashcards/batch, api/batch_generation.py): como máximo BATCH_MAX_ITEMS
+# pares (material, consulta) por petición y BATCH_GENERATION_CONCURRENCY llamadas de generación a la vez
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "100"))
+BATCH_GENERATION_CONCURRENCY = int(os.getenv("BATCH_GENERATION_CONCURRENCY", "8"))
+
+# Métricas (api/metrics.py, GET /metrics): el desglose de tiempos por etapa se devuelve en la cabecera
+# Server-Timing si la petición trae "X-Debug-Timing: 1", o en todas si METRICS_TIMING_HEADER=true
+METRICS_TIMING_HEADER = os.getenv("METRICS_TIMING_HEADER", "false").lower() == "true"
+
+# Transcripción con Whisper en un pool de procesos (api/speech.py)
+# WHISPER_QUEUE_SIZE: transcripciones en espera o en curso antes de responder 503
+# WHISPER_WARM_MODELS: modelos que cada worker carga al arrancar la app (separados por coma). Vacío por
+#   defecto: los procesos de Whisper recién se crean con la primera transcripción (despliegues sin audio no
+#   pagan su memoria ni su arranque); con p. ej. "small" se arrancan y precargan en el lifespan
+# WHISPER_MAX_MODEL_MEMORY_MB: memoria de modelos por worker; se expulsa el menos usado al pasarse
+WHISPER_WORKERS = int(os.getenv("WHISPER_WORKERS", str(max(1, (os.cpu_count() or 1) // 4))))
+WHISPER_QUEUE_SIZE = int(os.getenv("WHISPER_QUEUE_SIZE", "8"))
+WHISPER_QUEUE_TIMEOUT_S = float(os.getenv("WHISPER_QUEUE_TIMEOUT_S", "5"))
+WHISPER_WARM_MODELS = [m.strip() for m in os.getenv("WHISPER_WARM_MODELS", "").split(",") if m.strip()]
+WHISPER_MAX_MODEL_MEMORY_MB = int(os.getenv("WHISPER_MAX_MODEL_MEMORY_MB", "2048"))
+WHISPER_TORCH_THREADS = int(os.getenv("WHISPER_TORCH_THREADS", str(max(1, (os.cpu_count() or 1) // max(1, WHISPER_WORKERS)))))
+# Transcripción segmentada: el audio se corta en silencios de al menos WHISPER_MIN_SILENCE_S
+# en segmentos de ~WHISPER_SEGMENT_TARGET_S (máximo WHISPER_SEGMENT_MAX_S) que se transcriben en paralelo
+WHISPER_SEGMENT_TARGET_S = float(os.getenv("WHISPER_SEGMENT_TARGET_S", "25"))
+WHISPER_SEGMENT_MAX_S = float(os.getenv("WHISPER_SEGMENT_MAX_S", "30"))
+WHISPER_MIN_SILENCE_S = float(os.getenv("WHISPER_MIN_SILENCE_S", "0.3"))
+# La recuperación de contexto arranca cada WHISPER_RETRIEVAL_WINDOW_CHARS caracteres transcritos
+WHISPER_RETRIEVAL_WINDOW_CHARS = int(os.getenv("WHISPER_RETRIEVAL_WINDOW_CHARS", "1500"))
+
+# Planificador de llamadas a Gemini (api/gemini_scheduler.py): límites por modelo y reintentos
+# GEMINI_RPM_LIMITS / GEMINI_TPM_LIMITS: "modelo=límite,modelo=límite" (los demás usan los valores por defecto)
+# GEMINI_PROJECT_RPM / GEMINI_PROJECT_TPM: cuota compartida por todos los modelos del proyecto; es la que
+# permite que una generación interactiva pase delante de los embeddings bulk de otro modelo.
+# En todos los límites 0 = sin límite; un valor negativo hace fallar el arranque (ValueError)
+def _parse_model_limits(value: str) -> dict:
+    limits = {}
+    for item in value.split(","):
+        if "=" in item:
+            model, limit = item.split("=", 1)
+            limits[model.strip()] = int(limit)
+    return limits
+
+GEMINI_SCHEDULER_ENABLED = os.getenv("GEMINI_SCHEDULER_ENABLED", "true").lower() == "true"
+GEMINI_RPM_LIMITS = _parse_model_limits(os.getenv("GEMINI_RPM_LIMITS", ""))
+GEMINI_TPM_LIMITS = _parse_model_limits(os.getenv("GEMINI_TPM_LIMITS", ""))
+GEMINI_DEFAULT_RPM = int(os.getenv("GEMINI_DEFAULT_RPM", "1000"))
+GEMINI_DEFAULT_TPM = int(os.getenv("GEMINI_DEFAULT_TPM", "1000000"))
+GEMINI_PROJECT_RPM = int(os.getenv("GEMINI_PROJECT_RPM", "0"))
+GEMINI_PROJECT_TPM = int(os.getenv("GEMINI_PROJECT_TPM", "0"))
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "5"))
+GEMINI_BACKOFF_BASE_S = float(os.getenv("GEMINI_BACKOFF_BASE_S", "0.5"))
+GEMINI_BACKOFF_MAX_S = float(os.getenv("GEMINI_BACKOFF_MAX_S", "20"))
@@ -0,0 +1,357 @@
+import re
+import asyncio
+
+import numpy as np
+
+from .config import (
+    CONTEXT_TOKEN_BUDGET, CONTEXT_CANDIDATES_FACTOR, CONTEXT_MMR_LAMBDA,
+    CONTEXT_DEDUP_THRESHOLD, CONTEXT_MIN_OVERLAP_CHARS, RETRIEVAL_MODE, RETRIEVAL_RRF_K,
+)
+from .text_processing import estimate_tokens
+from .vector_index import vector_search_hits, avector_search_hits, avector_search_hits_many
+from .lexical_index import alexical_search_hits, is_keyword_query
+from .gemini import aget_query_embedding, aget_query_embeddings
+from .metrics import trace
+
+# Armado del contexto para el LLM a partir de los chunks recuperados.
+# Los chunks vecinos comparten el solapamiento del chunker y los documentos repiten
+# párrafos, así que unir el top-k con "---" infla el prompt con texto duplicado.
+# Aquí, entre vector_search y la generación:
+#   1. se descartan casi-duplicados,
+#   2. se eligen chunks con MMR (relevancia vs. diversidad) hasta llenar el presupuesto de tokens,
+#   3. se ordenan por posición en el documento (page_start, id) y se fusionan los contiguos que se solapan.
+
+CONTEXT_SEPARATOR = "\n\n---\n\n"
+_WORD_RE = re.compile(r'\w+')
+
+
+def _shingles(text: str, n: int = 3) -> set:
+    words = _WORD_RE.findall(text.lower())
+    if len(words) < n:
+        return {tuple(words)}
+    return {tuple(words[i:i + n]) for i in range(len(words) - n + 1)}
+
+
+def _similarity_matrix(hits: list[dict]) -> np.ndarray:
+    # Similitud entre candidatos: coseno de embeddings si los hay (backend local),
+    # si no, Jaccard de 3-gramas de palabras sobre el texto
+    if all(h.get("embedding") is not None for h in hits):
+        matrix = np.asarray([h["embedding"] for h in hits], dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        matrix = matrix / norms
+        return matrix @ matrix.T
+    shingles = [_shingles(h["chunk_text"]) for h in hits]
+    n = len(hits)
+    sims = np.eye(n, dtype=np.float32)
+    for i in range(n):
+        for j in range(i + 1, n):
+            union = len(shingles[i] | shingles[j])
+            sims[i, j] = sims[j, i] = len(shingles[i] & shingles[j]) / union if union else 0.0
+    return sims
+
+
+def find_overlap(a: str, b: str, min_chars: int = CONTEXT_MIN_OVERLAP_CHARS) -> int:
+    """
+    Largo del mayor sufijo de `a` que es prefijo de `b` (0 si es menor que min_chars).
+    Se busca el inicio de `b` solo dentro de la cola de `a` y se verifica cada aparición.
+    """
+    if min_chars <= 0 or len(a) < min_chars or len(b) < min_chars:
+        return 0
+    probe = b[:min_chars]
+    position = a.find(probe, max(0, len(a) - len(b)))
+    while position != -1:
+        # La primera aparición que calza da el solapamiento más largo
+        if b.startswith(a[position:]):
+            return len(a) - position
+        position = a.find(probe, position + 1)
+    return 0
+
+
+def merge_overlapping(texts: list[str], min_chars: int = CONTEXT_MIN_OVERLAP_CHARS) -> tuple[list[str], int]:
+    # Fusiona (en orden) cada texto con el siguiente cuando el final de uno es el inicio del otro
+    merged = []
+    merges = 0
+    for text in texts:
+        if merged:
+            overlap = find_overlap(merged[-1], text, min_chars)
+            if overlap:
+                merged[-1] += text[overlap:]
+                merges += 1
+                continue
+            if text in merged[-1]:
+                merges += 1
+                continue
+        merged.append(text)
+    return merged, merges
+
+
+def _truncate_to_tokens(text: str, max_tokens: int) -> str:
+    # Recorta por palabras completas hasta max_tokens tokens estimados
+    words = text.split()
+    total = 0
+    for i, word in enumerate(words):
+        total += estimate_tokens(word)
+        if total > max_tokens:
+            return " ".join(words[:i])
+    return text
+
+
+def _position(hit: dict, rank: int, by_page: bool) -> tuple:
+    # Posición en el documento. Los ids no alcanzan: replace_material_pdf inserta los chunks editados
+    # con ids nuevos (mayores) y ChunkWriter escribe lotes en paralelo, así que se ordena primero por
+    # page_start y el id solo desempata dentro de la página
+    if hit.get("id") is None:
+        return (rank, rank, rank)
+    return (hit["page_start"] if by_page else 0, hit["id"], rank)
+
+
+def _assemble(selected: list[dict], min_chars: int) -> tuple[list[str], int]:
+    # Orden del documento (ver _position) y fusión de solapes
+    ordered = sorted(selected, key=lambda h: h["_order"])
+    return merge_overlapping([h["chunk_text"] for h in ordered], min_chars)
+
+
+def build_context(hits: list[dict], max_chunks: int = 4, token_budget: int = CONTEXT_TOKEN_BUDGET,
+                  mmr_lambda: float = CONTEXT_MMR_LAMBDA, dedup_threshold: float = CONTEXT_DEDUP_THRESHOLD,
+                  min_overlap_chars: int = CONTEXT_MIN_OVERLAP_CHARS) -> dict:
+    """
+    Construye el contexto para el LLM a partir de los candidatos de vector_search_hits,
+    del índice léxico o de su fusión RRF (ordenados de más a menos relevante).
+    Retorna el texto del contexto, cuántos chunks se usaron, sus tokens estimados y
+    contadores de lo que se descartó (duplicados) o fusionó (solapes).
+    """
+    if not hits:
+        return {"context": "", "chunk_ids": [], "selected": 0, "context_tokens": 0,
+                "candidates": 0, "duplicates_dropped": 0, "merged": 0}
+
+    # Por página solo si todos los candidatos la traen (un RPC o índice sin page_start: orden por id)
+    by_page = all(hit.get("page_start") is not None for hit in hits)
+    candidates = []
+    for rank, hit in enumerate(hits):
+        candidates.append({
+            **hit,
+            "_order": _position(hit, rank, by_page),
+            "_relevance": float(hit["similarity"]) if hit.get("similarity") is not None else 1.0 - rank / len(hits),
+        })
+    sims = _similarity_matrix(candidates)
+
+    # Relevancia reescalada a [0, 1] entre los candidatos: la similitud consulta-chunk suele
+    # moverse en un rango estrecho y, sin reescalar, la penalización por redundancia la aplasta
+    relevance = np.array([c["_relevance"] for c in candidates], dtype=np.float32)
+    spread = float(relevance.max() - relevance.min())
+    relevance = (relevance - relevance.min()) / spread if spread > 0 else np.ones_like(relevance)
+
+    # 1. Casi-duplicados: se conserva el más relevante (los hits ya vienen ordenados por relevancia)
+    kept = []
+    for i, candidate in enumerate(candidates):
+        if any(sims[i, j] >= dedup_threshold or candidate["chunk_text"] in candidates[j]["chunk_text"] for j in kept):
+            continue
+        kept.append(i)
+    duplicates_dropped = len(candidates) - len(kept)
+
+    # 2. MMR con presupuesto: cada paso elige el candidato que maximiza
+    #    lambda * relevancia - (1 - lambda) * similitud máxima con lo ya elegido,
+    #    y solo lo acepta si el contexto resultante (ya fusionado) entra en el presupuesto
+    selected: list[int] = []
+    remaining = list(kept)
+    context_tokens = 0
+    while remaining and len(selected) < max_chunks:
+        best, best_score = None, -np.inf
+        for i in remaining:
+            redundancy = max((sims[i, j] for j in selected), default=0.0)
+            score = mmr_lambda * relevance[i] - (1 - mmr_lambda) * redundancy
+            if score > best_score:
+                best, best_score = i, score
+        remaining.remove(best)
+
+        pieces, _ = _assemble([candidates[j] for j in selected + [best]], min_overlap_chars)
+        tokens = sum(estimate_tokens(p) for p in pieces)
+        if tokens <= token_budget:
+            selected.append(best)
+            context_tokens = tokens
+        elif not selected:
+            # Ni el chunk más relevante entra completo: se recorta al presupuesto
+            candidates[best]["chunk_text"] = _truncate_to_tokens(candidates[best]["chunk_text"], token_budget)
+            selected.append(best)
+            context_tokens = estimate_tokens(candidates[best]["chunk_text"])
+        # Si no entra, se prueba con el siguiente (puede ser más corto o solaparse con lo elegido)
+
+    # 3. Orden de documento + fusión de chunks contiguos
+    chosen = [candidates[i] for i in selected]
+    pieces, merged = _assemble(chosen, min_overlap_chars)
+    return {
+        "context": CONTEXT_SEPARATOR.join(pieces),
+        "chunk_ids": [c.get("id") for c in sorted(chosen, key=lambda h: h["_order"])],
+        "selected": len(chosen),
+        "context_tokens": context_tokens,
+        "candidates": len(candidates),
+        "duplicates_dropped": duplicates_dropped,
+        "merged": merged,
+    }
+
+
+def retrieve_context(query_embedding: list, material_id: int, top_k: int = 4,
+                     token_budget: int = CONTEXT_TOKEN_BUDGET) -> dict:
+    # Recupera top_k * CONTEXT_CANDIDATES_FACTOR candidatos y arma el contexto con como máximo top_k chunks
+    hits = vector_search_hits(query_embedding, material_id, top_k * max(1, CONTEXT_CANDIDATES_FACTOR))
+    return build_context(hits, max_chunks=top_k, token_budget=token_budget)
+
+
+def reciprocal_rank_fusion(hit_lists: list[list[dict]], k: int = RETRIEVAL_RRF_K) -> list[dict]:
+    # Cada lista aporta 1 / (k + rango) a cada chunk que contiene; solo importan los rangos, así que
+    # la similitud coseno y el puntaje BM25 (escalas distintas) se combinan sin calibrarlos.
+    # El resultado queda ordenado por 'rrf_score' y sin 'similarity' (build_context usa el rango)
+    fused, scores = {}, {}
+    for hits in hit_lists:
+        for rank, hit in enumerate(hits):
+            key = hit.get("id") if hit.get("id") is not None else hit["chunk_text"]
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank + 1)
+            if key not in fused:
+                fused[key] = {**hit, "similarity": None}
+                continue
+            # Lo que la primera lista no traía (embedding del índice local, page_start) se completa con las demás
+            for field in ("embedding", "page_start"):
+                if fused[key].get(field) is None and hit.get(field) is not None:
+                    fused[key][field] = hit[field]
+    ordered = sorted(fused, key=lambda key: scores[key], reverse=True)
+    return [{**fused[key], "rrf_score": scores[key]} for key in ordered]
+
+
+def choose_retrieval_mode(query: str, mode: str = RETRIEVAL_MODE) -> str:
+    # Las consultas cortas de palabras clave van solo por BM25 (sin embedding), salvo en modo "dense"
+    if mode != "dense" and is_keyword_query(query):
+        return "lexical"
+    return mode
+
+
+async def aretrieve_hits(query: str, material_id: int, limit: int, query_embedding: list | None = None,
+                         mode: str | None = None) -> tuple[list[dict], str]:
+    """
+    Candidatos para `query` según el modo: "lexical" (BM25), "dense" (embeddings) o "hybrid"
+    (ambas búsquedas a la vez, fusionadas con RRF). Si no se pasa el modo se elige con
+    choose_retrieval_mode. El embedding solo se calcula si el modo lo necesita y no se recibió.
+    Retorna (hits, modo usado): una consulta léxica sin coincidencias se resuelve con la densa.
+    """
+    mode = mode or choose_retrieval_mode(query)
+    if mode == "lexical":
+        hits = await alexical_search_hits(query, material_id, limit)
+        if hits:
+            return hits, "lexical"
+        mode = "dense"
+
+    if query_embedding is None:
+        query_embedding = await aget_query_embedding(query)
+        if not query_embedding:
+            raise Exception("Fallo al generar el embedding de la consulta.")
+    if mode == "dense":
+        return await avector_search_hits(query_embedding, material_id, limit), "dense"
+
+    dense, lexical = await asyncio.gather(
+        avector_search_hits(query_embedding, material_id, limit),
+        alexical_search_hits(query, material_id, limit),
+    )
+    return reciprocal_rank_fusion([dense, lexical]), "hybrid"
+
+
+async def aretrieve_context(query: str, material_id: int, top_k: int = 4, token_budget: int = CONTEXT_TOKEN_BUDGET,
+                            query_embedding: list | None = None, mode: str | None = None) -> dict:
+    # Variante async de retrieve_context con modos de recuperación (ver aretrieve_hits).
+    # El armado del contexto es CPU liviano y corre en el loop
+    hits, mode = await aretrieve_hits(query, material_id, top_k * max(1, CONTEXT_CANDIDATES_FACTOR), query_embedding, mode)
+    with trace("context_build"):
+        built = build_context(hits, max_chunks=top_k, token_budget=token_budget)
+    return {**built, "retrieval_mode": mode}
+
+
+async def aretrieve_hits_many(queries: list[str], material_id: int, limits: list[int],
+                              query_embeddings: list | None = None, modes: list | None = None) -> list:
+    """
+    aretrieve_hits para varias consultas del MISMO material (endpoint por lotes): las búsquedas
+    densas se hacen juntas (un producto matriz-matriz con el backend local) y las léxicas a la vez.
+    Retorna, en orden, (hits, modo) por consulta o la excepción de esa consulta
+    (como asyncio.gather con return_exceptions=True), para que un fallo no tumbe al resto.
+    """
+    n = len(queries)
+    embeddings = list(query_embeddings) if query_embeddings is not None else [None] * n
+    modes = [mode or choose_retrieval_mode(query) for query, mode in zip(queries, modes or [None] * n)]
+    results: list = [None] * n
+
+    async def dense_search(items: list[int]) -> dict:
+        # Embeddings que falten (consultas léxicas sin coincidencias) en una sola llamada
+        missing = [i for i in items if embeddings[i] is None]
+        if missing:
+            for i, embedding in zip(missing, await aget_query_embeddings([queries[i] for i in missing])):
+                embeddings[i] = embedding
+        for i in items:
+            if not embeddings[i]:
+                results[i] = Exception("Fallo al generar el embedding de la consulta.")
+        ready = [i for i in items if embeddings[i]]
+        if not ready:
+            return {}
+        # Los top-k de cada consulta son un prefijo de su top-max(limits)
+        found = await avector_search_hits_many([embeddings[i] for i in ready], material_id, max(limits[i] for i in ready))
+        return {i: hits[:limits[i]] for i, hits in zip(ready, found)}
+
+    lexical_items = [i for i in range(n) if modes[i] in ("lexical", "hybrid")]
+    dense_items = [i for i in range(n) if modes[i] != "lexical"]
+    lexical_found, dense = await asyncio.gather(
+        asyncio.gather(*[alexical_search_hits(queries[i], material_id, limits[i]) for i in lexical_items]),
+        dense_search(dense_items),
+    )
+    lexical = dict(zip(lexical_items, lexical_found))
+
+    # Consultas léxicas sin coincidencias: se resuelven con la búsqueda densa, como en aretrieve_hits
+    fallback = [i for i in lexical_items if modes[i] == "lexical" and not lexical[i]]
+    if fallback:
+        dense.update(await dense_search(fallback))
+
+    for i in range(n):
+        if results[i] is not None:
+            continue
+        if modes[i] == "lexical" and lexical[i]:
+            results[i] = (lexical[i], "lexical")
+        elif modes[i] == "hybrid":
+            results[i] = (reciprocal_rank_fusion([dense[i], lexical[i]]), "hybrid")
+        else:
+            results[i] = (dense[i], "dense")
+    return results
+
+
+async def aretrieve_context_many(queries: list[str], material_id: int, top_ks: list[int],
+                                 token_budget: int = CONTEXT_TOKEN_BUDGET, query_embeddings: list | None = None,
+                                 modes: list | None = None) -> list:
+    # aretrieve_context para varias consultas del mismo material (ver aretrieve_hits_many);
+    # cada posición es el contexto armado o la excepción de esa consulta
+    limits = [top_k * max(1, CONTEXT_CANDIDATES_FACTOR) for top_k in top_ks]
+    retrieved = await aretrieve_hits_many(queries, material_id, limits, query_embeddings, modes)
+    results = []
+    for top_k, item in zip(top_ks, retrieved):
+        if isinstance(item, BaseException):
+            results.append(item)
+            continue
+        hits, mode = item
+        with trace("context_build"):
+            built = build_context(hits, max_chunks=top_k, token_budget=token_budget)
+        results.append({**built, "retrieval_mode": mode})
+    return results
+
+
+def _hit_score(hit: dict) -> float:
+    # Relevancia de un hit según su origen: similitud coseno, puntaje RRF o puntaje BM25
+    for field in ("similarity", "rrf_score", "score"):
+        if hit.get(field) is not None:
+            return hit[field]
+    return 0.0
+
+
+def merge_hits(hit_lists: list[list[dict]]) -> list[dict]:
+    # Une los candidatos de varias consultas (p. ej. una por tramo de una transcripción larga):
+    # un chunk repetido conserva su mayor puntaje y el resultado queda ordenado por relevancia
+    best = {}
+    for hits in hit_lists:
+        for hit in hits:
+            key = hit.get("id") if hit.get("id") is not None else hit["chunk_text"]
+            if key not in best or _hit_score(hit) > _hit_score(best[key]):
+                best[key] = hit
+    return sorted(best.values(), key=_hit_score, reverse=True)
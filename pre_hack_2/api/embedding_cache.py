@@ -0,0 +1,227 @@
+import os
+import json
+import time
+import atexit
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: sin flock
+    fcntl = None
+
+from .config import (
+    EMBEDDING_MODEL, EMBEDDING_DIM,
+    EMBEDDING_CACHE_ENABLED, EMBEDDING_CACHE_DIR, EMBEDDING_CACHE_MAX_MB, EMBEDDING_CACHE_FLUSH_INTERVAL_S,
+)
+
+
+def content_hash(text: str) -> str:
+    # Mismo hash que se guarda como 'chunk_hash' en material_chunks (ver routes/upload.py)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class CacheLockedError(RuntimeError):
+    # Otro proceso ya tiene abierto el mismo directorio de caché
+    pass
+
+
+class EmbeddingCache:
+    """
+    Caché local y persistente de embeddings direccionada por contenido.
+    La clave es (modelo, chunk_hash): cada modelo tiene su propio directorio.
+
+    Almacenamiento:
+    - 'vectors.f32': archivo binario de registros de tamaño fijo (dim float32 por slot).
+    - 'index.json': mapa chunk_hash -> slot, guardado en orden LRU (del más antiguo al más reciente).
+
+    Cuando se supera el máximo de entradas se expulsa la entrada menos usada
+    recientemente y su slot se reutiliza, así el archivo no crece más allá del límite.
+
+    El índice se reescribe entero, así que no se guarda después de cada lote: se guarda cuando hubo
+    inserciones o expulsiones y pasaron `flush_interval_s` segundos (o al apagar). Los aciertos solo
+    reordenan el LRU en memoria. Un slot expulsado no se reutiliza hasta el siguiente guardado: si el
+    proceso se corta antes, el índice en disco nunca apunta a un vector que no es el suyo.
+
+    Un directorio pertenece a un solo proceso: el mapa de slots vive en memoria, así que dos
+    procesos sobre los mismos archivos se pisarían los slots y devolverían vectores ajenos como
+    aciertos. Al abrirla se toma un flock exclusivo sobre '.lock'; si otro proceso ya lo tiene
+    (uvicorn --workers), se lanza CacheLockedError y en ese proceso la caché queda deshabilitada.
+    """
+
+    def __init__(self, directory: str, model: str, dim: int, max_entries: int,
+                 flush_interval_s: float = EMBEDDING_CACHE_FLUSH_INTERVAL_S):
+        self.dim = dim
+        self.max_entries = max(1, max_entries)
+        self.flush_interval_s = flush_interval_s
+        self.record_size = dim * 4
+        self.directory = os.path.join(directory, model.replace("/", "_"))
+        self.vectors_path = os.path.join(self.directory, "vectors.f32")
+        self.index_path = os.path.join(self.directory, "index.json")
+
+        self._lock = threading.Lock()
+        self._index: OrderedDict[str, int] = OrderedDict()
+        self._free_slots: list[int] = []
+        # Slots expulsados desde el último guardado (el índice en disco todavía los referencia)
+        self._released: list[int] = []
+        self._next_slot = 0
+        self._dirty = False
+        self._last_flush = time.monotonic()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock_file = self._acquire_directory_lock()
+        if not os.path.exists(self.vectors_path):
+            open(self.vectors_path, "wb").close()
+        self._load_index()
+        self._file = open(self.vectors_path, "r+b")
+
+    def _acquire_directory_lock(self):
+        # El archivo queda abierto (y el lock tomado) mientras viva el proceso
+        lock_file = open(os.path.join(self.directory, ".lock"), "a")
+        if fcntl is None:
+            return lock_file
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            raise CacheLockedError(f"La caché de embeddings en {self.directory} está en uso por otro proceso.")
+        return lock_file
+
+    def _load_index(self):
+        if not os.path.exists(self.index_path):
+            return
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta.get("dim") != self.dim:
+                # Cambió la dimensión: la caché existente no sirve
+                return
+            for key, slot in meta.get("entries", []):
+                self._index[key] = slot
+            # Si el límite se redujo desde la última ejecución, expulsamos las más antiguas
+            while len(self._index) > self.max_entries:
+                self._released.append(self._index.popitem(last=False)[1])
+                self._dirty = True
+            self._next_slot = meta.get("next_slot", len(self._index))
+            used = set(self._index.values()) | set(self._released)
+            self._free_slots = [s for s in range(self._next_slot) if s not in used]
+        except Exception as e:
+            print(f"Error al cargar el índice de la caché de embeddings: {e}")
+            self._index.clear()
+
+    def _read_slot(self, slot: int) -> list[float]:
+        self._file.seek(slot * self.record_size)
+        raw = self._file.read(self.record_size)
+        return np.frombuffer(raw, dtype=np.float32).tolist()
+
+    def _write_slot(self, slot: int, embedding: list[float]):
+        self._file.seek(slot * self.record_size)
+        self._file.write(np.asarray(embedding, dtype=np.float32).tobytes())
+
+    def get(self, key: str) -> list[float] | None:
+        with self._lock:
+            slot = self._index.get(key)
+            if slot is None:
+                self.misses += 1
+                return None
+            self._index.move_to_end(key)
+            self.hits += 1
+            return self._read_slot(slot)
+
+    def get_many(self, keys: list[str]) -> dict[str, list[float]]:
+        # Retorna solo las claves encontradas
+        found = {}
+        for key in keys:
+            emb = self.get(key)
+            if emb is not None:
+                found[key] = emb
+        return found
+
+    def put(self, key: str, embedding: list[float]):
+        if len(embedding) != self.dim:
+            return
+        with self._lock:
+            slot = self._index.get(key)
+            if slot is None:
+                if len(self._index) >= self.max_entries:
+                    # Expulsamos la entrada menos usada recientemente; su slot queda libre tras el próximo guardado
+                    _, released = self._index.popitem(last=False)
+                    self._released.append(released)
+                    self.evictions += 1
+                if self._free_slots:
+                    slot = self._free_slots.pop()
+                else:
+                    slot = self._next_slot
+                    self._next_slot += 1
+            self._write_slot(slot, embedding)
+            self._index[key] = slot
+            self._index.move_to_end(key)
+            self._dirty = True
+
+    def put_many(self, items: dict[str, list[float]]):
+        for key, emb in items.items():
+            self.put(key, emb)
+        self.maybe_flush()
+
+    def maybe_flush(self):
+        # Guardado periódico; también antes si se acumularon muchos slots expulsados (el archivo crece mientras tanto)
+        if self._dirty and (time.monotonic() - self._last_flush >= self.flush_interval_s
+                            or len(self._released) >= max(1, self.max_entries // 10)):
+            self.flush()
+
+    def flush(self):
+        # Persiste el índice (escritura atómica con archivo temporal)
+        with self._lock:
+            self._last_flush = time.monotonic()
+            if not self._dirty:
+                return
+            self._file.flush()
+            tmp_path = self.index_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({
+                    "dim": self.dim,
+                    "next_slot": self._next_slot,
+                    "entries": list(self._index.items()),
+                }, f)
+            os.replace(tmp_path, self.index_path)
+            self._dirty = False
+            # El índice guardado ya no referencia los slots expulsados: se pueden reutilizar
+            self._free_slots.extend(self._released)
+            self._released.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._index),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+# Instancia única de la caché (None si está deshabilitada o no se pudo crear)
+try:
+    embedding_cache = EmbeddingCache(
+        directory=EMBEDDING_CACHE_DIR,
+        model=EMBEDDING_MODEL,
+        dim=EMBEDDING_DIM,
+        max_entries=(EMBEDDING_CACHE_MAX_MB * 1024 * 1024) // (EMBEDDING_DIM * 4),
+    ) if EMBEDDING_CACHE_ENABLED else None
+except CacheLockedError as e:
+    print(f"{e} Se deshabilita la caché de embeddings en este proceso.")
+    embedding_cache = None
+except Exception as e:
+    print(f"Error al inicializar la caché de embeddings: {e}")
+    embedding_cache = None
+
+if embedding_cache:
+    atexit.register(embedding_cache.flush)
@@ -1,11 +1,21 @@
 import os
 import json
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from google import genai
 from google.genai import types
 from google.genai.errors import APIError
 
-from .config import GEMINI_API_KEY, EMBEDDING_MODEL, GENERATION_MODEL
-from .supabase import vector_search
+from .config import (
+    GEMINI_API_KEY, EMBEDDING_MODEL, GENERATION_MODEL,
+    EMBEDDING_BATCH_SIZE, EMBEDDING_CONCURRENCY,
+)
+from .embedding_cache import embedding_cache, content_hash
+from .query_cache import query_embedding_memo, normalize_query
+from .gemini_scheduler import gemini_scheduler
+from .text_processing import estimate_tokens
+from .metrics import trace, record_tokens
 
 # Inicialización del cliente de Gemini
 try:
@@ -14,18 +24,45 @@ except Exception as e:
     print(f"Error al inicializar el cliente Gemini: {e}")
     client = None
 
+def _record_usage(model: str, prompt_tokens: int, response=None, output_text: str | None = None):
+    # Tokens para /metrics: los que reporta Gemini (usage_metadata) o, si no vienen, la estimación local
+    usage = getattr(response, "usage_metadata", None)
+    prompt_tokens = getattr(usage, "prompt_token_count", None) or prompt_tokens
+    output_tokens = getattr(usage, "candidates_token_count", None)
+    if output_tokens is None and output_text is not None:
+        output_tokens = estimate_tokens(output_text)
+    record_tokens(model, prompt_tokens, output_tokens or 0)
+
 # Función para generar embeddings usando Gemini
-def get_embedding(text: str) -> list[float]:
+def get_embedding(text: str, chunk_hash: str | None = None, lane: str = "bulk", cache: bool = True) -> list[float]:
     #Genera el vector embedding (768 dimensiones) para el chunk de texto dado
     #Se usa el modelo text-embedding-004 de Gemini
+    #Si el texto ya está en la caché local (por su chunk_hash) no se llama a Gemini
+    #La llamada pasa por el planificador (límites RPM/TPM, reintentos) en el lane indicado
+    #cache=False: ni se lee ni se escribe la caché persistente (consultas, que viven en query_embedding_memo)
+    key = chunk_hash or content_hash(text)
+    if embedding_cache and cache:
+        cached = embedding_cache.get(key)
+        if cached is not None:
+            return cached
+
     if not client:
         raise ConnectionError("El cliente Gemini no está inicializado.")
     try:
-        response = client.models.embed_content(
-            model=EMBEDDING_MODEL,
-            contents=[text]
-        )
-        return list(response.embeddings[0].values)  # Retorna el primer (y único) embedding generado
+        with trace("gemini.embed"):
+            response = gemini_scheduler.call(
+                EMBEDDING_MODEL,
+                lambda: client.models.embed_content(
+                    model=EMBEDDING_MODEL,
+                    contents=[text]
+                ),
+                tokens=estimate_tokens(text), lane=lane
+            )
+        _record_usage(EMBEDDING_MODEL, estimate_tokens(text))
+        embedding = list(response.embeddings[0].values)  # El primer (y único) embedding generado
+        if embedding_cache and cache:
+            embedding_cache.put_many({key: embedding})
+        return embedding
     except APIError as e:
         print(f"Error en la API de gemini al generar embedding: {e}")
         return []
@@ -33,11 +70,109 @@ def get_embedding(text: str) -> list[float]:
         print(f"Error inesperado al generar embedding: {e}")
         return []
 
-def generate_flashcards(context: str, query: str = "Create study flashcards", num_flashcards: int = 6) -> dict:
-    #Llama al LLM (gemini-2.5-flash) para generar flashcards basadas en el contexto recuperado
+def get_query_embedding(query: str) -> list[float]:
+    # Embedding de una consulta de usuario, memorizado en memoria (LRU + TTL).
+    # Ráfagas de la misma consulta comparten una única llamada a Gemini.
+    # No pasa por la caché persistente de chunks: las consultas ad hoc desplazarían sus entradas
+    key = normalize_query(query)
+    return query_embedding_memo.get_or_compute(key, lambda: get_embedding(key, lane="interactive", cache=False))
+
+def get_embeddings_batch(texts: list[str]) -> list[list[float]]:
+    # Genera los embeddings de varios textos en UNA sola llamada a embed_content.
+    # A diferencia de get_embedding, aquí los errores se propagan: quien llama
+    # (el pipeline por lotes) necesita saber qué lote falló para reportarlo.
     if not client:
         raise ConnectionError("El cliente Gemini no está inicializado.")
-    
+    if not texts:
+        return []
+    tokens = sum(estimate_tokens(t) for t in texts)
+    with trace("gemini.embed_batch"):
+        response = gemini_scheduler.call(
+            EMBEDDING_MODEL,
+            lambda: client.models.embed_content(
+                model=EMBEDDING_MODEL,
+                contents=texts
+            ),
+            tokens=tokens, lane="bulk"
+        )
+    _record_usage(EMBEDDING_MODEL, tokens)
+    embeddings = [list(e.values) for e in response.embeddings]
+    if len(embeddings) != len(texts):
+        raise ValueError(f"Gemini devolvió {len(embeddings)} embeddings para {len(texts)} textos.")
+    return embeddings
+
+def embed_chunks_in_batches(
+    chunks: list[dict],
+    on_batch=None,
+    batch_size: int = EMBEDDING_BATCH_SIZE,
+    concurrency: int = EMBEDDING_CONCURRENCY,
+) -> dict:
+    """
+    Pipeline de embeddings por lotes para una lista de chunks ({'id', 'chunk_text', ...}).
+    Agrupa los textos en lotes de `batch_size` (una llamada a embed_content por lote)
+    y ejecuta como máximo `concurrency` lotes a la vez en un pool de hilos.
+
+    `on_batch(batch, embeddings)` se ejecuta dentro del mismo hilo cuando un lote
+    termina (p. ej. para hacer el upsert en Supabase), así la escritura de un lote
+    se solapa con el embedding de los demás.
+
+    Un lote fallido no detiene a los demás: se registra en 'failed_batches' y sus
+    chunks quedan sin embedding, por lo que basta con volver a llamar para reanudar.
+    """
+    batch_size = max(1, batch_size)
+    concurrency = max(1, concurrency)
+    batches = [chunks[i:i + batch_size] for i in range(0, len(chunks), batch_size)]
+
+    def _run_batch(batch: list[dict]) -> tuple[int, int]:
+        # Solo se envían a Gemini los chunks que no están en la caché local
+        keys = [ch.get("chunk_hash") or content_hash(ch["chunk_text"]) for ch in batch]
+        cached = embedding_cache.get_many(keys) if embedding_cache else {}
+        missing = [i for i, key in enumerate(keys) if key not in cached]
+
+        fresh = get_embeddings_batch([batch[i]["chunk_text"] for i in missing]) if missing else []
+        new_entries = {keys[i]: emb for i, emb in zip(missing, fresh)}
+        if embedding_cache and new_entries:
+            embedding_cache.put_many(new_entries)
+
+        embeddings = [cached.get(key) or new_entries[key] for key in keys]
+        if on_batch:
+            on_batch(batch, embeddings)
+        return len(batch), len(batch) - len(missing)
+
+    processed = 0
+    cache_hits = 0
+    failed_batches = []
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(_run_batch, batch): (i, batch) for i, batch in enumerate(batches)}
+        for future in as_completed(futures):
+            index, batch = futures[future]
+            try:
+                done, hits = future.result()
+                processed += done
+                cache_hits += hits
+            except Exception as e:
+                print(f"Error procesando el lote {index} de embeddings: {e}")
+                failed_batches.append({
+                    "batch": index,
+                    "chunk_ids": [ch.get("id") for ch in batch],
+                    "error": str(e),
+                })
+    elapsed = time.perf_counter() - start
+
+    return {
+        "processed": processed,
+        "cache_hits": cache_hits,
+        "failed": sum(len(b["chunk_ids"]) for b in failed_batches),
+        "failed_batches": sorted(failed_batches, key=lambda b: b["batch"]),
+        "batches": len(batches),
+        "elapsed_s": round(elapsed, 3),
+        "chunks_per_sec": round(processed / elapsed, 2) if elapsed > 0 else 0.0,
+    }
+
+def _flashcards_request(context: str, query: str, num_flashcards: int) -> tuple[str, types.GenerateContentConfig]:
+    # Prompt y configuración compartidos por generate_flashcards y stream_flashcards
+
     # Definición del Esquema JSON (Structured Output)
     # Esto garantiza que el modelo DEVUELVA un JSON parseable y con la estructura correcta.
     schema = types.Schema(
@@ -69,21 +204,35 @@ CONTEXTO:
 
 Devuelve SOLAMENTE el JSON válido con el formato solicitado.
 """
+    config = types.GenerateContentConfig(
+        # Forzamos la salida JSON
+        response_mime_type="application/json",
+        response_schema=schema,
+        temperature=0.2, # Baja temperatura para respuestas consistentes
+    )
+    return prompt, config
+
+def generate_flashcards(context: str, query: str = "Create study flashcards", num_flashcards: int = 6) -> dict:
+    #Llama al LLM (gemini-2.5-flash) para generar flashcards basadas en el contexto recuperado
+    if not client:
+        raise ConnectionError("El cliente Gemini no está inicializado.")
+    prompt, config = _flashcards_request(context, query, num_flashcards)
     
     # 3. Llamada a Gemini con JSON Mode
     try:
-        response = client.models.generate_content(
-            model=GENERATION_MODEL,
-            contents=[
-                {"role":"user", "parts":[{"text": prompt}]}
-            ],
-            config=types.GenerateContentConfig(
-                # Forzamos la salida JSON
-                response_mime_type="application/json",
-                response_schema=schema,
-                temperature=0.2, # Baja temperatura para respuestas consistentes
+        with trace("gemini.generate"):
+            response = gemini_scheduler.call(
+                GENERATION_MODEL,
+                lambda: client.models.generate_content(
+                    model=GENERATION_MODEL,
+                    contents=[
+                        {"role":"user", "parts":[{"text": prompt}]}
+                    ],
+                    config=config
+                ),
+                tokens=estimate_tokens(prompt), lane="interactive"
             )
-        )
+        _record_usage(GENERATION_MODEL, estimate_tokens(prompt), response, response.text)
         
         # El texto de la respuesta debería ser un JSON válido
         return json.loads(response.text)
@@ -98,15 +247,8 @@ Devuelve SOLAMENTE el JSON válido con el formato solicitado.
         raise Exception(f"Error inesperado durante la generación: {e}")
     
 
-def generate_feynman_feedback_from_context(context: str, topic: str, user_explanation: str) -> dict:
-    """
-    Genera feedback tipo Feynman a partir de un CONTEXTO ya recuperado.
-    Esta función asume que la recuperación (embeddings + vector search) se hizo
-    fuera de ella y únicamente se encarga de formular el prompt y llamar al LLM.
-    """
-    if not client:
-        raise ConnectionError("El cliente Gemini no está inicializado.")
-
+def _feynman_request(context: str, topic: str, user_explanation: str) -> tuple[str, types.GenerateContentConfig]:
+    # Prompt y configuración compartidos por la versión bloqueante y la de streaming del feedback Feynman
     system_prompt = (
         "Eres un tutor experto y amable especializado en la Técnica de Feynman. "
         "Tu tarea es evaluar la 'Explicación del Usuario' basándote en el 'Contexto del Documento'. "
@@ -128,23 +270,253 @@ def generate_feynman_feedback_from_context(context: str, topic: str, user_explan
     2. Señala y corrige cualquier imprecisión o error basándote estrictamente en el Contexto.
     3. Menciona un punto crucial del contexto que el usuario omitió (la 'laguna') para completar su entendimiento.
     """
+    config = types.GenerateContentConfig(
+        system_instruction=system_prompt,
+        temperature=0.3,
+    )
+    return feynman_prompt, config
+
+
+def generate_feynman_feedback_from_context(context: str, topic: str, user_explanation: str) -> dict:
+    """
+    Genera feedback tipo Feynman a partir de un CONTEXTO ya recuperado.
+    Esta función asume que la recuperación (embeddings + vector search) se hizo
+    fuera de ella y únicamente se encarga de formular el prompt y llamar al LLM.
+    """
+    if not client:
+        raise ConnectionError("El cliente Gemini no está inicializado.")
+
+    feynman_prompt, config = _feynman_request(context, topic, user_explanation)
+
+    try:
+        with trace("gemini.generate"):
+            response = gemini_scheduler.call(
+                GENERATION_MODEL,
+                lambda: client.models.generate_content(
+                    model=GENERATION_MODEL,
+                    contents=[
+                        {"role":"user", "parts":[{"text": feynman_prompt}]}
+                    ],
+                    config=config
+                ),
+                tokens=estimate_tokens(feynman_prompt), lane="interactive"
+            )
+        _record_usage(GENERATION_MODEL, estimate_tokens(feynman_prompt), response, response.text)
+
+        return {"feedback": response.text}
+
+    except APIError as e:
+        raise Exception(f"Error de API de Gemini al generar feedback: {e}")
+    except Exception as e:
+        raise Exception(f"Error inesperado durante la generación del feedback: {e}")
 
+
+def _stream_text(prompt: str, config: types.GenerateContentConfig):
+    # Genera los fragmentos de texto de la respuesta a medida que Gemini los produce
+    if not client:
+        raise ConnectionError("El cliente Gemini no está inicializado.")
+    parts = []
     try:
-        response = client.models.generate_content(
-            model=GENERATION_MODEL,
-            contents=[
-                {"role":"user", "parts":[{"text": feynman_prompt}]}
-            ],
-            config=types.GenerateContentConfig(
-                system_instruction=system_prompt,
-                temperature=0.3,
+        with trace("gemini.stream"):
+            for chunk in gemini_scheduler.stream(
+                GENERATION_MODEL,
+                lambda: client.models.generate_content_stream(
+                    model=GENERATION_MODEL,
+                    contents=[
+                        {"role":"user", "parts":[{"text": prompt}]}
+                    ],
+                    config=config
+                ),
+                tokens=estimate_tokens(prompt), lane="interactive"
+            ):
+                if chunk.text:
+                    parts.append(chunk.text)
+                    yield chunk.text
+        _record_usage(GENERATION_MODEL, estimate_tokens(prompt), output_text="".join(parts))
+    except APIError as e:
+        raise Exception(f"Error de API de Gemini durante el streaming: {e}")
+
+
+def stream_flashcards(context: str, query: str = "Create study flashcards", num_flashcards: int = 6):
+    # Versión en streaming de generate_flashcards: genera el JSON por fragmentos (ver api/streaming.py)
+    prompt, config = _flashcards_request(context, query, num_flashcards)
+    yield from _stream_text(prompt, config)
+
+
+def stream_feynman_feedback(context: str, topic: str, user_explanation: str):
+    # Versión en streaming de generate_feynman_feedback_from_context: genera el feedback por fragmentos
+    prompt, config = _feynman_request(context, topic, user_explanation)
+    yield from _stream_text(prompt, config)
+
+
+# --- Variantes async (cliente client.aio): el request path RAG no ocupa hilos mientras espera a Gemini ---
+
+async def aget_embedding(text: str, chunk_hash: str | None = None, lane: str = "interactive",
+                         cache: bool = True) -> list[float]:
+    # Igual que get_embedding, con la llamada a Gemini por el cliente async
+    key = chunk_hash or content_hash(text)
+    if embedding_cache and cache:
+        cached = embedding_cache.get(key)
+        if cached is not None:
+            return cached
+
+    if not client:
+        raise ConnectionError("El cliente Gemini no está inicializado.")
+    try:
+        with trace("gemini.embed"):
+            response = await gemini_scheduler.acall(
+                EMBEDDING_MODEL,
+                lambda: client.aio.models.embed_content(
+                    model=EMBEDDING_MODEL,
+                    contents=[text]
+                ),
+                tokens=estimate_tokens(text), lane=lane
             )
+        _record_usage(EMBEDDING_MODEL, estimate_tokens(text))
+        embedding = list(response.embeddings[0].values)
+        if embedding_cache and cache:
+            embedding_cache.put_many({key: embedding})
+        return embedding
+    except APIError as e:
+        print(f"Error en la API de gemini al generar embedding: {e}")
+        return []
+    except Exception as e:
+        print(f"Error inesperado al generar embedding: {e}")
+        return []
+
+async def aget_query_embedding(query: str) -> list[float]:
+    # Comparte el memo (y las peticiones en vuelo) con get_query_embedding; tampoco usa la caché de chunks
+    key = normalize_query(query)
+    return await query_embedding_memo.aget_or_compute(key, lambda: aget_embedding(key, cache=False))
+
+async def aget_embeddings_batch(texts: list[str], lane: str = "interactive") -> list[list[float]]:
+    # Variante async de get_embeddings_batch (varios textos en UNA llamada); los errores se propagan
+    if not client:
+        raise ConnectionError("El cliente Gemini no está inicializado.")
+    if not texts:
+        return []
+    tokens = sum(estimate_tokens(t) for t in texts)
+    with trace("gemini.embed_batch"):
+        response = await gemini_scheduler.acall(
+            EMBEDDING_MODEL,
+            lambda: client.aio.models.embed_content(
+                model=EMBEDDING_MODEL,
+                contents=texts
+            ),
+            tokens=tokens, lane=lane
         )
+    _record_usage(EMBEDDING_MODEL, tokens)
+    embeddings = [list(e.values) for e in response.embeddings]
+    if len(embeddings) != len(texts):
+        raise ValueError(f"Gemini devolvió {len(embeddings)} embeddings para {len(texts)} textos.")
+    return embeddings
+
+async def aget_query_embeddings(queries: list[str]) -> list[list[float]]:
+    # Embeddings de varias consultas (p. ej. el endpoint por lotes) con el mismo memo que
+    # aget_query_embedding: las que faltan se piden juntas, una llamada a embed_content por
+    # cada EMBEDDING_BATCH_SIZE textos. Si una llamada falla, sus consultas quedan con [].
+    # Como aget_query_embedding, no pasa por la caché persistente de chunks
+    keys = [normalize_query(q) for q in queries]
 
+    async def _embed(batch: list[str]) -> list[list[float]]:
+        try:
+            return await aget_embeddings_batch(batch)
+        except Exception as e:
+            print(f"Error al generar los embeddings de {len(batch)} consultas: {e}")
+            return [[] for _ in batch]
+
+    async def _compute(missing: list[str]) -> list[list[float]]:
+        values = {}
+        batches = [missing[i:i + EMBEDDING_BATCH_SIZE] for i in range(0, len(missing), EMBEDDING_BATCH_SIZE)]
+        for batch, embeddings in zip(batches, await asyncio.gather(*[_embed(b) for b in batches])):
+            values.update(zip(batch, embeddings))
+        return [values[key] for key in missing]
+
+    return await query_embedding_memo.aget_or_compute_many(keys, _compute)
+
+async def agenerate_flashcards(context: str, query: str = "Create study flashcards", num_flashcards: int = 6) -> dict:
+    if not client:
+        raise ConnectionError("El cliente Gemini no está inicializado.")
+    prompt, config = _flashcards_request(context, query, num_flashcards)
+    try:
+        with trace("gemini.generate"):
+            response = await gemini_scheduler.acall(
+                GENERATION_MODEL,
+                lambda: client.aio.models.generate_content(
+                    model=GENERATION_MODEL,
+                    contents=[
+                        {"role":"user", "parts":[{"text": prompt}]}
+                    ],
+                    config=config
+                ),
+                tokens=estimate_tokens(prompt), lane="interactive"
+            )
+        _record_usage(GENERATION_MODEL, estimate_tokens(prompt), response, response.text)
+        return json.loads(response.text)
+
+    except APIError as e:
+        raise Exception(f"Error de API de Gemini al generar flashcards: {e}")
+    except json.JSONDecodeError:
+        print(f"El modelo devolvió un JSON inválido: {response.text}")
+        raise Exception("Fallo al generar flashcards: El modelo devolvió JSON no parseable.")
+    except Exception as e:
+        raise Exception(f"Error inesperado durante la generación: {e}")
+
+async def agenerate_feynman_feedback_from_context(context: str, topic: str, user_explanation: str) -> dict:
+    if not client:
+        raise ConnectionError("El cliente Gemini no está inicializado.")
+    feynman_prompt, config = _feynman_request(context, topic, user_explanation)
+    try:
+        with trace("gemini.generate"):
+            response = await gemini_scheduler.acall(
+                GENERATION_MODEL,
+                lambda: client.aio.models.generate_content(
+                    model=GENERATION_MODEL,
+                    contents=[
+                        {"role":"user", "parts":[{"text": feynman_prompt}]}
+                    ],
+                    config=config
+                ),
+                tokens=estimate_tokens(feynman_prompt), lane="interactive"
+            )
+        _record_usage(GENERATION_MODEL, estimate_tokens(feynman_prompt), response, response.text)
         return {"feedback": response.text}
 
     except APIError as e:
         raise Exception(f"Error de API de Gemini al generar feedback: {e}")
     except Exception as e:
         raise Exception(f"Error inesperado durante la generación del feedback: {e}")
-    
+
+async def _astream_text(prompt: str, config: types.GenerateContentConfig):
+    if not client:
+        raise ConnectionError("El cliente Gemini no está inicializado.")
+    parts = []
+    try:
+        with trace("gemini.stream"):
+            async for chunk in gemini_scheduler.astream(
+                GENERATION_MODEL,
+                lambda: client.aio.models.generate_content_stream(
+                    model=GENERATION_MODEL,
+                    contents=[
+                        {"role":"user", "parts":[{"text": prompt}]}
+                    ],
+                    config=config
+                ),
+                tokens=estimate_tokens(prompt), lane="interactive"
+            ):
+                if chunk.text:
+                    parts.append(chunk.text)
+                    yield chunk.text
+        _record_usage(GENERATION_MODEL, estimate_tokens(prompt), output_text="".join(parts))
+    except APIError as e:
+        raise Exception(f"Error de API de Gemini durante el streaming: {e}")
+
+async def astream_flashcards(context: str, query: str = "Create study flashcards", num_flashcards: int = 6):
+    prompt, config = _flashcards_request(context, query, num_flashcards)
+    async for text in _astream_text(prompt, config):
+        yield text
+
+async def astream_feynman_feedback(context: str, topic: str, user_explanation: str):
+    prompt, config = _feynman_request(context, topic, user_explanation)
+    async for text in _astream_text(prompt, config):
+        yield text
@@ -0,0 +1,352 @@
+import time
+import heapq
+import random
+import asyncio
+import threading
+import itertools
+from collections import deque
+
+import httpx
+from google.genai.errors import APIError
+
+from .config import (
+    GEMINI_SCHEDULER_ENABLED, GEMINI_RPM_LIMITS, GEMINI_TPM_LIMITS, GEMINI_DEFAULT_RPM, GEMINI_DEFAULT_TPM,
+    GEMINI_MAX_RETRIES, GEMINI_BACKOFF_BASE_S, GEMINI_BACKOFF_MAX_S, GEMINI_PROJECT_RPM, GEMINI_PROJECT_TPM,
+)
+
+# Lanes de prioridad: las llamadas interactivas (flashcards, Feynman, consultas) se
+# despachan antes que las de los trabajos masivos (embeddings de ingesta), de cualquier modelo.
+LANES = {"interactive": 0, "bulk": 1}
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
+def is_retryable(error: BaseException) -> bool:
+    # 429 (cuota) y errores transitorios del servidor o de red se reintentan; el resto no
+    if isinstance(error, APIError):
+        return error.code in RETRYABLE_STATUS
+    return isinstance(error, (httpx.TransportError, ConnectionError, TimeoutError))
+
+
+class TokenBucket:
+    """
+    Balde de tokens: se rellena a `rate` por segundo hasta `capacity`. `rate` 0 = sin límite.
+
+    Una petición mayor que la capacidad (un lote de embeddings de decenas de miles de tokens)
+    espera a que el balde esté lleno y se cobra completa: el balde queda en deuda (tokens < 0)
+    y las siguientes esperan a que se pague, así el ritmo medio nunca pasa de `rate`.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        if rate < 0:
+            raise ValueError(f"TokenBucket: rate debe ser >= 0 (0 = sin límite), no {rate}.")
+        self.rate = rate
+        self.unlimited = rate == 0
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        if self.unlimited:
+            return 0.0
+        self._refill(now)
+        # Se espera a tener `amount` tokens, o el balde lleno si no caben (y a saldar la deuda)
+        missing = min(amount, self.capacity) - self.tokens
+        return missing / self.rate if missing > 0 else 0.0
+
+    def take(self, amount: float):
+        if not self.unlimited:
+            self.tokens -= amount
+
+    def drain(self):
+        # Tras un 429 el proveedor nos dice que vamos demasiado rápido: se vacía el balde
+        self.tokens = min(self.tokens, 0.0)
+
+
+class _Waiter:
+    __slots__ = ("priority", "seq", "lane", "tokens", "enqueued_at", "notify", "cancelled")
+
+    def __init__(self, priority, seq, lane, tokens, notify):
+        self.priority = priority
+        self.seq = seq
+        self.lane = lane
+        self.tokens = tokens
+        self.enqueued_at = time.monotonic()
+        self.notify = notify
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class _LaneStats:
+    def __init__(self):
+        self.queued = 0
+        self.granted = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.failures = 0
+        self.waits = deque(maxlen=1000)  # segundos de espera en cola de las últimas llamadas
+
+    def snapshot(self) -> dict:
+        waits = sorted(self.waits)
+
+        def _pct(p):
+            return round(waits[min(len(waits) - 1, int(p * len(waits)))], 4) if waits else 0.0
+
+        return {
+            "queue_depth": self.queued,
+            "granted": self.granted,
+            "retries": self.retries,
+            "rate_limited": self.rate_limited,
+            "failures": self.failures,
+            "wait_s_p50": _pct(0.5),
+            "wait_s_p95": _pct(0.95),
+            "wait_s_max": round(waits[-1], 4) if waits else 0.0,
+        }
+
+
+class GeminiScheduler:
+    """
+    Planificador delante del cliente compartido de Gemini.
+
+    - Límites por modelo: un balde de peticiones (RPM) y otro de tokens (TPM), más un par
+      de baldes del proyecto (project_rpm / project_tpm) que consumen todos los modelos,
+      como la cuota del proyecto de Gemini. Un límite 0 es sin límite.
+    - Prioridad estricta por lane entre todos los modelos: las llamadas se consideran en
+      orden (lane, llegada); si una interactiva espera por la cuota del proyecto, ninguna
+      bulk (de ningún modelo) la consume antes. Si lo que falta es la cuota de su propio
+      modelo, las de otros modelos siguen pasando (no compiten por ese balde).
+    - Reintentos con backoff exponencial con jitter completo ante 429/5xx/errores de red;
+      un 429 además vacía el balde RPM del modelo (y el del proyecto, si tiene límite)
+      para frenar al resto de llamadas.
+    - Sirve a hilos (call) y a corrutinas (acall): un único hilo despachador concede los
+      permisos y despierta al que espera (Event o Future del event loop).
+    """
+
+    def __init__(self, rpm_limits: dict, tpm_limits: dict, default_rpm: int, default_tpm: int,
+                 max_retries: int, backoff_base_s: float, backoff_max_s: float, enabled: bool = True,
+                 project_rpm: int = 0, project_tpm: int = 0):
+        # Se validan al crear el planificador: un límite negativo en la config falla al arrancar,
+        # no dentro del hilo despachador al primer uso del modelo
+        limits = [default_rpm, default_tpm, *rpm_limits.values(), *tpm_limits.values()]
+        if any(limit < 0 for limit in limits):
+            raise ValueError("Los límites RPM/TPM de Gemini no pueden ser negativos (0 = sin límite).")
+        self.rpm_limits = rpm_limits
+        self.tpm_limits = tpm_limits
+        self.default_rpm = default_rpm
+        self.default_tpm = default_tpm
+        self.max_retries = max(0, max_retries)
+        self.backoff_base_s = backoff_base_s
+        self.backoff_max_s = backoff_max_s
+        self.enabled = enabled
+
+        self._cond = threading.Condition()
+        self._buckets: dict[str, tuple[TokenBucket, TokenBucket]] = {}
+        self._project = (TokenBucket(project_rpm / 60, project_rpm / 60), TokenBucket(project_tpm / 60, project_tpm / 60))
+        self._queues: dict[str, list[_Waiter]] = {}
+        self._seq = itertools.count()
+        self._stats = {lane: _LaneStats() for lane in LANES}
+        self._thread = None
+
+    # --- Permisos ---
+
+    def _bucket_pair(self, model: str) -> tuple[TokenBucket, TokenBucket]:
+        pair = self._buckets.get(model)
+        if pair is None:
+            rpm = self.rpm_limits.get(model, self.default_rpm)
+            tpm = self.tpm_limits.get(model, self.default_tpm)
+            # Capacidad de un segundo y cobro completo (con deuda): el ritmo sostenido no pasa del límite
+            # por minuto; en una ventana concreta puede sumarse como mucho una petición más
+            pair = (TokenBucket(rpm / 60, rpm / 60), TokenBucket(tpm / 60, tpm / 60))
+            self._buckets[model] = pair
+        return pair
+
+    def _enqueue(self, model: str, tokens: int, lane: str, notify) -> _Waiter:
+        waiter = _Waiter(LANES[lane], next(self._seq), lane, max(1, tokens), notify)
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._dispatch_loop, name="gemini-scheduler", daemon=True)
+                self._thread.start()
+            heapq.heappush(self._queues.setdefault(model, []), waiter)
+            self._stats[lane].queued += 1
+            self._cond.notify()
+        return waiter
+
+    def _head(self, queue: list[_Waiter]) -> _Waiter | None:
+        # Primera llamada viva de la cola de un modelo (descarta las canceladas)
+        while queue and queue[0].cancelled:
+            self._stats[heapq.heappop(queue).lane].queued -= 1
+        return queue[0] if queue else None
+
+    def _dispatch_loop(self):
+        project_requests, project_tokens = self._project
+        with self._cond:
+            while True:
+                timeout = None
+                now = time.monotonic()
+                # Cabezas de todas las colas en un único heap: el orden (lane, llegada) es global,
+                # así una interactiva de generación va antes que los embeddings bulk ya encolados
+                heads = []
+                for model, queue in self._queues.items():
+                    waiter = self._head(queue)
+                    if waiter is not None:
+                        heads.append((waiter, model))
+                heapq.heapify(heads)
+                while heads:
+                    waiter, model = heapq.heappop(heads)
+                    requests_bucket, tokens_bucket = self._bucket_pair(model)
+                    project_wait = max(project_requests.wait_time(1, now), project_tokens.wait_time(waiter.tokens, now))
+                    if project_wait > 0:
+                        # Sin cuota del proyecto nadie de menor prioridad (ni posterior) pasa delante
+                        timeout = project_wait if timeout is None else min(timeout, project_wait)
+                        break
+                    wait = max(requests_bucket.wait_time(1, now), tokens_bucket.wait_time(waiter.tokens, now))
+                    if wait > 0:
+                        # Solo se bloquea este modelo: los demás no compiten por sus baldes
+                        timeout = wait if timeout is None else min(timeout, wait)
+                        continue
+                    queue = self._queues[model]
+                    heapq.heappop(queue)
+                    for bucket, amount in ((requests_bucket, 1), (tokens_bucket, waiter.tokens),
+                                           (project_requests, 1), (project_tokens, waiter.tokens)):
+                        bucket.take(amount)
+                    stats = self._stats[waiter.lane]
+                    stats.queued -= 1
+                    stats.granted += 1
+                    stats.waits.append(now - waiter.enqueued_at)
+                    try:
+                        waiter.notify()
+                    except RuntimeError:
+                        pass  # el event loop del que esperaba ya se cerró
+                    following = self._head(queue)
+                    if following is not None:
+                        heapq.heappush(heads, (following, model))
+                self._cond.wait(timeout)
+
+    def acquire(self, model: str, tokens: int = 1, lane: str = "bulk"):
+        # Bloquea el hilo actual hasta que el modelo tenga cupo para esta llamada
+        granted = threading.Event()
+        self._enqueue(model, tokens, lane, granted.set)
+        granted.wait()
+
+    async def aacquire(self, model: str, tokens: int = 1, lane: str = "interactive"):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def _notify():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        waiter = self._enqueue(model, tokens, lane, _notify)
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self._cond:
+                waiter.cancelled = True
+                self._cond.notify()
+            raise
+
+    def penalize(self, model: str):
+        # El 429 puede venir de la cuota del modelo o de la del proyecto: se frenan ambos
+        # (drain no hace nada en un balde sin límite)
+        with self._cond:
+            self._bucket_pair(model)[0].drain()
+            self._project[0].drain()
+
+    # --- Llamadas con reintentos ---
+
+    def backoff_delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.backoff_max_s, self.backoff_base_s * (2 ** attempt)))
+
+    def _on_error(self, model: str, lane: str, error: BaseException, attempt: int) -> bool:
+        # Registra el error y decide si se reintenta
+        stats = self._stats[lane]
+        if isinstance(error, APIError) and error.code == 429:
+            stats.rate_limited += 1
+            self.penalize(model)
+        if attempt < self.max_retries and is_retryable(error):
+            stats.retries += 1
+            return True
+        stats.failures += 1
+        return False
+
+    def call(self, model: str, fn, tokens: int = 1, lane: str = "bulk"):
+        """Ejecuta fn() respetando los límites del modelo y reintentando errores transitorios."""
+        if not self.enabled:
+            return fn()
+        for attempt in itertools.count():
+            self.acquire(model, tokens, lane)
+            try:
+                return fn()
+            except Exception as e:
+                if not self._on_error(model, lane, e, attempt):
+                    raise
+            time.sleep(self.backoff_delay(attempt))
+
+    async def acall(self, model: str, fn, tokens: int = 1, lane: str = "interactive"):
+        """Variante async de call: fn() devuelve una corrutina nueva en cada intento."""
+        if not self.enabled:
+            return await fn()
+        for attempt in itertools.count():
+            await self.aacquire(model, tokens, lane)
+            try:
+                return await fn()
+            except Exception as e:
+                if not self._on_error(model, lane, e, attempt):
+                    raise
+            await asyncio.sleep(self.backoff_delay(attempt))
+
+    def stream(self, model: str, fn, tokens: int = 1, lane: str = "interactive"):
+        """
+        Como call, para respuestas en streaming: fn() devuelve un iterador nuevo en cada intento.
+        Solo se reintenta si el error llega antes del primer elemento (lo ya entregado no se repite).
+        """
+        for attempt in itertools.count():
+            if self.enabled:
+                self.acquire(model, tokens, lane)
+            started = False
+            try:
+                for item in fn():
+                    started = True
+                    yield item
+                return
+            except Exception as e:
+                if started or not self.enabled or not self._on_error(model, lane, e, attempt):
+                    raise
+            time.sleep(self.backoff_delay(attempt))
+
+    async def astream(self, model: str, fn, tokens: int = 1, lane: str = "interactive"):
+        # Variante async de stream: fn() devuelve un awaitable que resuelve a un iterador async
+        for attempt in itertools.count():
+            if self.enabled:
+                await self.aacquire(model, tokens, lane)
+            started = False
+            try:
+                async for item in await fn():
+                    started = True
+                    yield item
+                return
+            except Exception as e:
+                if started or not self.enabled or not self._on_error(model, lane, e, attempt):
+                    raise
+            await asyncio.sleep(self.backoff_delay(attempt))
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "enabled": self.enabled,
+                "lanes": {lane: stats.snapshot() for lane, stats in self._stats.items()},
+                "queue_depth_by_model": {model: len(queue) for model, queue in self._queues.items()},
+                "project_limits": {"rpm": round(self._project[0].rate * 60), "tpm": round(self._project[1].rate * 60)},
+            }
+
+
+# Instancia única compartida por todas las llamadas a Gemini (ver api/gemini.py)
+gemini_scheduler = GeminiScheduler(
+    GEMINI_RPM_LIMITS, GEMINI_TPM_LIMITS, GEMINI_DEFAULT_RPM, GEMINI_DEFAULT_TPM,
+    GEMINI_MAX_RETRIES, GEMINI_BACKOFF_BASE_S, GEMINI_BACKOFF_MAX_S, enabled=GEMINI_SCHEDULER_ENABLED,
+    project_rpm=GEMINI_PROJECT_RPM, project_tpm=GEMINI_PROJECT_TPM,
+)
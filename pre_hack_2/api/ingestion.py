@@ -0,0 +1,392 @@
+import io
+import queue
+import hashlib
+import itertools
+import threading
+from collections import defaultdict, Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from .config import (
+    INGEST_BATCH_SIZE, INGEST_STORE_RAW_TEXT, INGEST_PREFETCH_BATCHES, DEDUP_UPLOADS,
+    EMBEDDING_BATCH_SIZE, EMBEDDING_CONCURRENCY, ANN_INDEX_PATH,
+)
+from .supabase import (
+    insert_material, insert_chunks, upload_pdf_to_storage, update_material_raw_text,
+    get_chunks_without_embeddings, upsert_chunk_embeddings, get_material_owner,
+    get_chunk_hashes, delete_chunks, update_material, find_material_by_content_hash,
+    set_material_content_hash, clone_chunks, get_chunks_for_clone, get_material_page_count, get_chunk_embeddings, get_raw_text, is_pdf_shared,
+)
+from .gemini import embed_chunks_in_batches
+from .pypdf_utils import iter_pages
+from .text_processing import chunk_pages, iter_batches, estimate_tokens
+from .vector_index import local_index
+from .lexical_index import lexical_index
+from .ann_index import ann_index
+from .response_cache import flashcards_cache
+
+# Servicios de ingesta compartidos por las rutas (upload_pdf, create_embeddings)
+# y por los jobs en segundo plano (api/jobs.py). Todo aquí es bloqueante:
+# quien llama desde un async def debe usar run_in_threadpool.
+
+
+class Prefetch:
+    """
+    Ejecuta un iterador bloqueante en un hilo propio y entrega sus elementos
+    a través de una cola acotada (como máximo `max_items` por adelantado).
+    Permite que la extracción del PDF avance mientras el hilo consumidor
+    espera a Supabase, sin perder el límite de memoria.
+    """
+    _DONE = object()
+
+    def __init__(self, iterator, max_items: int):
+        self._queue = queue.Queue(maxsize=max(1, max_items))
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(iterator,), daemon=True)
+        self._thread.start()
+
+    def _put(self, item) -> bool:
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self, iterator):
+        try:
+            for item in iterator:
+                if not self._put(item):
+                    return
+        except BaseException as e:
+            self._put(e)
+            return
+        self._put(self._DONE)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = self._queue.get()
+        if item is self._DONE:
+            self._queue.put(item)  # próximas llamadas también terminan
+            raise StopIteration
+        if isinstance(item, BaseException):
+            raise item
+        return item
+
+    def close(self):
+        self._stop.set()
+
+
+def chunk_rows(batch: list[dict]) -> list[dict]:
+    # Convierte un lote de chunks de iter_chunks en filas para material_chunks
+    rows = []
+    for c in batch:
+        chunk_hash = hashlib.sha256(c["chunk_text"].encode('utf-8')).hexdigest()
+        # NOTA: Por ahora, solo insertamos texto y hash. Los embeddings se crean en /create_embeddings.
+        rows.append({
+            "chunk_text": c["chunk_text"],
+            "chunk_hash": chunk_hash,
+            # Tokens estimados (el chunker "tokens" ya los trae calculados)
+            "token_count": c.get("token_count") or estimate_tokens(c["chunk_text"]),
+            "page_start": c["page_start"],
+            "page_end": c["page_end"],
+        })
+    return rows
+
+
+def drop_written_rows(rows: list[dict], written: Counter) -> list[dict]:
+    # Quita de rows las filas ya escritas según el conteo por chunk_hash `written` (que se va consumiendo)
+    kept = []
+    for row in rows:
+        if written[row["chunk_hash"]] > 0:
+            written[row["chunk_hash"]] -= 1
+        else:
+            kept.append(row)
+    return kept
+
+
+def lexical_indexer(material_id: int):
+    # on_written para insert_chunks: mantiene al día el índice BM25 con los ids que devolvió Supabase
+    def _on_written(rows: list[dict], ids: list | None):
+        if ids is None:
+            # Lote confirmado por chunk_hash (sin ids): el índice se recarga entero en la próxima búsqueda
+            lexical_index.invalidate(material_id)
+            return
+        lexical_index.add(material_id, [{"id": chunk_id, "chunk_text": row["chunk_text"], "page_start": row.get("page_start")}
+                                        for row, chunk_id in zip(rows, ids)])
+    return _on_written
+
+
+def clone_material(source: dict, user_id: str, title: str, content_hash: str, on_progress=None) -> dict:
+    """
+    Crea un material nuevo para user_id a partir de uno ya ingerido con el mismo PDF:
+    reutiliza su archivo en Storage y copia sus chunks con sus embeddings, sin extraer,
+    trocear ni llamar a Gemini. La copia se hace en Postgres (RPC clone_material_chunks);
+    si el RPC no está instalado, se leen los chunks y se insertan desde aquí.
+    Retorna lo mismo que ingest_pdf más 'deduplicated_from'.
+    """
+    on_progress = on_progress or (lambda **fields: None)
+    raw_text = (get_raw_text(source["id"]) or "") if INGEST_STORE_RAW_TEXT else ""
+    material_id = insert_material(user_id, title, source["pdf_url"], raw_text)
+    if not material_id:
+        raise Exception("Fallo al insertar el registro del material.")
+    on_progress(material_id=material_id)
+
+    count = clone_chunks(source["id"], material_id)
+    if count is None:
+        rows = get_chunks_for_clone(source["id"])
+        lexical_index.create(material_id)
+        count = insert_chunks(material_id, rows, Counter(), lexical_indexer(material_id))
+        if count < len(rows):
+            raise Exception(f"Fallo al copiar los chunks: {len(rows) - count} sin escribir.")
+        pages_count = max((row["page_end"] or 0 for row in rows), default=0)
+    else:
+        pages_count = get_material_page_count(material_id)
+    on_progress(chunks_inserted=count, pages_done=pages_count)
+
+    # Los chunks copiados ya traen embedding: se añaden al índice ANN (el local se carga al buscar)
+    if ann_index is not None:
+        embedded = get_chunk_embeddings(material_id)
+        if embedded:
+            ann_index.add([row["id"] for row in embedded], [row["embedding"] for row in embedded], material_id, user_id)
+
+    set_material_content_hash(material_id, content_hash)
+    return {"material_id": material_id, "chunks_count": count, "pages_count": pages_count,
+            "deduplicated_from": source["id"]}
+
+
+def ingest_pdf(content: bytes, user_id: str, title: str, file_name: str,
+               material_id: int | None = None, skip_batches: int = 0, on_progress=None) -> dict:
+    """
+    Sube el PDF a Storage, extrae y trocea el texto por streaming e inserta los chunks por lotes.
+    La subida a Storage y la extracción son independientes y corren a la vez.
+
+    Para reanudar una ingesta interrumpida se pasa el material_id ya creado y
+    cuántos lotes se insertaron (skip_batches): el chunking es determinista, así que
+    esos lotes se regeneran y se descartan sin volver a insertarlos.
+
+    on_progress(**campos) recibe material_id, batches_done, chunks_inserted y pages_done.
+    Lanza ValueError si el PDF no tiene suficiente texto.
+    """
+    on_progress = on_progress or (lambda **fields: None)
+
+    # Un PDF idéntico ya ingerido (de cualquier usuario) se clona en milisegundos
+    content_hash = hashlib.sha256(content).hexdigest()
+    if material_id is None and DEDUP_UPLOADS:
+        source = find_material_by_content_hash(content_hash)
+        if source is not None:
+            return clone_material(source, user_id, title, content_hash, on_progress)
+
+    # Extraer texto página a página (solo se acumula si se pide guardar raw_text)
+    raw_pages = []
+    def _pages():
+        for page_number, text in iter_pages(content):
+            if INGEST_STORE_RAW_TEXT:
+                raw_pages.append(text)
+            yield page_number, text
+
+    # Chunking incremental en un hilo propio: empieza ya, en paralelo con la subida a Storage
+    batches = Prefetch(iter_batches(chunk_pages(_pages()), INGEST_BATCH_SIZE), INGEST_PREFETCH_BATCHES)
+    try:
+        if material_id is None:
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                storage = executor.submit(upload_pdf_to_storage, user_id, file_name, io.BytesIO(content))
+                first_batch = next(batches, [])
+                public_url = storage.result()
+            if not public_url:
+                raise Exception("Fallo al subir el archivo a Supabase Storage.")
+
+            if sum(len(c["chunk_text"]) for c in first_batch) < 100:
+                raise ValueError("El PDF no contiene suficiente texto extraíble.")
+
+            # Inserta registro de material (obtenemos el material_id)
+            material_id = insert_material(user_id, title, public_url, "")
+            if not material_id:
+                raise Exception("Fallo al insertar el registro del material.")
+            on_progress(material_id=material_id)
+            # El índice léxico del material nuevo se arma a medida que se escriben sus chunks
+            lexical_index.create(material_id)
+            all_batches = itertools.chain([first_batch], batches)
+            existing = Counter()
+            resuming = False
+        else:
+            all_batches = batches
+            existing = Counter(row["chunk_hash"] for row in get_chunk_hashes(material_id))
+            resuming = True
+
+        # Insertar chunks lote a lote (la extracción sigue adelantando lotes mientras tanto).
+        # `existing` lleva el conteo por chunk_hash de lo ya escrito para que los reintentos sean idempotentes
+        on_written = lexical_indexer(material_id)
+        count = 0
+        pages_count = 0
+        skipped = Counter()
+        already_written = None
+        for index, batch in enumerate(all_batches):
+            pages_count = max(pages_count, batch[-1]["page_end"])
+            rows = chunk_rows(batch)
+            if index < skip_batches:
+                skipped.update(row["chunk_hash"] for row in rows)
+                continue
+            if resuming:
+                # Lo interrumpido pudo quedar escrito en parte (un lote se escribe en varios INSERT)
+                if already_written is None:
+                    already_written = existing - skipped
+                rows = drop_written_rows(rows, already_written)
+            count += insert_chunks(material_id, rows, existing, on_written)
+            on_progress(batches_done=index + 1, chunks_inserted=count, pages_done=pages_count)
+
+        if INGEST_STORE_RAW_TEXT:
+            update_material_raw_text(material_id, "\n".join(raw_pages))
+    finally:
+        batches.close()
+
+    # Solo ahora el material puede servir de origen para uploads duplicados
+    set_material_content_hash(material_id, content_hash)
+
+    return {"material_id": material_id, "chunks_count": count, "pages_count": pages_count}
+
+
+def _upload_replacement(material_id: int, owner_id: str, file_name: str, content: bytes, content_hash: str):
+    # Si el PDF actual lo comparten otros materiales (uploads deduplicados) no se sobrescribe:
+    # la versión nueva va a una ruta propia
+    if DEDUP_UPLOADS and is_pdf_shared(material_id):
+        file_name = f"{content_hash[:16]}-{file_name}"
+    return upload_pdf_to_storage(owner_id, file_name, io.BytesIO(content), True)
+
+
+def _discard_new_chunks(material_id: int, old_ids: set):
+    # Deshace un reemplazo interrumpido: borra los chunks insertados que no estaban antes
+    try:
+        added = [row["id"] for row in get_chunk_hashes(material_id) if row["id"] not in old_ids]
+        if added:
+            delete_chunks(added)
+    except Exception as e:
+        print(f"Error al deshacer el reemplazo del material {material_id}: {e}")
+    lexical_index.invalidate(material_id)
+
+
+def replace_material_pdf(material_id: int, content: bytes, file_name: str) -> dict:
+    """
+    Reemplaza el PDF de un material por una versión revisada sin re-ingestar todo.
+    Se comparan los multiconjuntos de chunk_hash viejo/nuevo:
+    - chunks que siguen existiendo: se conservan (con su embedding),
+    - chunks nuevos: se insertan sin embedding (luego embed_material solo procesa estos),
+    - chunks que desaparecieron: se borran.
+    Con el chunker "cdc" (CHUNKER=cdc) una edición pequeña solo cambia los chunks cercanos,
+    así que el trabajo es O(edición) en lugar de O(documento); con "fixed" una inserción
+    desplaza las ventanas siguientes y se re-insertan los chunks desde la edición.
+    El texto se valida antes de escribir nada y el PDF nuevo se sube al final: si la inserción
+    falla, los chunks ya insertados se borran y el material queda como estaba.
+    Lanza LookupError si el material no existe y ValueError si el PDF no tiene texto.
+    """
+    owner_id = get_material_owner(material_id)
+    if owner_id is None:
+        raise LookupError("Material no encontrado.")
+    content_hash = hashlib.sha256(content).hexdigest()
+
+    batches = Prefetch(iter_batches(chunk_pages(iter_pages(content)), INGEST_BATCH_SIZE), INGEST_PREFETCH_BATCHES)
+    try:
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            # La lectura de los hashes actuales corre mientras se extrae el texto
+            current = executor.submit(get_chunk_hashes, material_id)
+            # Como en ingest_pdf, el texto se valida antes de escribir nada: un PDF sin texto
+            # no debe tocar ni el archivo en Storage ni los chunks del material
+            first_batches = []
+            total_chars = 0
+            for batch in batches:
+                first_batches.append(batch)
+                total_chars += sum(len(c["chunk_text"]) for c in batch)
+                if total_chars >= 100:
+                    break
+            if total_chars < 100:
+                raise ValueError("El PDF no contiene suficiente texto extraíble.")
+            old_rows = current.result()
+
+        old_ids_by_hash = defaultdict(list)
+        for row in old_rows:
+            old_ids_by_hash[row["chunk_hash"]].append(row["id"])
+        existing = Counter({chunk_hash: len(ids) for chunk_hash, ids in old_ids_by_hash.items()})
+
+        kept = 0
+        inserted = 0
+        try:
+            for batch in itertools.chain(first_batches, batches):
+                new_rows = []
+                for row in chunk_rows(batch):
+                    ids = old_ids_by_hash.get(row["chunk_hash"])
+                    if ids:
+                        ids.pop()
+                        kept += 1
+                    else:
+                        new_rows.append(row)
+                if new_rows:
+                    inserted += insert_chunks(material_id, new_rows, existing, lexical_indexer(material_id))
+        except Exception:
+            _discard_new_chunks(material_id, {row["id"] for row in old_rows})
+            raise
+    finally:
+        batches.close()
+
+    # El PDF se sube solo cuando los chunks nuevos ya están escritos: si algo falla antes,
+    # el material conserva su archivo y sus chunks anteriores
+    public_url = _upload_replacement(material_id, owner_id, file_name, content, content_hash)
+
+    # Lo que quedó sin emparejar ya no existe en la versión nueva
+    removed_ids = [chunk_id for ids in old_ids_by_hash.values() for chunk_id in ids]
+    deleted = delete_chunks(removed_ids) if removed_ids else 0
+    if public_url:
+        update_material(material_id, {"pdf_url": public_url})
+    set_material_content_hash(material_id, content_hash)
+
+    # Índices: el local se reconstruye en la próxima búsqueda; del léxico y del ANN se quitan los borrados
+    if removed_ids:
+        local_index.invalidate(material_id)
+        lexical_index.remove(material_id, removed_ids)
+        if ann_index is not None:
+            ann_index.remove(removed_ids)
+
+    return {"material_id": material_id, "kept": kept, "inserted": inserted, "deleted": deleted}
+
+
+def embed_material(material_id: int, batch_size: int = EMBEDDING_BATCH_SIZE,
+                   concurrency: int = EMBEDDING_CONCURRENCY, on_progress=None) -> dict | None:
+    """
+    Genera y guarda los embeddings de los chunks de un material que aún no los tienen,
+    y actualiza los índices en memoria (local y ANN) lote a lote.
+    Retorna el reporte de embed_chunks_in_batches, o None si no había nada que procesar.
+    on_progress(**campos) recibe embedded y total_chunks después de cada lote.
+    """
+    on_progress = on_progress or (lambda **fields: None)
+    chunks = get_chunks_without_embeddings(material_id)
+    if not chunks:
+        return None
+
+    owner_id = get_material_owner(material_id) if ann_index is not None else None
+    embedded = 0
+    lock = threading.Lock()
+
+    def _save_batch(batch, embeddings):
+        nonlocal embedded
+        upsert_chunk_embeddings(material_id, batch, embeddings)
+        # Mantiene al día el índice vectorial local (si el material está cargado)
+        local_index.append(material_id, batch, embeddings)
+        # ...y el índice ANN de toda la biblioteca
+        if ann_index is not None:
+            ann_index.add([ch["id"] for ch in batch], embeddings, material_id, owner_id)
+        with lock:
+            embedded += len(batch)
+            on_progress(embedded=embedded, total_chunks=len(chunks))
+
+    on_progress(embedded=0, total_chunks=len(chunks))
+    return embed_chunks_in_batches(chunks, on_batch=_save_batch, batch_size=batch_size, concurrency=concurrency)
+
+
+def finalize_material_index(material_id: int, changed: bool = True):
+    # Persiste los índices actualizados y descarta respuestas cacheadas que quedaron obsoletas
+    local_index.persist(material_id)
+    if ann_index is not None:
+        ann_index.maybe_save(ANN_INDEX_PATH)
+    if changed:
+        flashcards_cache.invalidate_material(material_id)
@@ -0,0 +1,399 @@
+import os
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from .config import (
+    INGEST_JOBS_DB, INGEST_JOBS_DIR, INGEST_MAX_CONCURRENT_JOBS,
+    INGEST_JOB_MAX_ATTEMPTS, INGEST_JOB_RETRY_BACKOFF_S, INGEST_SHUTDOWN_TIMEOUT_S,
+    INGEST_JOB_HEARTBEAT_S, INGEST_JOB_STALE_S,
+)
+from .pypdf_utils import count_pages
+from .ingestion import ingest_pdf, embed_material, finalize_material_index
+
+
+class JobStore:
+    """
+    Cola de jobs persistente en SQLite.
+    Cada operación abre su propia conexión: sqlite3 no permite compartir
+    una conexión entre hilos y los workers corren en hilos distintos.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS ingestion_jobs (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    stage TEXT,
+                    user_id TEXT NOT NULL,
+                    title TEXT NOT NULL,
+                    file_name TEXT,
+                    pdf_path TEXT NOT NULL,
+                    material_id INTEGER,
+                    progress TEXT NOT NULL DEFAULT '{}',
+                    timings TEXT NOT NULL DEFAULT '{}',
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    retry_at REAL,
+                    worker_id TEXT,
+                    heartbeat_at REAL
+                )
+            """)
+            # Bases creadas antes de los reintentos o del latido: se agregan las columnas que falten
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(ingestion_jobs)")}
+            if "attempts" not in columns:
+                conn.execute("ALTER TABLE ingestion_jobs ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+            if "retry_at" not in columns:
+                conn.execute("ALTER TABLE ingestion_jobs ADD COLUMN retry_at REAL")
+            if "worker_id" not in columns:
+                conn.execute("ALTER TABLE ingestion_jobs ADD COLUMN worker_id TEXT")
+            if "heartbeat_at" not in columns:
+                conn.execute("ALTER TABLE ingestion_jobs ADD COLUMN heartbeat_at REAL")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def create(self, user_id: str, title: str, file_name: str, pdf_path: str, job_id: str) -> str:
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO ingestion_jobs (id, status, user_id, title, file_name, pdf_path, created_at, updated_at) "
+                "VALUES (?, 'queued', ?, ?, ?, ?, ?, ?)",
+                (job_id, user_id, title, file_name, pdf_path, now, now),
+            )
+        return job_id
+
+    def get(self, job_id: str) -> dict | None:
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM ingestion_jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["progress"] = json.loads(job["progress"])
+        job["timings"] = json.loads(job["timings"])
+        return job
+
+    def update(self, job_id: str, owner: str | None = None, **fields) -> bool:
+        # Con `owner`, solo se escribe si el job sigue siendo de ese worker (no se lo quitó
+        # requeue_stale para dárselo a otro proceso); retorna si se escribió
+        for key in ("progress", "timings"):
+            if key in fields:
+                fields[key] = json.dumps(fields[key])
+        fields["updated_at"] = time.time()
+        assignments = ", ".join(f"{key} = ?" for key in fields)
+        query = f"UPDATE ingestion_jobs SET {assignments} WHERE id = ?"
+        params = (*fields.values(), job_id)
+        if owner is not None:
+            query += " AND status = 'running' AND worker_id = ?"
+            params += (owner,)
+        with self._connect() as conn:
+            return conn.execute(query, params).rowcount > 0
+
+    def claim_next(self, worker_id: str) -> dict | None:
+        # Toma el job más antiguo en cola (cuyo reintento ya venció) y lo marca como 'running'
+        # de forma atómica a nombre de worker_id, contando el intento
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT id FROM ingestion_jobs WHERE status = 'queued' AND (retry_at IS NULL OR retry_at <= ?) "
+                "ORDER BY created_at LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE ingestion_jobs SET status = 'running', attempts = attempts + 1, retry_at = NULL, "
+                "worker_id = ?, heartbeat_at = ?, updated_at = ? WHERE id = ?",
+                (worker_id, now, now, row["id"]),
+            )
+        return self.get(row["id"])
+
+    def retry(self, job_id: str) -> bool:
+        # Vuelve a encolar un job fallido (reintento manual); se reanuda desde su progreso guardado
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE ingestion_jobs SET status = 'queued', attempts = 0, retry_at = NULL, error = NULL, updated_at = ? "
+                "WHERE id = ? AND status = 'failed'",
+                (time.time(), job_id),
+            )
+            return cursor.rowcount > 0
+
+    def heartbeat(self, worker_id: str):
+        # Latido del proceso: sus jobs 'running' siguen vivos
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE ingestion_jobs SET heartbeat_at = ? WHERE status = 'running' AND worker_id = ?",
+                (time.time(), worker_id),
+            )
+
+    def requeue_stale(self, stale_after_s: float) -> int:
+        # Los jobs 'running' cuyo dueño dejó de latir (el proceso murió o se cortó) vuelven a la cola.
+        # Los de procesos vivos no se tocan, aunque compartan la base
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE ingestion_jobs SET status = 'queued', worker_id = NULL, updated_at = ? "
+                "WHERE status = 'running' AND (heartbeat_at IS NULL OR heartbeat_at < ?)",
+                (time.time(), time.time() - stale_after_s),
+            )
+            return cursor.rowcount
+
+
+class JobInterrupted(Exception):
+    # El runner se está deteniendo: el job se corta en el próximo punto de avance y vuelve a la cola
+    pass
+
+
+class JobLost(JobInterrupted):
+    # El job se dio por huérfano (sin latido) y pasó a otro worker: este lo abandona sin escribir más
+    pass
+
+
+class JobRunner:
+    """
+    Pool de hilos que ejecuta los jobs de ingesta: extract -> chunk -> embed -> index.
+    Como máximo `max_concurrent` jobs corren a la vez; el resto espera en la cola SQLite.
+    Un job interrumpido (reinicio o stop()) se reanuda desde su último progreso guardado, y uno
+    que falla se reintenta igual hasta `max_attempts` veces con espera exponencial (salvo un
+    ValueError, p. ej. un PDF sin texto, que no mejora reintentando).
+
+    Varios procesos pueden compartir la misma base (uvicorn --workers): cada runner reclama los
+    jobs con su `worker_id` y un hilo de latido refresca heartbeat_at cada `heartbeat_s`. Solo se
+    reencolan los jobs 'running' sin latido en `stale_after_s` (su proceso murió), nunca los que
+    otro proceso vivo está corriendo.
+    """
+
+    def __init__(self, store: JobStore, pdf_dir: str, max_concurrent: int, max_attempts: int = INGEST_JOB_MAX_ATTEMPTS,
+                 retry_backoff_s: float = INGEST_JOB_RETRY_BACKOFF_S, heartbeat_s: float = INGEST_JOB_HEARTBEAT_S,
+                 stale_after_s: float = INGEST_JOB_STALE_S):
+        self.store = store
+        self.pdf_dir = pdf_dir
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_attempts = max(1, max_attempts)
+        self.retry_backoff_s = retry_backoff_s
+        self.heartbeat_s = heartbeat_s
+        # El latido tiene que llegar varias veces dentro del plazo para no perder jobs vivos
+        self.stale_after_s = max(stale_after_s, 3 * heartbeat_s)
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._threads: list[threading.Thread] = []
+        os.makedirs(pdf_dir, exist_ok=True)
+
+    def start(self):
+        if self._threads:
+            return
+        self._stop.clear()
+        self._requeue_stale()
+        for i in range(self.max_concurrent):
+            thread = threading.Thread(target=self._worker, name=f"ingestion-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        thread = threading.Thread(target=self._heartbeat, name="ingestion-heartbeat", daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def stop(self, timeout: float = INGEST_SHUTDOWN_TIMEOUT_S):
+        # Los jobs en curso se cortan en su próximo punto de avance (fin de un lote) y quedan en cola;
+        # si alguno no llega a tiempo, deja de latir y requeue_stale lo recupera (este u otro proceso)
+        self._stop.set()
+        self._wakeup.set()
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        alive = sum(thread.is_alive() for thread in self._threads)
+        if alive:
+            print(f"{alive} workers de ingesta no terminaron en {timeout}s; sus jobs se reanudarán en {self.stale_after_s}s.")
+        self._threads = []
+
+    def submit(self, content: bytes, user_id: str, title: str, file_name: str) -> str:
+        # El PDF se guarda en disco para que el job sobreviva a un reinicio del proceso
+        job_id = uuid.uuid4().hex
+        pdf_path = os.path.join(self.pdf_dir, f"{job_id}.pdf")
+        with open(pdf_path, "wb") as f:
+            f.write(content)
+        self.store.create(user_id, title, file_name, pdf_path, job_id)
+        self.wake()
+        return job_id
+
+    def wake(self):
+        # Avisa a los workers de que hay un job nuevo en la cola
+        self._wakeup.set()
+
+    def _requeue_stale(self):
+        try:
+            requeued = self.store.requeue_stale(self.stale_after_s)
+        except sqlite3.Error as e:
+            print(f"Error al reencolar jobs de ingesta huérfanos: {e}")
+            return
+        if requeued:
+            print(f"Reanudando {requeued} jobs de ingesta interrumpidos.")
+            self.wake()
+
+    def _heartbeat(self):
+        # Mantiene vivos los jobs de este proceso y recupera los de procesos que dejaron de latir
+        while not self._stop.wait(self.heartbeat_s):
+            try:
+                self.store.heartbeat(self.worker_id)
+            except sqlite3.Error as e:
+                print(f"Error al registrar el latido de los jobs de ingesta: {e}")
+            self._requeue_stale()
+
+    def _worker(self):
+        while not self._stop.is_set():
+            job = self.store.claim_next(self.worker_id)
+            if job is None:
+                self._wakeup.wait(timeout=1.0)
+                self._wakeup.clear()
+                continue
+            self._run(job)
+
+    def _run(self, job: dict):
+        job_id = job["id"]
+        progress = job["progress"]
+        timings = job["timings"]
+        stage_started = {}
+
+        def _save(**fields):
+            # Toda escritura del job exige que siga siendo nuestro; si no, se abandona
+            if not self.store.update(job_id, owner=self.worker_id, **fields):
+                raise JobLost()
+
+        def _enter(stage: str):
+            stage_started[stage] = time.perf_counter()
+            _save(stage=stage, progress=progress)
+
+        def _leave(stage: str):
+            timings[stage] = round(timings.get(stage, 0.0) + time.perf_counter() - stage_started[stage], 3)
+            _save(timings=timings)
+
+        def _on_progress(**fields):
+            progress.update(fields)
+            if "material_id" in fields:
+                _save(material_id=fields["material_id"], progress=progress, heartbeat_at=time.time())
+            else:
+                _save(progress=progress, heartbeat_at=time.time())
+            # Con el avance ya guardado, el job puede cortarse aquí y reanudarse sin repetir trabajo
+            if self._stop.is_set():
+                raise JobInterrupted()
+
+        try:
+            with open(job["pdf_path"], "rb") as f:
+                content = f.read()
+
+            # 1-2. extract + chunk (streaming: la extracción y el chunking se intercalan)
+            if not progress.get("chunked"):
+                _enter("extract")
+                progress["total_pages"] = count_pages(content)
+                started_chunk = False
+
+                def _on_ingest_progress(**fields):
+                    nonlocal started_chunk
+                    if "batches_done" in fields and not started_chunk:
+                        # Primer lote insertado: la etapa activa pasa a ser 'chunk'
+                        _leave("extract")
+                        _enter("chunk")
+                        started_chunk = True
+                    _on_progress(**fields)
+
+                result = ingest_pdf(
+                    content, job["user_id"], job["title"], job["file_name"],
+                    material_id=job["material_id"] or progress.get("material_id"),
+                    skip_batches=progress.get("batches_done", 0),
+                    on_progress=_on_ingest_progress,
+                )
+                _leave("chunk" if started_chunk else "extract")
+                progress["chunked"] = True
+                progress["material_id"] = result["material_id"]
+                if result.get("deduplicated_from"):
+                    progress["deduplicated_from"] = result["deduplicated_from"]
+                _save(material_id=result["material_id"], progress=progress)
+
+            material_id = progress["material_id"]
+
+            # 3. embed (reanudable: solo procesa los chunks sin embedding)
+            _enter("embed")
+            report = embed_material(material_id, on_progress=_on_progress)
+            _leave("embed")
+            if report and report["failed_batches"]:
+                raise Exception(f"{report['failed']} chunks sin embedding tras el lote fallido {report['failed_batches'][0]['batch']}.")
+
+            # 4. index
+            _enter("index")
+            finalize_material_index(material_id, changed=bool(report and report["processed"]))
+            _leave("index")
+
+            _save(status="done", stage="done", progress=progress)
+            try:
+                os.unlink(job["pdf_path"])
+            except OSError:
+                pass
+
+        except JobLost:
+            print(f"El job de ingesta {job_id} pasó a otro worker; se abandona.")
+        except Exception as e:
+            if self._stop.is_set():
+                # Cortado por stop() (directamente o como lote fallido): no cuenta como intento
+                self.store.update(job_id, owner=self.worker_id, status="queued", worker_id=None,
+                                  attempts=max(0, job["attempts"] - 1), progress=progress, timings=timings)
+                return
+            print(f"Error en el job de ingesta {job_id} (intento {job['attempts']}): {e}")
+            if isinstance(e, ValueError) or job["attempts"] >= self.max_attempts:
+                self.store.update(job_id, owner=self.worker_id, status="failed", error=str(e),
+                                  progress=progress, timings=timings)
+            else:
+                retry_at = time.time() + self.retry_backoff_s * 2 ** (job["attempts"] - 1)
+                self.store.update(job_id, owner=self.worker_id, status="queued", worker_id=None, retry_at=retry_at,
+                                  error=str(e), progress=progress, timings=timings)
+
+
+def job_status(job: dict) -> dict:
+    # Vista pública de un job para el endpoint /jobs/{id}
+    progress = job["progress"]
+    stage = job["stage"]
+    if stage in ("extract", "chunk") and progress.get("total_pages"):
+        fraction = progress.get("pages_done", 0) / progress["total_pages"]
+    elif stage == "embed" and progress.get("total_chunks"):
+        fraction = progress.get("embedded", 0) / progress["total_chunks"]
+    elif stage == "done":
+        fraction = 1.0
+    else:
+        fraction = 0.0
+    return {
+        "job_id": job["id"],
+        "status": job["status"],
+        "stage": stage,
+        "stage_progress": round(fraction, 4),
+        "material_id": job["material_id"],
+        "counters": {k: v for k, v in progress.items() if k not in ("chunked", "material_id")},
+        "timings_s": job["timings"],
+        "error": job["error"],
+        "attempts": job["attempts"],
+        "retry_at": job["retry_at"],
+        "created_at": job["created_at"],
+        "updated_at": job["updated_at"],
+    }
+
+
+# Instancias únicas (los workers se arrancan en el lifespan de la app, ver api/main.py)
+job_store = JobStore(INGEST_JOBS_DB)
+job_runner = JobRunner(job_store, INGEST_JOBS_DIR, INGEST_MAX_CONCURRENT_JOBS)
@@ -0,0 +1,210 @@
+import re
+import math
+import heapq
+import asyncio
+import threading
+import unicodedata
+from collections import Counter
+
+from .config import LEXICAL_BM25_K1, LEXICAL_BM25_B, LEXICAL_SHORT_QUERY_TERMS, RETRIEVAL_MODE
+from . import supabase as supabase_db
+from .metrics import traced
+
+# Índice léxico (BM25) en memoria sobre material_chunks, uno por material.
+# Complementa al vectorial: resuelve consultas de palabras clave ("fotosíntesis",
+# "ciclo de Krebs") sin pedir un embedding a Gemini, y en modo híbrido aporta
+# coincidencias exactas de términos que la búsqueda densa a veces pierde.
+
+_WORD_RE = re.compile(r'\w+')
+
+# Palabras vacías (español e inglés): no discriminan entre chunks y solo inflan las listas invertidas
+STOPWORDS = frozenset("""
+a al algo algunos ante antes como con contra cual cuales cuando de del desde donde durante e el ella ellas
+ellos en entre era es esa ese eso esta este esto estos estas fue ha han hasta hay la las le les lo los mas
+me mi mucho muy nada ni no nos o otra otro para pero poco por porque que quien se sea segun ser si sin sobre
+son su sus tambien tan te tiene todo tras tu un una uno unos unas y ya yo
+an and are as at be by for from how in is it its of on or that the this to was what when where which who why with
+""".split())
+
+
+def fold(text: str) -> str:
+    # Minúsculas y sin tildes: "Fotosíntesis" y "fotosintesis" son el mismo término
+    decomposed = unicodedata.normalize("NFKD", text.lower())
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def tokenize(text: str) -> list[str]:
+    return [w for w in _WORD_RE.findall(fold(text)) if len(w) > 1 and w not in STOPWORDS]
+
+
+def is_keyword_query(text: str, max_terms: int = LEXICAL_SHORT_QUERY_TERMS) -> bool:
+    # Consulta corta de palabras clave: pocas palabras y al menos un término con contenido
+    words = _WORD_RE.findall(text)
+    return 0 < len(words) <= max_terms and bool(tokenize(text))
+
+
+class BM25Index:
+    """
+    Índice invertido BM25 de un único material.
+    postings: término -> {chunk_id: frecuencia}; se actualiza chunk a chunk (add/remove),
+    así la ingesta y el reemplazo de PDFs no obligan a reconstruirlo.
+    """
+
+    def __init__(self, k1: float = LEXICAL_BM25_K1, b: float = LEXICAL_BM25_B):
+        self.k1 = k1
+        self.b = b
+        self.postings: dict[str, dict[int, int]] = {}
+        self.lengths: dict[int, int] = {}
+        self.texts: dict[int, str] = {}
+        # page_start de cada chunk (si se conoce): se devuelve en los hits para ordenar el contexto
+        self.pages: dict[int, int] = {}
+        self.total_length = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_rows(cls, rows: list[dict]):
+        index = cls()
+        index.add(rows)
+        return index
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def _discard(self, chunk_id: int):
+        if chunk_id not in self.lengths:
+            return
+        for term in set(tokenize(self.texts[chunk_id])):
+            posting = self.postings.get(term)
+            if posting is not None:
+                posting.pop(chunk_id, None)
+                if not posting:
+                    del self.postings[term]
+        self.total_length -= self.lengths.pop(chunk_id)
+        del self.texts[chunk_id]
+        self.pages.pop(chunk_id, None)
+
+    def add(self, rows: list[dict]):
+        # rows: [{'id', 'chunk_text', 'page_start'?}]; un id ya indexado se reemplaza (añadir es idempotente)
+        with self._lock:
+            for row in rows:
+                chunk_id = row["id"]
+                self._discard(chunk_id)
+                frequencies = Counter(tokenize(row["chunk_text"]))
+                for term, count in frequencies.items():
+                    self.postings.setdefault(term, {})[chunk_id] = count
+                self.lengths[chunk_id] = sum(frequencies.values())
+                self.texts[chunk_id] = row["chunk_text"]
+                if row.get("page_start") is not None:
+                    self.pages[chunk_id] = row["page_start"]
+                self.total_length += self.lengths[chunk_id]
+
+    def remove(self, chunk_ids):
+        with self._lock:
+            for chunk_id in chunk_ids:
+                self._discard(chunk_id)
+
+    def search(self, query: str, limit: int = 4) -> list[dict]:
+        # Hits con el mismo formato que vector_search_hits pero con 'score' BM25 en lugar de 'similarity'
+        terms = set(tokenize(query))
+        with self._lock:
+            if not terms or not self.lengths:
+                return []
+            total = len(self.lengths)
+            average_length = self.total_length / total or 1.0
+            scores: dict[int, float] = {}
+            for term in terms:
+                posting = self.postings.get(term)
+                if not posting:
+                    continue
+                idf = math.log(1 + (total - len(posting) + 0.5) / (len(posting) + 0.5))
+                for chunk_id, frequency in posting.items():
+                    norm = self.k1 * (1 - self.b + self.b * self.lengths[chunk_id] / average_length)
+                    scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * frequency * (self.k1 + 1) / (frequency + norm)
+            best = heapq.nlargest(limit, scores.items(), key=lambda item: (item[1], -item[0]))
+            hits = []
+            for chunk_id, score in best:
+                hit = {"id": chunk_id, "chunk_text": self.texts[chunk_id], "score": score}
+                if chunk_id in self.pages:
+                    hit["page_start"] = self.pages[chunk_id]
+                hits.append(hit)
+            return hits
+
+
+class LexicalStore:
+    """
+    Índices BM25 por material. Un material recién ingerido se indexa a medida que se
+    escriben sus chunks (solo si `index_on_ingest`, es decir, si RETRIEVAL_MODE usa BM25);
+    los demás se cargan de Supabase en la primera búsqueda.
+    """
+
+    def __init__(self, index_on_ingest: bool = RETRIEVAL_MODE != "dense"):
+        self.index_on_ingest = index_on_ingest
+        self._indexes: dict[int, BM25Index] = {}
+        self._lock = threading.Lock()
+        # Un lock por material en carga: la lectura de Supabase no bloquea a los demás materiales,
+        # y las búsquedas simultáneas del mismo material comparten una sola carga
+        self._loading: dict[int, threading.Lock] = {}
+        # Cambia con create()/invalidate(): una carga que se cruza con ellos no se guarda
+        self._versions: Counter = Counter()
+
+    def get(self, material_id: int) -> BM25Index:
+        with self._lock:
+            index = self._indexes.get(material_id)
+            if index is not None:
+                return index
+            loading = self._loading.setdefault(material_id, threading.Lock())
+        with loading:
+            with self._lock:
+                index = self._indexes.get(material_id)
+                if index is not None:
+                    return index
+                version = self._versions[material_id]
+            index = None
+            try:
+                index = BM25Index.from_rows(supabase_db.get_chunk_texts(material_id))
+            finally:
+                with self._lock:
+                    if index is not None and self._versions[material_id] == version:
+                        self._indexes[material_id] = index
+                    self._loading.pop(material_id, None)
+            return index
+
+    def create(self, material_id: int):
+        # Material nuevo (aún sin chunks): el índice se arma durante la ingesta con add()
+        if not self.index_on_ingest:
+            return
+        with self._lock:
+            self._versions[material_id] += 1
+            self._indexes[material_id] = BM25Index()
+
+    def add(self, material_id: int, rows: list[dict]):
+        # Si el material no está cargado no hacemos nada: se leerá completo en la primera búsqueda
+        with self._lock:
+            index = self._indexes.get(material_id)
+        if index is not None:
+            index.add(rows)
+
+    def remove(self, material_id: int, chunk_ids):
+        with self._lock:
+            index = self._indexes.get(material_id)
+        if index is not None:
+            index.remove(chunk_ids)
+
+    def invalidate(self, material_id: int):
+        with self._lock:
+            self._versions[material_id] += 1
+            self._indexes.pop(material_id, None)
+
+
+# Instancia única del índice léxico
+lexical_index = LexicalStore()
+
+
+def lexical_search_hits(query: str, material_id: int, limit: int = 4) -> list[dict]:
+    return lexical_index.get(material_id).search(query, limit)
+
+
+@traced("lexical_search")
+async def alexical_search_hits(query: str, material_id: int, limit: int = 4) -> list[dict]:
+    # En un hilo: la primera búsqueda de un material lo carga desde Supabase
+    return await asyncio.to_thread(lexical_search_hits, query, material_id, limit)
@@ -1,12 +1,38 @@
+import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
 from api import routes
-from api.routes import upload, generate
+from api.routes import upload, generate, jobs
+from api.jobs import job_runner
+from api.speech import transcription_service
+from api.metrics import metrics, MetricsMiddleware
+from api.query_cache import query_embedding_memo
+from api.embedding_cache import embedding_cache
+from api.response_cache import flashcards_cache
+from api.gemini_scheduler import gemini_scheduler
 from fastapi.middleware.cors import CORSMiddleware
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Arranca los workers de ingesta (y reanuda los jobs que quedaron a medias)
+    job_runner.start()
+    # ...y los de Whisper solo si WHISPER_WARM_MODELS pide precargar modelos (si no, el pool se crea
+    # con la primera transcripción)
+    transcription_service.start()
+    yield
+    # Espera (fuera del event loop) a que los jobs en curso lleguen a un punto de corte
+    await asyncio.to_thread(job_runner.stop)
+    transcription_service.stop()
+    if embedding_cache:
+        embedding_cache.flush()
+
+
 app = FastAPI(
     title="Pre-Hack 2 RAG backend",
-    description="API para subir PDFs, procesarlos y generar herramientas de estudio basadas en RAG usando Gemini y Supabase."
+    description="API para subir PDFs, procesarlos y generar herramientas de estudio basadas en RAG usando Gemini y Supabase.",
+    lifespan=lifespan
 )
 
 origins = [
@@ -24,11 +50,45 @@ app.add_middleware(
     allow_headers=["*"],               # Permite todos los headers
 )
 
+# Latencia y conteo por ruta + cabecera Server-Timing a pedido (ver api/metrics.py)
+app.add_middleware(MetricsMiddleware)
+
+
+def _metrics_snapshot() -> tuple[dict, dict]:
+    # Valores que se leen al momento de cada scrape: cachés y cola del planificador de Gemini.
+    # Retorna (gauges, counters): los aciertos, fallos y 429 solo crecen (se reinician con el proceso),
+    # así que van como counters *_total para que rate()/increase() detecten el reinicio
+    caches = {"query_embeddings": query_embedding_memo.stats(), "flashcards": flashcards_cache.stats()}
+    if embedding_cache:
+        caches["chunk_embeddings"] = embedding_cache.stats()
+    lanes = gemini_scheduler.stats()["lanes"]
+    gauges = {
+        "rag_cache_hit_ratio": [({"cache": name}, stats["hit_rate"]) for name, stats in caches.items()],
+        "rag_cache_entries": [({"cache": name}, stats["entries"]) for name, stats in caches.items()],
+        "rag_gemini_queue_depth": [({"lane": lane}, lane_stats["queue_depth"]) for lane, lane_stats in lanes.items()],
+    }
+    counters = {
+        "rag_cache_hits_total": [({"cache": name}, stats["hits"]) for name, stats in caches.items()],
+        "rag_cache_misses_total": [({"cache": name}, stats["misses"]) for name, stats in caches.items()],
+        "rag_gemini_rate_limited_total": [({"lane": lane}, lane_stats["rate_limited"])
+                                          for lane, lane_stats in lanes.items()],
+    }
+    return gauges, counters
+
+
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+def metrics_route():
+    """Métricas en formato de texto de Prometheus: latencias por etapa y por ruta, errores, tokens y cachés."""
+    gauges, counters = _metrics_snapshot()
+    return PlainTextResponse(metrics.render(gauges, counters), media_type="text/plain; version=0.0.4")
+
+
 #incluir los routers de la aplicación
 #Las rutas de 'upload' estarán en /api/upload y las de 'generate' en /api/generate
 
 app.include_router(upload.router, prefix="/api", tags=["Upload & Chunking"])
 app.include_router(generate.router, prefix="/api", tags=["RAG & Generation"])
+app.include_router(jobs.router, prefix="/api", tags=["Ingestion Jobs"])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,229 @@
+import time
+import inspect
+import threading
+import functools
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from .config import METRICS_TIMING_HEADER
+
+# Métricas del backend en memoria, exportadas en formato de texto de Prometheus (GET /metrics).
+# Cada etapa del pipeline (embedding, búsqueda vectorial, generación, Supabase, Whisper...) se
+# mide con trace(etapa) o @traced(etapa): su latencia va a un histograma y sus excepciones a un
+# contador. Si la petición en curso pidió el desglose de tiempos (ver api/main.py), cada etapa
+# también se anota en ella y se devuelve en la cabecera Server-Timing.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Etapas de la petición en curso: (etapa, segundos). None si no se pidió el desglose
+_request_timings: ContextVar[list | None] = ContextVar("request_timings", default=None)
+
+
+class MetricsRegistry:
+    """
+    Contadores e histogramas con etiquetas (thread-safe), sin dependencias externas.
+    Las métricas se crean al primer uso; describe() solo agrega el texto de ayuda.
+    """
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._help: dict[str, str] = {}
+        # nombre -> {etiquetas (tupla ordenada): valor}
+        self._counters: dict[str, dict[tuple, float]] = {}
+        # nombre -> {etiquetas: [conteo por bucket..., suma, total]}
+        self._histograms: dict[str, dict[tuple, list]] = {}
+
+    def describe(self, name: str, help_text: str):
+        self._help[name] = help_text
+
+    def inc(self, name: str, value: float = 1.0, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            state = series.get(key)
+            if state is None:
+                state = series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def render(self, gauges: dict | None = None, counters: dict | None = None) -> str:
+        # `gauges` y `counters`: {nombre: [(etiquetas, valor), ...]} calculados al momento. En `gauges`
+        # van los valores que suben y bajan (tasas de acierto, tamaños, colas); en `counters` los totales
+        # acumulados que otro componente ya cuenta (aciertos de cachés, 429), con nombre terminado en _total
+        lines = []
+
+        def header(name: str, kind: str):
+            if name in self._help:
+                lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                header(name, "counter")
+                for key, value in series.items():
+                    lines.append(f"{name}{_labels(dict(key))} {_number(value)}")
+            for name, series in sorted(self._histograms.items()):
+                header(name, "histogram")
+                for key, state in series.items():
+                    labels = dict(key)
+                    for bound, count in zip(self.buckets, state):
+                        lines.append(f"{name}_bucket{_labels({**labels, 'le': _number(bound)})} {count}")
+                    lines.append(f"{name}_bucket{_labels({**labels, 'le': '+Inf'})} {state[-1]}")
+                    lines.append(f"{name}_sum{_labels(labels)} {_number(state[-2])}")
+                    lines.append(f"{name}_count{_labels(labels)} {state[-1]}")
+        for kind, computed in (("counter", counters), ("gauge", gauges)):
+            for name, series in sorted((computed or {}).items()):
+                header(name, kind)
+                for labels, value in series:
+                    lines.append(f"{name}{_labels(labels)} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in labels.values())
+    return "{" + ",".join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + "}"
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+# Instancia única compartida por todos los módulos
+metrics = MetricsRegistry()
+metrics.describe("rag_stage_duration_seconds", "Latencia de cada etapa del pipeline RAG.")
+metrics.describe("rag_stage_errors_total", "Excepciones por etapa del pipeline RAG.")
+metrics.describe("rag_gemini_tokens_total", "Tokens enviados (prompt) y recibidos (output) de Gemini por modelo.")
+metrics.describe("rag_http_request_duration_seconds", "Latencia de las peticiones HTTP por ruta (hasta el último byte).")
+metrics.describe("rag_http_requests_total", "Peticiones HTTP por ruta y código de estado.")
+
+
+@contextmanager
+def trace(stage: str):
+    """
+    Mide un bloque como la etapa `stage`: latencia al histograma, excepción al contador de
+    errores (la excepción se propaga) y, si la petición pidió el desglose, a sus tiempos.
+    Sirve tanto en código síncrono como dentro de corrutinas (`with trace(...)`).
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        metrics.inc("rag_stage_errors_total", stage=stage)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics.observe("rag_stage_duration_seconds", elapsed, stage=stage)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings.append((stage, elapsed))
+
+
+def traced(stage: str):
+    # Decorador equivalente a envolver todo el cuerpo de la función (sync o async) en trace(stage)
+    def decorator(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with trace(stage):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with trace(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_tokens(model: str, prompt_tokens: int, output_tokens: int = 0):
+    if prompt_tokens:
+        metrics.inc("rag_gemini_tokens_total", prompt_tokens, model=model, kind="prompt")
+    if output_tokens:
+        metrics.inc("rag_gemini_tokens_total", output_tokens, model=model, kind="output")
+
+
+def start_request_timing():
+    # Activa el desglose de tiempos para la petición (y las tareas que cree); retorna (token, lista)
+    timings = []
+    return _request_timings.set(timings), timings
+
+
+def stop_request_timing(token):
+    _request_timings.reset(token)
+
+
+def server_timing_header(timings: list, total_s: float | None = None) -> str:
+    # Cabecera Server-Timing (la muestran las devtools del navegador): una entrada por etapa,
+    # sumando las repeticiones (p. ej. varias búsquedas) e indicando cuántas hubo
+    totals: dict[str, list] = {}
+    for stage, elapsed in list(timings):
+        entry = totals.setdefault(stage, [0.0, 0])
+        entry[0] += elapsed
+        entry[1] += 1
+    parts = []
+    for stage, (elapsed, count) in totals.items():
+        part = f"{stage};dur={elapsed * 1000:.1f}"
+        parts.append(part + (f';desc="x{count}"' if count > 1 else ""))
+    if total_s is not None:
+        parts.append(f"total;dur={total_s * 1000:.1f}")
+    return ", ".join(parts)
+
+
+class MetricsMiddleware:
+    """
+    Middleware ASGI: latencia (hasta el último byte, también en streaming) y conteo de
+    peticiones por ruta, con la plantilla de la ruta como etiqueta ("/material/{material_id}/...").
+    Con "X-Debug-Timing: 1" (o METRICS_TIMING_HEADER=true) agrega la cabecera Server-Timing con
+    las etapas medidas hasta que salen las cabeceras (en streaming, las previas al primer evento).
+    """
+
+    def __init__(self, app, timing_header: bool = METRICS_TIMING_HEADER):
+        self.app = app
+        self.timing_header = timing_header
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] == "/metrics":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        debug = dict(scope.get("headers", [])).get(b"x-debug-timing", b"").lower() in (b"1", b"true")
+        token, timings = start_request_timing() if self.timing_header or debug else (None, None)
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if timings is not None:
+                    value = server_timing_header(timings, time.perf_counter() - start).encode()
+                    message = {**message, "headers": [*message.get("headers", []), (b"server-timing", value)]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            metrics.observe("rag_http_request_duration_seconds", time.perf_counter() - start,
+                            method=scope["method"], route=route)
+            metrics.inc("rag_http_requests_total", method=scope["method"], route=route, status=str(status))
+            if token is not None:
+                stop_request_timing(token)
@@ -1,12 +1,98 @@
+import os
+import tempfile
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from pypdf import PdfReader
 from io import BytesIO
+from typing import Iterator
+
+from .config import PDF_EXTRACT_WORKERS, PDF_PARALLEL_MIN_BYTES
+
+# Pool de procesos compartido (se crea la primera vez que se necesita)
+_pool = None
+_pool_lock = threading.Lock()
+
+# Caché del PdfReader dentro de cada proceso worker: así un worker que recibe
+# varios rangos del mismo archivo no vuelve a parsear el PDF completo.
+_worker_reader = (None, None)
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # 'spawn' evita heredar hilos y sockets del servidor (fork no es seguro con hilos)
+            _pool = ProcessPoolExecutor(
+                max_workers=PDF_EXTRACT_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _pool
+
+def _extract_page_range(path: str, start: int, end: int) -> list[str]:
+    # Se ejecuta en un proceso worker: extrae el texto de las páginas [start, end)
+    global _worker_reader
+    # mkstemp puede reutilizar un nombre ya borrado, así que la clave incluye mtime y tamaño
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    cached_key, reader = _worker_reader
+    if cached_key != key:
+        reader = PdfReader(path)
+        _worker_reader = (key, reader)
+    return [reader.pages[i].extract_text() or "" for i in range(start, end)]
+
+def iter_pages_parallel(pdf_bytes: bytes, workers: int = PDF_EXTRACT_WORKERS) -> Iterator[tuple[int, str]]:
+    """
+    Igual que iter_pages, pero reparte rangos de páginas entre procesos.
+    Los bytes del PDF se escriben UNA vez en un archivo temporal y los workers
+    reciben solo la ruta y el rango (no se vuelve a serializar el PDF por tarea).
+    Las páginas se devuelven en orden.
+    """
+    fd, path = tempfile.mkstemp(suffix=".pdf")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(pdf_bytes)
+        num_pages = len(PdfReader(path).pages)
+
+        # Varios rangos por worker para equilibrar la carga (algunas páginas cuestan más que otras)
+        range_size = max(1, num_pages // (workers * 4))
+        pool = _get_pool()
+        futures = [
+            (start, pool.submit(_extract_page_range, path, start, min(start + range_size, num_pages)))
+            for start in range(0, num_pages, range_size)
+        ]
+        try:
+            for start, future in futures:
+                for offset, text in enumerate(future.result()):
+                    yield start + offset + 1, text
+        finally:
+            for _, future in futures:
+                future.cancel()
+    finally:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+def count_pages(pdf_bytes: bytes) -> int:
+    # Número de páginas (solo lee la estructura del PDF, no extrae texto)
+    return len(PdfReader(BytesIO(pdf_bytes)).pages)
+
+def iter_pages(pdf_bytes: bytes) -> Iterator[tuple[int, str]]:
+    """
+    Genera (número_de_página, texto) página por página, empezando en 1.
+    Así nunca se construye el documento completo como un único string.
+    Los PDFs de al menos PDF_PARALLEL_MIN_BYTES se extraen en paralelo con un pool de procesos.
+    """
+    if PDF_EXTRACT_WORKERS > 1 and len(pdf_bytes) >= PDF_PARALLEL_MIN_BYTES:
+        yield from iter_pages_parallel(pdf_bytes)
+        return
+
+    reader = PdfReader(BytesIO(pdf_bytes))
+    for page_number, page in enumerate(reader.pages, start=1):
+        # Usamos or "" para manejar páginas vacías.
+        yield page_number, page.extract_text() or ""
 
 def extract_text_from_bytes(pdf_bytes: bytes) -> str:
     """Extrae texto de un archivo PDF en formato bytes."""
     # Usamos BytesIO para tratar los bytes como un archivo en memoria.
-    reader = PdfReader(BytesIO(pdf_bytes))
-    texts = []
-    for page in reader.pages:
-        # Extraemos texto de cada página. Usamos or "" para manejar páginas vacías.
-        texts.append(page.extract_text() or "") 
-    return "\n".join(texts)
\ No newline at end of file
+    return "\n".join(text for _, text in iter_pages(pdf_bytes))
@@ -0,0 +1,151 @@
+import re
+import asyncio
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from .config import QUERY_CACHE_MAX_ENTRIES, QUERY_CACHE_TTL_S
+
+
+def normalize_query(text: str) -> str:
+    # Misma consulta con distintos espacios -> misma clave
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+class TTLMemo:
+    """
+    Memo en memoria LRU + TTL con coalescencia de peticiones en vuelo.
+
+    Si llegan N peticiones con la misma clave mientras la primera aún se está
+    calculando, solo la primera ejecuta `compute()`; las demás esperan su resultado.
+    Los resultados "vacíos" (p. ej. [] cuando falla el embedding) no se guardan.
+    """
+
+    def __init__(self, max_entries: int, ttl_s: float):
+        self.max_entries = max(1, max_entries)
+        self.ttl_s = ttl_s
+        self._entries: OrderedDict[str, tuple[float, object]] = OrderedDict()
+        self._inflight: dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.expired = 0
+        self.evictions = 0
+
+    def _claim(self, key: str):
+        # Retorna (True, valor) si hay acierto; si no, (False, (future, owner)):
+        # owner=True significa que esta petición debe calcular el valor
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return True, value
+                del self._entries[key]
+                self.expired += 1
+
+            future = self._inflight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return False, (future, False)
+            self.misses += 1
+            future = Future()
+            self._inflight[key] = future
+            return False, (future, True)
+
+    def _fail(self, key: str, future: Future, error: BaseException):
+        with self._lock:
+            self._inflight.pop(key, None)
+        future.set_exception(error)
+
+    def _store(self, key: str, future: Future, value):
+        with self._lock:
+            self._inflight.pop(key, None)
+            if value:
+                self._entries[key] = (time.monotonic() + self.ttl_s, value)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+        future.set_result(value)
+
+    def get_or_compute(self, key: str, compute):
+        hit, result = self._claim(key)
+        if hit:
+            return result
+        future, owner = result
+        if not owner:
+            return future.result()
+        try:
+            value = compute()
+        except BaseException as e:
+            self._fail(key, future, e)
+            raise
+        self._store(key, future, value)
+        return value
+
+    async def aget_or_compute(self, key: str, compute):
+        # Variante async: `compute` es una corrutina (función async sin argumentos).
+        # Comparte entradas y peticiones en vuelo con get_or_compute.
+        hit, result = self._claim(key)
+        if hit:
+            return result
+        future, owner = result
+        if not owner:
+            return await asyncio.wrap_future(future)
+        try:
+            value = await compute()
+        except BaseException as e:
+            self._fail(key, future, e)
+            raise
+        self._store(key, future, value)
+        return value
+
+    async def aget_or_compute_many(self, keys: list[str], compute_many) -> list:
+        # Como aget_or_compute para varias claves: las que faltan se calculan juntas con
+        # `compute_many(claves)` (una corrutina que retorna un valor por clave, en orden)
+        values, owned, waiting = {}, {}, {}
+        for key in dict.fromkeys(keys):
+            hit, result = self._claim(key)
+            if hit:
+                values[key] = result
+            else:
+                future, owner = result
+                (owned if owner else waiting)[key] = future
+        if owned:
+            try:
+                computed = await compute_many(list(owned))
+            except BaseException as e:
+                for key, future in owned.items():
+                    self._fail(key, future, e)
+                raise
+            for (key, future), value in zip(owned.items(), computed):
+                self._store(key, future, value)
+                values[key] = value
+        for key, future in waiting.items():
+            values[key] = await asyncio.wrap_future(future)
+        return [values[key] for key in keys]
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses + self.coalesced
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_s": self.ttl_s,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "expired": self.expired,
+            "evictions": self.evictions,
+            # Las peticiones coalescidas tampoco llaman a Gemini, así que cuentan como acierto
+            "hit_rate": round((self.hits + self.coalesced) / total, 4) if total else 0.0,
+        }
+
+
+# Memo compartido por todas las rutas RAG para los embeddings de consultas
+query_embedding_memo = TTLMemo(QUERY_CACHE_MAX_ENTRIES, QUERY_CACHE_TTL_S)
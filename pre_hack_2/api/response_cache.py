@@ -0,0 +1,119 @@
+import time
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from .config import RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_MAX_DISTANCE, RESPONSE_CACHE_TTL_S
+from .query_cache import normalize_query
+
+
+class SemanticResponseCache:
+    """
+    Caché semántica de respuestas generadas (p. ej. flashcards).
+
+    Las entradas se agrupan por (material_id, num_flashcards). Una consulta nueva
+    reutiliza una respuesta guardada si su embedding está a distancia coseno
+    <= max_distance del embedding de la consulta original, o si es el mismo texto
+    (las consultas de palabras clave se resuelven sin embedding: solo cuentan por texto).
+
+    - Memoria acotada: como máximo max_entries respuestas, expulsión LRU.
+    - Caducidad: cada entrada vence tras ttl_s segundos.
+    - Obsolescencia: invalidate_material() descarta todo lo de un material
+      cuando sus chunks cambian (nuevos embeddings, reemplazo del PDF, etc.).
+    """
+
+    def __init__(self, max_entries: int, max_distance: float, ttl_s: float):
+        self.max_entries = max(1, max_entries)
+        self.max_distance = max_distance
+        self.ttl_s = ttl_s
+        # entry_id -> (key, embedding normalizado o None, texto normalizado, respuesta, expires_at)
+        self._entries: OrderedDict[int, tuple] = OrderedDict()
+        self._by_key: dict[tuple, set[int]] = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray | None:
+        if embedding is None:
+            return None
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _remove(self, entry_id: int):
+        key = self._entries.pop(entry_id)[0]
+        ids = self._by_key.get(key)
+        if ids is not None:
+            ids.discard(entry_id)
+            if not ids:
+                del self._by_key[key]
+
+    def lookup(self, material_id: int, num_flashcards: int, query_embedding, query: str | None = None) -> dict | None:
+        key = (material_id, num_flashcards)
+        vector = self._normalize(query_embedding)
+        text = normalize_query(query) if query else None
+        now = time.monotonic()
+        with self._lock:
+            best_id, best_similarity = None, -1.0
+            for entry_id in list(self._by_key.get(key, ())):
+                _, embedding, entry_text, _, expires_at = self._entries[entry_id]
+                if expires_at <= now:
+                    self._remove(entry_id)
+                    continue
+                if text is not None and entry_text == text:
+                    similarity = 1.0
+                elif embedding is not None and vector is not None:
+                    similarity = float(embedding @ vector)
+                else:
+                    continue
+                if similarity > best_similarity:
+                    best_id, best_similarity = entry_id, similarity
+
+            if best_id is None or 1.0 - best_similarity > self.max_distance:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best_id)
+            self.hits += 1
+            return self._entries[best_id][3]
+
+    def store(self, material_id: int, num_flashcards: int, query_embedding, response: dict, query: str | None = None):
+        key = (material_id, num_flashcards)
+        text = normalize_query(query) if query else None
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (key, self._normalize(query_embedding), text, response, time.monotonic() + self.ttl_s)
+            self._by_key.setdefault(key, set()).add(entry_id)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate_material(self, material_id: int):
+        with self._lock:
+            for key in [k for k in self._by_key if k[0] == material_id]:
+                for entry_id in list(self._by_key.get(key, ())):
+                    self._remove(entry_id)
+                    self.invalidations += 1
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "max_distance": self.max_distance,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+# Caché compartida de flashcards generadas
+flashcards_cache = SemanticResponseCache(RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_MAX_DISTANCE, RESPONSE_CACHE_TTL_S)
@@ -1,71 +1,138 @@
+import time
+import asyncio
 from fastapi import APIRouter, HTTPException, Query, Body, UploadFile, File
+from fastapi.responses import StreamingResponse
 import json
 import numpy as np
+from pydantic import BaseModel, Field
 
-from ..gemini import get_embedding, generate_flashcards, generate_feynman_feedback_from_context
-from ..speech import transcribe_audiofile
-from ..supabase import vector_search, get_raw_text, insert_chunks, insert_tool
+from ..config import (
+    EMBEDDING_BATCH_SIZE, EMBEDDING_CONCURRENCY, ANN_NPROBE,
+    CONTEXT_CANDIDATES_FACTOR, WHISPER_RETRIEVAL_WINDOW_CHARS, BATCH_MAX_ITEMS, BATCH_GENERATION_CONCURRENCY,
+)
+from ..gemini import (
+    aget_query_embedding, agenerate_flashcards, agenerate_feynman_feedback_from_context,
+    astream_flashcards, astream_feynman_feedback,
+)
+from ..speech import transcription_service, TranscriptionBusy
+from ..supabase_async import insert_tool, get_chunks_by_ids
+from ..ingestion import embed_material, finalize_material_index
+from ..context_builder import aretrieve_context, aretrieve_hits, build_context, merge_hits, choose_retrieval_mode
+from ..ann_index import ann_index
+from ..embedding_cache import embedding_cache
+from ..query_cache import query_embedding_memo
+from ..response_cache import flashcards_cache
+from ..gemini_scheduler import gemini_scheduler
+from ..streaming import sse_event, IncrementalArrayParser, SSE_HEADERS
+from ..batch_generation import iter_flashcards_batch
 
 router = APIRouter()
 
 @router.post("/material/{material_id}/create_embeddings")
-def create_embeddings(material_id: int):
+def create_embeddings(
+    material_id: int,
+    batch_size: int = Query(default=EMBEDDING_BATCH_SIZE, ge=1, le=100),
+    concurrency: int = Query(default=EMBEDDING_CONCURRENCY, ge=1, le=32)
+):
     """
     Genera y guarda los embeddings para todos los chunks de un material
     que aún no los tienen.
+    Los chunks se envían a Gemini en lotes (varios textos por llamada) con un número
+    acotado de lotes en paralelo, y cada lote se guarda con un único upsert.
+    Es reanudable: los chunks de un lote fallido siguen con embedding NULL,
+    así que volver a llamar a este endpoint procesa solo lo que falta.
     """
-    # NOTA: En la práctica, se necesitaría una función en supabase.py
-    # que recupere solo los chunks SIN embeddings.
-    # Por simplicidad y enfoque en el flujo, usamos la función get_raw_text
-    # y re-chunking (lo cual es ineficiente, pero sirve para el hackathon si la BD falla).
-    
-    # En un sistema real, se debería:
-    # 1. chunks = supabase.get_chunks_without_embeddings(material_id)
-    # 2. for chunk in chunks:
-    # 3.    emb = get_embedding(chunk['chunk_text'])
-    # 4.    supabase.update_chunk(chunk['id'], emb)
-    
     try:
-        from ..supabase import supabase # Acceso directo al cliente
-
-        response = supabase.table("material_chunks").select("id, chunk_text, embedding").eq("material_id", material_id).is_("embedding", None).execute()
-
-        # La librería supabase-py, cuando se usa sin el cliente 'Postgrest', devuelve una tupla donde [1] es la lista de resultados.
-        if isinstance(response, tuple) and len(response) > 1:
-            chunks = response[1] # <--- La lista de dicts (los chunks)
-        elif hasattr(response, 'data') and response.data is not None:
-             chunks = response.data
-        else:
-            chunks = []
-            
+        report = embed_material(material_id, batch_size=batch_size, concurrency=concurrency)
     except Exception as e:
-        raise HTTPException(500, detail=f"Fallo al recuperar chunks: {e}")
+        raise HTTPException(500, detail=f"Fallo al generar embeddings: {e}")
         
-    if not chunks:
+    if report is None:
         return {"status": "ok", "message": "No hay chunks sin embeddings para procesar."}
-    
-    processed_count = 0
-    for ch in chunks:
-        try:
-            emb = get_embedding(ch["chunk_text"])
-            if emb:
-                # Actualiza la columna 'embedding' en la fila específica
-                supabase.table("material_chunks").update({"embedding": emb}).eq("id", ch["id"]).execute()
-                processed_count += 1
-        except Exception as e:
-            print(f"Error procesando chunk {ch['id']}: {e}")
-            continue
-            
-    return {"status": "ok", "count": processed_count, "message": f"Embeddings generados para {processed_count} chunks."}
+
+    processed_count = report["processed"]
+    # Persiste los índices y, si los chunks del material cambiaron, invalida las flashcards cacheadas
+    finalize_material_index(material_id, changed=processed_count > 0)
+
+    return {
+        "status": "ok" if not report["failed_batches"] else "partial",
+        "count": processed_count,
+        "message": f"Embeddings generados para {processed_count} chunks.",
+        "cache_hits": report["cache_hits"],
+        "failed_count": report["failed"],
+        "failed_batches": report["failed_batches"],
+        "batches": report["batches"],
+        "elapsed_s": report["elapsed_s"],
+        "chunks_per_sec": report["chunks_per_sec"],
+    }
+
+
+@router.post("/user/{user_id}/search")
+async def search_library_route(
+    user_id: str,
+    query: str = Query(...),
+    top_k: int = Query(default=8, ge=1, le=100),
+    nprobe: int = Query(default=ANN_NPROBE, ge=1),
+    material_ids: list[int] | None = Query(default=None)
+):
+    """
+    Búsqueda semántica en TODA la biblioteca de un usuario (todos sus materiales)
+    usando el índice ANN. `nprobe` controla el equilibrio recall/latencia y
+    `material_ids` restringe la búsqueda a ciertos materiales.
+    """
+    if ann_index is None:
+        raise HTTPException(400, "El índice ANN no está habilitado (ANN_INDEX_ENABLED=true).")
+    try:
+        query_embedding = await aget_query_embedding(query)
+        if not query_embedding:
+            raise HTTPException(500, "Fallo al generar el embedding de la consulta.")
+
+        # La primera búsqueda del usuario en este proceso carga sus materiales ya embebidos desde Supabase
+        await asyncio.to_thread(ann_index.ensure_user, user_id)
+        # La búsqueda ANN es CPU (numpy): en un hilo para no frenar el resto de peticiones
+        hits = await asyncio.to_thread(
+            ann_index.search, query_embedding, k=top_k, nprobe=nprobe, user_id=user_id, material_ids=material_ids
+        )
+        texts = {row["id"]: row["chunk_text"] for row in await get_chunks_by_ids([h["id"] for h in hits])}
+
+        return {
+            "status": "success",
+            "user_id": user_id,
+            "query": query,
+            "results": [{**h, "chunk_text": texts.get(h["id"])} for h in hits if h["id"] in texts],
+        }
+
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        print(f"Error en search_library_route: {e}")
+        raise HTTPException(status_code=500, detail=f"Error en la búsqueda: {str(e)}")
+
+
+@router.get("/cache/stats")
+async def cache_stats_route():
+    """Estadísticas de las cachés de embeddings (aciertos, fallos, tasa de acierto)."""
+    return {
+        "query_embeddings": query_embedding_memo.stats(),
+        "chunk_embeddings": embedding_cache.stats() if embedding_cache else None,
+        "flashcards": flashcards_cache.stats(),
+    }
+
+
+@router.get("/gemini/stats")
+async def gemini_stats_route():
+    """Métricas del planificador de Gemini por lane: profundidad de cola, espera en cola, reintentos y 429."""
+    return gemini_scheduler.stats()
 
 
 # --- 2. Generación de Flashcards (Flujo RAG Completo) ---
 
 @router.post("/material/{material_id}/generate_flashcards")
-def generate_flashcards_route(
+async def generate_flashcards_route(
     material_id: int, 
     query: str = Query(default="Create study flashcards on key concepts"),
-    top_k: int = 4
+    top_k: int = 4,
+    num_flashcards: int = Query(default=6, ge=1, le=30)
 ):
     """
     Ejecuta el flujo RAG: 
@@ -73,39 +140,67 @@ def generate_flashcards_route(
     2. Busca chunks relevantes. 
     3. Llama a Gemini con el contexto. 
     4. Guarda las flashcards.
+    Si ya se generaron flashcards para una consulta semánticamente equivalente
+    (mismo material y número de flashcards) se devuelven directamente (cache_hit=True).
+    Una consulta corta de palabras clave ("fotosíntesis") se busca solo con BM25, sin embedding.
     """
     try:
-        # 1. Generar embedding de la consulta del usuario
-        query_embedding = get_embedding(query)
-        if not query_embedding:
-            raise HTTPException(500, "Fallo al generar el embedding de la consulta.")
+        # 1. Generar embedding de la consulta del usuario (salvo en la recuperación solo léxica)
+        mode = choose_retrieval_mode(query)
+        query_embedding = None
+        if mode != "lexical":
+            query_embedding = await aget_query_embedding(query)
+            if not query_embedding:
+                raise HTTPException(500, "Fallo al generar el embedding de la consulta.")
 
-        # 2. Recuperar top-k chunks relevantes (R: Retrieval)
-        # Esto llama a la función match_material_chunks en Supabase
-        context_chunks = vector_search(query_embedding, material_id, top_k)
-        
-        if not context_chunks:
+        # 1b. Caché semántica: consulta equivalente ya respondida -> sin retrieval ni LLM
+        cached = flashcards_cache.lookup(material_id, num_flashcards, query_embedding, query)
+        if cached is not None:
+            return {
+                "status": "success",
+                "material_id": material_id,
+                "query": query,
+                "flashcards": cached["flashcards"],
+                "context_chunks_count": cached["context_chunks_count"],
+                "context_tokens": cached.get("context_tokens"),
+                "save_count": 0,
+                "cache_hit": True
+            }
+
+        # 2. Recuperar candidatos relevantes (R: Retrieval): léxica, densa o híbrida (RETRIEVAL_MODE)
+        # 3. Construir el contexto para el LLM (A: Augmented): sin duplicados, diversificado
+        #    con MMR, chunks contiguos fusionados y acotado a CONTEXT_TOKEN_BUDGET tokens
+        built = await aretrieve_context(query, material_id, top_k, query_embedding=query_embedding, mode=mode)
+
+        if not built["selected"]:
             raise HTTPException(404, "No se encontraron fragmentos relevantes. ¿Se crearon los embeddings?")
-            
-        # 3. Construir el contexto para el LLM (A: Augmented)
-        context = "\n\n---\n\n".join(context_chunks)
+
+        context = built["context"]
 
         # 4. Generación de Flashcards (G: Generation)
-        flashcards_data = generate_flashcards(context=context, query=query, num_flashcards=6)
+        flashcards_data = await agenerate_flashcards(context=context, query=query, num_flashcards=num_flashcards)
         
         if not flashcards_data.get('flashcards'):
             raise HTTPException(500, "El modelo no devolvió la estructura de flashcards esperada.")
 
         # 5. Guardar la herramienta generada
-        save_count = insert_tool(material_id, "flashcards", flashcards_data)
+        save_count = await insert_tool(material_id, "flashcards", flashcards_data)
+        flashcards_cache.store(material_id, num_flashcards, query_embedding, {
+            "flashcards": flashcards_data,
+            "context_chunks_count": built["selected"],
+            "context_tokens": built["context_tokens"],
+        }, query)
         
         return {
             "status": "success",
             "material_id": material_id,
             "query": query,
             "flashcards": flashcards_data,
-            "context_chunks_count": len(context_chunks),
-            "save_count": save_count
+            "context_chunks_count": built["selected"],
+            "context_tokens": built["context_tokens"],
+            "retrieval_mode": built["retrieval_mode"],
+            "save_count": save_count,
+            "cache_hit": False
         }
 
     except HTTPException as e:
@@ -115,9 +210,124 @@ def generate_flashcards_route(
         raise HTTPException(status_code=500, detail=f"Error en el proceso RAG: {str(e)}")
 
 
+@router.post("/material/{material_id}/generate_flashcards/stream")
+async def generate_flashcards_stream_route(
+    material_id: int,
+    query: str = Query(default="Create study flashcards on key concepts"),
+    top_k: int = 4,
+    num_flashcards: int = Query(default=6, ge=1, le=30)
+):
+    """
+    Igual que generate_flashcards pero en streaming (Server-Sent Events).
+    Eventos: 'start' (de inmediato), 'context' (tras la recuperación), 'card' (cada flashcard
+    en cuanto su objeto JSON está completo), 'done' (al guardar) o 'error'.
+    Las flashcards se guardan con insert_tool solo si el stream termina completo.
+    """
+    async def events():
+        yield sse_event("start", {"material_id": material_id, "query": query})
+        try:
+            mode = choose_retrieval_mode(query)
+            query_embedding = None
+            if mode != "lexical":
+                query_embedding = await aget_query_embedding(query)
+                if not query_embedding:
+                    yield sse_event("error", {"status_code": 500, "detail": "Fallo al generar el embedding de la consulta."})
+                    return
+
+            cached = flashcards_cache.lookup(material_id, num_flashcards, query_embedding, query)
+            if cached is not None:
+                for card in cached["flashcards"].get("flashcards", []):
+                    yield sse_event("card", card)
+                yield sse_event("done", {"save_count": 0, "cache_hit": True,
+                                         "context_chunks_count": cached["context_chunks_count"]})
+                return
+
+            built = await aretrieve_context(query, material_id, top_k, query_embedding=query_embedding, mode=mode)
+            if not built["selected"]:
+                yield sse_event("error", {"status_code": 404, "detail": "No se encontraron fragmentos relevantes. ¿Se crearon los embeddings?"})
+                return
+            yield sse_event("context", {"context_chunks_count": built["selected"], "context_tokens": built["context_tokens"],
+                                        "retrieval_mode": built["retrieval_mode"]})
+
+            parser = IncrementalArrayParser("flashcards")
+            parts = []
+            async for text in astream_flashcards(context=built["context"], query=query, num_flashcards=num_flashcards):
+                parts.append(text)
+                for card in parser.feed(text):
+                    yield sse_event("card", card)
+
+            flashcards_data = json.loads("".join(parts))
+            if not flashcards_data.get('flashcards'):
+                yield sse_event("error", {"status_code": 500, "detail": "El modelo no devolvió la estructura de flashcards esperada."})
+                return
+
+            # El stream terminó completo: ahora sí se persiste
+            save_count = await insert_tool(material_id, "flashcards", flashcards_data)
+            flashcards_cache.store(material_id, num_flashcards, query_embedding, {
+                "flashcards": flashcards_data,
+                "context_chunks_count": built["selected"],
+                "context_tokens": built["context_tokens"],
+            }, query)
+            yield sse_event("done", {"save_count": save_count, "cache_hit": False,
+                                     "context_chunks_count": built["selected"]})
+
+        except Exception as e:
+            print(f"Error en generate_flashcards_stream_route: {e}")
+            yield sse_event("error", {"status_code": 500, "detail": f"Error en el proceso RAG: {str(e)}"})
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+class BatchFlashcardsItem(BaseModel):
+    material_id: int
+    query: str = "Create study flashcards on key concepts"
+    num_flashcards: int = Field(default=6, ge=1, le=30)
+    top_k: int = Field(default=4, ge=1, le=50)
+
+
+@router.post("/flashcards/batch")
+async def generate_flashcards_batch_route(
+    items: list[BatchFlashcardsItem] = Body(..., embed=True),
+    concurrency: int = Query(default=BATCH_GENERATION_CONCURRENCY, ge=1, le=64)
+):
+    """
+    Genera flashcards para muchos pares (material, consulta) en una sola petición (Server-Sent Events).
+    Body JSON: { "items": [{"material_id": 1, "query": "...", "num_flashcards": 6, "top_k": 4}, ...] }
+    Todas las consultas se embeben en una llamada a Gemini, la recuperación se hace una vez por
+    material y hasta `concurrency` generaciones corren a la vez (ver api/batch_generation.py).
+    Eventos: 'start', 'result' por ítem en cuanto termina (con su 'index' en la lista y 'status'
+    "success" o "error") y 'done' con el resumen. Cada ítem se guarda con insert_tool al completarse.
+    """
+    if not items:
+        raise HTTPException(400, "El lote está vacío.")
+    if len(items) > BATCH_MAX_ITEMS:
+        raise HTTPException(400, f"El lote supera el máximo de {BATCH_MAX_ITEMS} ítems.")
+
+    async def events():
+        start = time.perf_counter()
+        yield sse_event("start", {"items": len(items)})
+        ok = failed = cache_hits = 0
+        try:
+            async for result in iter_flashcards_batch([item.model_dump() for item in items], concurrency):
+                if result["status"] == "success":
+                    ok += 1
+                    cache_hits += result["cache_hit"]
+                else:
+                    failed += 1
+                yield sse_event("result", result)
+        except Exception as e:
+            print(f"Error en generate_flashcards_batch_route: {e}")
+            yield sse_event("error", {"status_code": 500, "detail": f"Error en el proceso RAG por lotes: {str(e)}"})
+            return
+        yield sse_event("done", {"ok": ok, "failed": failed, "cache_hits": cache_hits,
+                                 "elapsed_s": round(time.perf_counter() - start, 3)})
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
 # --- 3. Feedback Feynman (Flujo RAG + evaluación por Gemini) ---
 @router.post("/material/{material_id}/feynman_feedback")
-def feynman_feedback_route(
+async def feynman_feedback_route(
     material_id: int,
     topic: str = Query(default="Tema"),
     user_explanation: str = Body(..., embed=True)
@@ -128,30 +338,36 @@ def feynman_feedback_route(
     """
     try:
         # 1. Generar embedding para la explicación del usuario (combinada con topic)
+        #    BM25 usa solo el tema y la explicación: las palabras de la plantilla no discriminan
         combined_query = f"Tema: {topic}. Explicación del usuario: {user_explanation}"
-        query_embedding = get_embedding(combined_query)
-        if not query_embedding:
-            raise HTTPException(500, "Fallo al generar el embedding de la explicación del usuario.")
+        lexical_query = f"{topic} {user_explanation}"
+        mode = choose_retrieval_mode(lexical_query)
+        query_embedding = None
+        if mode != "lexical":
+            query_embedding = await aget_query_embedding(combined_query)
+            if not query_embedding:
+                raise HTTPException(500, "Fallo al generar el embedding de la explicación del usuario.")
 
-        # 2. Recuperar top-k chunks relevantes (R: Retrieval)
-        context_chunks = vector_search(query_embedding, material_id, limit=4)
-        if not context_chunks:
+        # 2-3. Recuperar chunks relevantes y construir el contexto para el LLM (ver api/context_builder.py)
+        built = await aretrieve_context(lexical_query, material_id, top_k=4, query_embedding=query_embedding, mode=mode)
+        if not built["selected"]:
             raise HTTPException(404, "No se encontraron fragmentos relevantes. ¿Se crearon los embeddings?")
 
-        # 3. Construir el contexto para el LLM
-        context = "\n\n---\n\n".join(context_chunks)
+        context = built["context"]
 
         # 4. Llamar a Gemini (solo generación a partir del contexto recuperado)
-        result = generate_feynman_feedback_from_context(context=context, topic=topic, user_explanation=user_explanation)
+        result = await agenerate_feynman_feedback_from_context(context=context, topic=topic, user_explanation=user_explanation)
 
         # 5. Guardar la herramienta generada
-        save_count = insert_tool(material_id, "feynman_feedback", result)
+        save_count = await insert_tool(material_id, "feynman_feedback", result)
 
         return {
             "status": "success",
             "material_id": material_id,
             "feedback": result.get("feedback"),
-            "context_chunks_count": len(context_chunks),
+            "context_chunks_count": built["selected"],
+            "context_tokens": built["context_tokens"],
+            "retrieval_mode": built["retrieval_mode"],
             "save_count": save_count
         }
 
@@ -162,6 +378,98 @@ def feynman_feedback_route(
         raise HTTPException(status_code=500, detail=f"Error en el proceso Feynman: {str(e)}")
 
 
+@router.post("/material/{material_id}/feynman_feedback/stream")
+async def feynman_feedback_stream_route(
+    material_id: int,
+    topic: str = Query(default="Tema"),
+    user_explanation: str = Body(..., embed=True)
+):
+    """
+    Igual que feynman_feedback pero en streaming (Server-Sent Events).
+    Eventos: 'start' (de inmediato), 'context', 'token' (cada fragmento de texto de Gemini),
+    'done' (con el feedback completo, tras guardarlo con insert_tool) o 'error'.
+    """
+    async def events():
+        yield sse_event("start", {"material_id": material_id, "topic": topic})
+        try:
+            combined_query = f"Tema: {topic}. Explicación del usuario: {user_explanation}"
+            lexical_query = f"{topic} {user_explanation}"
+            mode = choose_retrieval_mode(lexical_query)
+            query_embedding = None
+            if mode != "lexical":
+                query_embedding = await aget_query_embedding(combined_query)
+                if not query_embedding:
+                    yield sse_event("error", {"status_code": 500, "detail": "Fallo al generar el embedding de la explicación del usuario."})
+                    return
+
+            built = await aretrieve_context(lexical_query, material_id, top_k=4, query_embedding=query_embedding, mode=mode)
+            if not built["selected"]:
+                yield sse_event("error", {"status_code": 404, "detail": "No se encontraron fragmentos relevantes. ¿Se crearon los embeddings?"})
+                return
+            yield sse_event("context", {"context_chunks_count": built["selected"], "context_tokens": built["context_tokens"],
+                                        "retrieval_mode": built["retrieval_mode"]})
+
+            parts = []
+            async for text in astream_feynman_feedback(context=built["context"], topic=topic, user_explanation=user_explanation):
+                parts.append(text)
+                yield sse_event("token", {"text": text})
+
+            result = {"feedback": "".join(parts)}
+            save_count = await insert_tool(material_id, "feynman_feedback", result)
+            yield sse_event("done", {**result, "save_count": save_count})
+
+        except Exception as e:
+            print(f"Error en feynman_feedback_stream_route: {e}")
+            yield sse_event("error", {"status_code": 500, "detail": f"Error en el proceso Feynman: {str(e)}"})
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+async def _retrieve_window_hits(topic: str, text: str, material_id: int, top_k: int) -> list[dict]:
+    # Candidatos para un tramo de la transcripción (mismo formato de consulta que el flujo Feynman)
+    lexical_query = f"{topic} {text}"
+    mode = choose_retrieval_mode(lexical_query)
+    query_embedding = None
+    if mode != "lexical":
+        query_embedding = await aget_query_embedding(f"Tema: {topic}. Explicación del usuario: {text}")
+        if not query_embedding:
+            raise Exception("Fallo al generar el embedding de la explicación del usuario.")
+    hits, _ = await aretrieve_hits(lexical_query, material_id, top_k * max(1, CONTEXT_CANDIDATES_FACTOR),
+                                   query_embedding, mode)
+    return hits
+
+
+async def _transcribe_and_retrieve(content: bytes, topic: str, material_id: int, top_k: int, model_name: str):
+    """
+    Transcribe por segmentos (en paralelo) y, a medida que llegan los segmentos en orden,
+    lanza la recuperación de cada tramo de ~WHISPER_RETRIEVAL_WINDOW_CHARS caracteres
+    sin esperar al resto del audio. Al final se unen los candidatos de todos los tramos.
+    Un audio corto es un único segmento y un único tramo (igual que el flujo anterior).
+    """
+    texts = []
+    window = []
+    retrievals = []
+    try:
+        async for text in transcription_service.iter_segments(content, model_name=model_name, language="es"):
+            texts.append(text)
+            window.append(text)
+            if sum(len(t) for t in window) >= WHISPER_RETRIEVAL_WINDOW_CHARS:
+                retrievals.append(asyncio.create_task(
+                    _retrieve_window_hits(topic, " ".join(window), material_id, top_k)
+                ))
+                window = []
+        user_explanation = " ".join(t for t in texts if t).strip()
+        if window and user_explanation:
+            retrievals.append(asyncio.create_task(
+                _retrieve_window_hits(topic, " ".join(window), material_id, top_k)
+            ))
+        hit_lists = await asyncio.gather(*retrievals)
+    finally:
+        for task in retrievals:
+            task.cancel()
+    return user_explanation, merge_hits(hit_lists)
+
+
 @router.post("/material/{material_id}/feynman_feedback_audio")
 async def feynman_feedback_audio_route(
     material_id: int,
@@ -175,36 +483,33 @@ async def feynman_feedback_audio_route(
     Requiere que 'openai-whisper' esté instalado en el servidor.
     """
     try:
-        # 0. Transcribir audio a texto
-        user_explanation = await transcribe_audiofile(file, model_name=model_name, language="es")
+        # 0-3. Transcribir el audio por segmentos y recuperar contexto mientras tanto
+        content = await file.read()
+        try:
+            user_explanation, hits = await _transcribe_and_retrieve(content, topic, material_id, top_k, model_name)
+        except TranscriptionBusy as e:
+            raise HTTPException(status_code=503, detail=str(e))
         if not user_explanation:
             raise HTTPException(status_code=400, detail="No se pudo transcribir el audio o el texto resultante está vacío.")
 
-        # 1. Generar embedding para la explicación del usuario (combinada con topic)
-        combined_query = f"Tema: {topic}. Explicación del usuario: {user_explanation}"
-        query_embedding = get_embedding(combined_query)
-        if not query_embedding:
-            raise HTTPException(500, "Fallo al generar el embedding de la explicación del usuario.")
-
-        # 2. Recuperar top-k chunks relevantes (R: Retrieval)
-        context_chunks = vector_search(query_embedding, material_id, top_k)
-        if not context_chunks:
+        built = build_context(hits, max_chunks=top_k)
+        if not built["selected"]:
             raise HTTPException(404, "No se encontraron fragmentos relevantes. ¿Se crearon los embeddings?")
 
-        # 3. Construir el contexto para el LLM
-        context = "\n\n---\n\n".join(context_chunks)
+        context = built["context"]
 
         # 4. Llamar a Gemini (solo generación a partir del contexto recuperado)
-        result = generate_feynman_feedback_from_context(context=context, topic=topic, user_explanation=user_explanation)
+        result = await agenerate_feynman_feedback_from_context(context=context, topic=topic, user_explanation=user_explanation)
 
         # 5. Guardar la herramienta generada
-        save_count = insert_tool(material_id, "feynman_feedback", result)
+        save_count = await insert_tool(material_id, "feynman_feedback", result)
 
         return {
             "status": "success",
             "material_id": material_id,
             "feedback": result.get("feedback"),
-            "context_chunks_count": len(context_chunks),
+            "context_chunks_count": built["selected"],
+            "context_tokens": built["context_tokens"],
             "save_count": save_count
         }
 
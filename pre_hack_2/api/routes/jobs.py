@@ -0,0 +1,42 @@
+from fastapi import APIRouter, UploadFile, File, HTTPException
+from fastapi.concurrency import run_in_threadpool
+
+from ..jobs import job_runner, job_store, job_status
+
+router = APIRouter()
+
+@router.post("/jobs/upload_pdf")
+async def upload_pdf_job(user_id: str, title: str, file: UploadFile = File(...)):
+    """
+    Encola la ingesta completa de un PDF (extract -> chunk -> embed -> index)
+    y devuelve el id del job de inmediato. El avance se consulta en /jobs/{job_id}.
+    """
+    try:
+        content = await file.read()
+        job_id = await run_in_threadpool(job_runner.submit, content, user_id, title, file.filename)
+        return {"job_id": job_id, "status": "queued"}
+
+    except Exception as e:
+        print(f"Error al encolar el job de ingesta: {e}")
+        raise HTTPException(status_code=500, detail=f"Error interno: {str(e)}")
+
+
+@router.get("/jobs/{job_id}")
+def get_job_route(job_id: str):
+    """Estado de un job de ingesta: etapa actual, progreso, contadores y tiempos por etapa."""
+    job = job_store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job no encontrado.")
+    return job_status(job)
+
+
+@router.post("/jobs/{job_id}/retry")
+def retry_job_route(job_id: str):
+    """Vuelve a encolar un job fallido; se reanuda desde el último progreso guardado."""
+    job = job_store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job no encontrado.")
+    if not job_store.retry(job_id):
+        raise HTTPException(status_code=409, detail=f"Solo se pueden reintentar jobs fallidos (estado: {job['status']}).")
+    job_runner.wake()
+    return {"job_id": job_id, "status": "queued"}
@@ -1,66 +1,73 @@
 from fastapi import APIRouter, UploadFile, File, HTTPException
-import io
-import hashlib
+from fastapi.concurrency import run_in_threadpool
 
-from ..supabase import insert_material, insert_chunks, upload_pdf_to_storage
-from ..gemini import get_embedding
-from ..config import EMBEDDING_DIM
-from ..pypdf_utils import extract_text_from_bytes
-from ..text_processing import split_text_simple
+from ..ingestion import ingest_pdf, replace_material_pdf, embed_material, finalize_material_index
 
 router = APIRouter()
 
 @router.post("/upload_pdf")
 async def upload_pdf(user_id: str, title: str, file: UploadFile = File(...)):
-    
+
     #1.Recibe el PDF. 2. Guarda en Storage. 3. Extrae texto. 4. Guarda Material. 5. Crea Chunks.
-    
+    #La extracción y el chunking son incrementales (página a página) y los chunks se insertan
+    #en lotes de INGEST_BATCH_SIZE, así la memoria no depende del tamaño del documento.
+    #Nada bloqueante corre en el event loop: la ingesta se ejecuta en el threadpool y,
+    #dentro de ella, la subida a Storage y la extracción de texto corren a la vez.
+    #Si el mismo PDF ya se ingirió (mismo sha256) se clona ese material en lugar de procesarlo.
+    #Esta ruta sigue siendo síncrona a propósito: los clientes actuales usan el material_id de la
+    #respuesta y luego llaman a create_embeddings. La variante asíncrona es POST /jobs/upload_pdf,
+    #que devuelve un job_id de inmediato y además genera los embeddings (ver api/jobs.py).
+
     try:
         content = await file.read()
-        pdf_bytes = io.BytesIO(content)
-        
-        # 1. Guarda en Supabase Storage
-        public_url = upload_pdf_to_storage(user_id, file.filename, pdf_bytes)
-        if not public_url: 
-            raise HTTPException(status_code=500, detail="Fallo al subir el archivo a Supabase Storage.")
-        
-        # 2. Extraer texto (volvemos a leer desde el inicio del buffer)
-        pdf_bytes.seek(0)
-        raw_text = extract_text_from_bytes(pdf_bytes.read())
-        
-        if not raw_text or len(raw_text.strip()) < 100:
-             raise HTTPException(status_code=400, detail="El PDF no contiene suficiente texto extraíble.")
+        result = await run_in_threadpool(ingest_pdf, content, user_id, title, file.filename)
 
-        # 3. Inserta registro de material (obtenemos el material_id)
-        material_id = insert_material(user_id, title, public_url, raw_text)
-        if not material_id:
-            raise HTTPException(status_code=500, detail="Fallo al insertar el registro del material.")
+        return {
+            "material_id": result["material_id"],
+            "message": "Archivo procesado y chunks creados.",
+            "chunks_count": result["chunks_count"],
+            "pages_count": result["pages_count"],
+            # Material del que se copiaron chunks y embeddings si el PDF ya se había subido
+            "deduplicated_from": result.get("deduplicated_from")
+        }
+
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        print(f"Error general en upload_pdf: {e}")
+        raise HTTPException(status_code=500, detail=f"Error interno: {str(e)}")
 
-        # 4. Chunking: Dividir el texto
-        chunks = split_text_simple(raw_text)
-        
-        # 5. Preparar Chunks para inserción (Opcional: Generación de embeddings AQUÍ para mayor velocidad)
-        chunks_to_insert = []
-        for c in chunks:
-            chunk_hash = hashlib.sha256(c.encode('utf-8')).hexdigest()
-            # NOTA: Por ahora, solo insertamos texto y hash. Los embeddings se crean en /create_embeddings.
-            chunks_to_insert.append({
-                "chunk_text": c,
-                "chunk_hash": chunk_hash,
-                # "embedding": get_embedding(c) # <- Descomentar para pre-computar (más rápido)
-            })
 
-        # 6. Insertar chunks
-        count = insert_chunks(material_id, chunks_to_insert)
+@router.post("/material/{material_id}/replace_pdf")
+async def replace_pdf(material_id: int, file: UploadFile = File(...)):
+    """
+    Reemplaza el PDF de un material por una versión revisada.
+    Solo se insertan y embeben los chunks nuevos y se borran los que desaparecieron;
+    los chunks sin cambios conservan su embedding.
+    """
+    try:
+        content = await file.read()
+        result = await run_in_threadpool(replace_material_pdf, material_id, content, file.filename)
+
+        # Embeddings solo para los chunks nuevos (los que quedaron con embedding NULL)
+        report = await run_in_threadpool(embed_material, material_id)
+        await run_in_threadpool(finalize_material_index, material_id, True)
 
         return {
-            "material_id": material_id, 
-            "message": "Archivo procesado y chunks creados.",
-            "chunks_count": count
+            **result,
+            "message": "Material actualizado.",
+            "embedded": report["processed"] if report else 0,
+            "failed_batches": report["failed_batches"] if report else []
         }
 
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except HTTPException as e:
         raise e
     except Exception as e:
-        print(f"Error general en upload_pdf: {e}")
-        raise HTTPException(status_code=500, detail=f"Error interno: {str(e)}")
\ No newline at end of file
+        print(f"Error general en replace_pdf: {e}")
+        raise HTTPException(status_code=500, detail=f"Error interno: {str(e)}")
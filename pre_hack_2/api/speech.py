@@ -1,39 +1,294 @@
+import os
+import asyncio
 import tempfile
+import threading
+import subprocess
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 from fastapi import UploadFile
-import os
 
-_whisper_model = None
+from .config import (
+    WHISPER_WORKERS, WHISPER_QUEUE_SIZE, WHISPER_QUEUE_TIMEOUT_S,
+    WHISPER_WARM_MODELS, WHISPER_MAX_MODEL_MEMORY_MB, WHISPER_TORCH_THREADS,
+    WHISPER_SEGMENT_TARGET_S, WHISPER_SEGMENT_MAX_S, WHISPER_MIN_SILENCE_S,
+)
+from .metrics import trace
+
+# Transcripción con Whisper (local) en un pool de procesos dedicado.
+# Cada worker mantiene su propio pool de modelos por nombre (LRU acotado por memoria):
+# un mismo modelo de Whisper no se puede usar desde dos hilos a la vez (los hooks
+# de kv-cache se instalan sobre el modelo compartido), así que el paralelismo es por proceso.
+
+SAMPLE_RATE = 16000
+
+
+class TranscriptionBusy(RuntimeError):
+    """La cola de transcripción está llena (backpressure): el cliente debe reintentar más tarde."""
+
 
-def _load_whisper_model(model_name: str = "small"):
-    global _whisper_model
-    if _whisper_model is None:
+def decode_audio(content: bytes, sample_rate: int = SAMPLE_RATE) -> np.ndarray:
+    """
+    Decodifica el audio en memoria a PCM mono float32 a `sample_rate` Hz (el formato que espera Whisper).
+    ffmpeg lee los bytes por stdin; solo si el contenedor necesita seek (p. ej. m4a con el
+    índice al final) se recurre a un archivo temporal.
+    """
+    cmd = [
+        "ffmpeg", "-loglevel", "error", "-threads", "0", "-i", "{input}",
+        "-f", "s16le", "-ac", "1", "-acodec", "pcm_s16le", "-ar", str(sample_rate), "-",
+    ]
+    try:
+        out = subprocess.run([c.replace("{input}", "pipe:0") for c in cmd], input=content, capture_output=True, check=True).stdout
+    except FileNotFoundError:
+        raise RuntimeError("ffmpeg no está instalado; Whisper lo necesita para decodificar el audio.")
+    except subprocess.CalledProcessError:
+        with tempfile.NamedTemporaryFile(delete=False) as tmp:
+            tmp.write(content)
+            tmp_path = tmp.name
         try:
-            import whisper
-        except Exception as e:
-            raise ImportError("Whisper no está instalado. Instala 'openai-whisper' y sus dependencias (torch).")
-        _whisper_model = whisper.load_model(model_name)
-    return _whisper_model
+            out = subprocess.run([c.replace("{input}", tmp_path) for c in cmd], capture_output=True, check=True).stdout
+        except subprocess.CalledProcessError as e:
+            raise ValueError(f"No se pudo decodificar el audio: {e.stderr.decode(errors='replace').strip()}")
+        finally:
+            os.unlink(tmp_path)
+    return np.frombuffer(out, np.int16).astype(np.float32) / 32768.0
 
-async def transcribe_audiofile(upload_file: UploadFile, model_name: str = "small", language: str = "es") -> str:
+
+def split_on_silence(audio: np.ndarray, sample_rate: int = SAMPLE_RATE,
+                     target_s: float = WHISPER_SEGMENT_TARGET_S, max_s: float = WHISPER_SEGMENT_MAX_S,
+                     min_silence_s: float = WHISPER_MIN_SILENCE_S, frame_ms: int = 30) -> list[tuple[int, int]]:
     """
-    Transcribe an uploaded audio file using OpenAI Whisper (local).
-    Returns the transcribed text.
-    Raises informative errors if whisper/torch are not available.
+    VAD por energía: divide el audio en segmentos de ~target_s segundos (nunca más de max_s)
+    cortando en el medio de un silencio de al menos min_silence_s.
+    El umbral de silencio se adapta a cada grabación (entre el ruido de fondo y el nivel de voz).
+    Retorna rangos de muestras (inicio, fin); los segmentos sin voz se omiten
+    (Whisper tiende a inventar texto sobre el silencio).
     """
-    # Save to a temporary file
-    suffix = os.path.splitext(upload_file.filename or "")[1] or ".wav"
-    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-        content = await upload_file.read()
-        tmp.write(content)
-        tmp_path = tmp.name
+    frame = int(sample_rate * frame_ms / 1000)
+    n_frames = len(audio) // frame
+    if n_frames == 0:
+        return [(0, len(audio))] if len(audio) else []
+    energy = np.square(audio[:n_frames * frame].reshape(n_frames, frame), dtype=np.float32).mean(axis=1)
+    db = 10 * np.log10(energy + 1e-10)
+    floor, speech = np.percentile(db, 10), np.percentile(db, 90)
+    if speech < -60:
+        # Prácticamente silencio absoluto: nada que transcribir
+        return []
+    silent = db < floor + 0.3 * (speech - floor)
+    if speech - floor < 6:
+        # Sin contraste suficiente (todo voz o todo ruido): sin cortes por silencio
+        silent[:] = False
+
+    # Candidatos de corte: el centro de cada silencio lo bastante largo
+    min_run = max(1, int(min_silence_s * 1000 / frame_ms))
+    cuts = []
+    edges = np.flatnonzero(np.diff(np.concatenate([[0], silent.astype(np.int8), [0]])))
+    for start, end in zip(edges[::2], edges[1::2]):
+        if end - start >= min_run:
+            cuts.append((start + end) // 2)
+
+    target, longest = int(target_s * 1000 / frame_ms), int(max_s * 1000 / frame_ms)
+    segments = []
+    start = 0
+    while n_frames - start > longest:
+        window = [c for c in cuts if start + target // 2 <= c <= start + longest]
+        end = min(window, key=lambda c: abs(c - (start + target))) if window else start + longest
+        segments.append((start, end))
+        start = end
+    segments.append((start, n_frames))
+
+    voiced = [(a, b) for a, b in segments if not silent[a:b].all()]
+    ranges = [(a * frame, b * frame) for a, b in voiced]
+    if ranges and voiced[-1][1] == n_frames:
+        ranges[-1] = (ranges[-1][0], len(audio))
+    return ranges
+
+
+# --- Estado de cada proceso worker ---
+
+_models: OrderedDict = OrderedDict()  # model_name -> modelo (orden LRU)
+_model_bytes: dict[str, int] = {}
+_max_model_bytes = 0
 
+
+def _model_size(model) -> int:
+    return sum(p.numel() * p.element_size() for p in model.parameters())
+
+
+def _get_model(model_name: str):
+    # Pool de modelos por nombre: respeta model_name y expulsa los menos usados si se pasa de memoria
+    model = _models.get(model_name)
+    if model is not None:
+        _models.move_to_end(model_name)
+        return model
     try:
-        model = _load_whisper_model(model_name)
-        result = model.transcribe(tmp_path, language=language)
-        text = result.get("text", "").strip()
-        return text
-    finally:
+        import whisper
+    except Exception:
+        raise ImportError("Whisper no está instalado. Instala 'openai-whisper' y sus dependencias (torch).")
+    model = whisper.load_model(model_name)
+    _models[model_name] = model
+    _model_bytes[model_name] = _model_size(model)
+    while len(_models) > 1 and sum(_model_bytes.values()) > _max_model_bytes:
+        evicted, _ = _models.popitem(last=False)
+        _model_bytes.pop(evicted, None)
+        print(f"Whisper: modelo '{evicted}' expulsado del pool (límite de memoria).")
+    return model
+
+
+def _init_worker(warm_models: list[str], max_model_bytes: int, torch_threads: int):
+    global _max_model_bytes
+    _max_model_bytes = max_model_bytes
+    try:
+        if torch_threads > 0:
+            import torch
+            torch.set_num_threads(torch_threads)
+        for model_name in warm_models:
+            _get_model(model_name)
+    except Exception as e:
+        # Un fallo aquí rompería el pool entero: el error real aparecerá en la primera transcripción
+        print(f"Error precargando modelos de Whisper: {e}")
+
+
+def _warm():
+    return sorted(_models)
+
+
+def _transcribe(audio, model_name: str, language: str) -> str:
+    # Corre en el worker: `audio` son los bytes del archivo o el PCM ya decodificado
+    if isinstance(audio, bytes):
+        audio = decode_audio(audio)
+    model = _get_model(model_name)
+    result = model.transcribe(audio, language=language)
+    return result.get("text", "").strip()
+
+
+class TranscriptionService:
+    """
+    Pool de procesos para Whisper con cola acotada.
+    Como máximo `queue_size` transcripciones esperan o corren a la vez; si la cola está llena
+    submit() espera hasta `queue_timeout_s` y luego lanza TranscriptionBusy.
+    """
+
+    def __init__(self, workers: int, queue_size: int, queue_timeout_s: float,
+                 warm_models: list[str], max_model_memory_mb: int, torch_threads: int):
+        self.workers = max(1, workers)
+        self.queue_timeout_s = queue_timeout_s
+        self.warm_models = warm_models
+        self.max_model_bytes = max_model_memory_mb * 1024 * 1024
+        self.torch_threads = torch_threads
+        self._slots = threading.BoundedSemaphore(max(self.workers, queue_size))
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                # spawn: torch no se lleva bien con fork una vez inicializado
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_worker,
+                    initargs=(self.warm_models, self.max_model_bytes, self.torch_threads),
+                )
+            return self._pool
+
+    def start(self):
+        # Con modelos a precargar arranca los workers ya (cada uno los carga en su initializer);
+        # sin ellos no hace nada: el pool se crea con la primera transcripción (_get_pool)
+        if not self.warm_models:
+            return
+        pool = self._get_pool()
+        for _ in range(self.workers):
+            pool.submit(_warm)
+
+    def stop(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
+
+    def _acquire(self):
+        if not self._slots.acquire(timeout=self.queue_timeout_s):
+            raise TranscriptionBusy("Demasiadas transcripciones en curso, intenta de nuevo en unos segundos.")
+
+    def submit(self, fn, *args):
+        self._acquire()
         try:
-            os.unlink(tmp_path)
-        except Exception:
-            pass
+            future = self._get_pool().submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    async def transcribe(self, content: bytes, model_name: str = "small", language: str = "es") -> str:
+        # La espera por un hueco en la cola también se hace fuera del event loop
+        with trace("speech.queue_wait"):
+            future = await asyncio.to_thread(self.submit, _transcribe, content, model_name, language)
+        with trace("speech.transcribe"):
+            return await asyncio.wrap_future(future)
+
+    async def iter_segments(self, content: bytes, model_name: str = "small", language: str = "es",
+                            max_in_flight: int | None = None):
+        """
+        Transcripción segmentada para grabaciones largas: el audio se corta en los silencios
+        (split_on_silence) y los segmentos se transcriben en paralelo en el pool, como máximo
+        `max_in_flight` a la vez (por defecto, uno por worker): una grabación larga no llena la
+        cola del pool por delante de las demás transcripciones.
+        Genera el texto de cada segmento en orden en cuanto está listo, así quien consume
+        puede empezar a trabajar con los primeros mientras los siguientes se transcriben.
+        Toda la grabación ocupa un único lugar en la cola.
+        """
+        with trace("speech.decode"):
+            audio = await asyncio.to_thread(decode_audio, content)
+            segments = await asyncio.to_thread(split_on_silence, audio)
+        with trace("speech.queue_wait"):
+            await asyncio.to_thread(self._acquire)
+        window = max(1, max_in_flight or self.workers)
+        remaining = iter(segments)
+        futures = deque()
+        try:
+            pool = self._get_pool()
+
+            def _fill():
+                # Mantiene `window` segmentos enviados al pool (en vuelo o esperando un worker)
+                while len(futures) < window:
+                    segment = next(remaining, None)
+                    if segment is None:
+                        return
+                    start, end = segment
+                    futures.append(pool.submit(_transcribe, audio[start:end], model_name, language))
+
+            _fill()
+            # Hasta el último segmento (los tiempos de quien consume entre segmentos quedan incluidos)
+            with trace("speech.transcribe"):
+                while futures:
+                    text = await asyncio.wrap_future(futures[0])
+                    futures.popleft()
+                    # El siguiente segmento entra antes de entregar el texto: el pool sigue ocupado mientras se consume
+                    _fill()
+                    yield text
+        finally:
+            for future in futures:
+                future.cancel()
+            self._slots.release()
+
+
+# Instancia única (los workers se arrancan en el lifespan de la app, ver api/main.py)
+transcription_service = TranscriptionService(
+    WHISPER_WORKERS, WHISPER_QUEUE_SIZE, WHISPER_QUEUE_TIMEOUT_S,
+    WHISPER_WARM_MODELS, WHISPER_MAX_MODEL_MEMORY_MB, WHISPER_TORCH_THREADS,
+)
+
+
+async def transcribe_audiofile(upload_file: UploadFile, model_name: str = "small", language: str = "es") -> str:
+    """
+    Transcribe an uploaded audio file using OpenAI Whisper (local).
+    Returns the transcribed text.
+    The audio is decoded in memory and transcribed in the Whisper worker pool,
+    so the event loop is never blocked. Raises TranscriptionBusy when the queue is full.
+    """
+    content = await upload_file.read()
+    return await transcription_service.transcribe(content, model_name=model_name, language=language)
@@ -0,0 +1,81 @@
+import json
+
+# Utilidades para las rutas en streaming (Server-Sent Events)
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    # Evita que nginx (u otro proxy) acumule la respuesta antes de enviarla
+    "X-Accel-Buffering": "no",
+}
+
+
+def sse_event(event: str, data) -> str:
+    # Un evento SSE: nombre + una línea de datos JSON, terminado en línea vacía
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+class IncrementalArrayParser:
+    """
+    Parser JSON incremental para respuestas del tipo {"<clave>": [{...}, {...}, ...]}.
+    Se le pasan los fragmentos de texto a medida que llegan (feed) y devuelve cada
+    objeto del arreglo en cuanto su llave de cierre aparece, sin esperar al resto.
+
+    Solo sigue strings (con escapes) y la pila de anidamiento, así que cada carácter
+    se examina una vez; el texto ya consumido se descarta.
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self._buffer = ""
+        self._pos = 0
+        self._stack: list[str] = []
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        self._last_string = None
+        self._array_depth = None  # profundidad de la pila dentro del arreglo buscado
+        self._item_start = None
+
+    def feed(self, text: str) -> list[dict]:
+        self._buffer += text
+        items = []
+        buffer = self._buffer
+        i = self._pos
+        while i < len(buffer):
+            ch = buffer[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    self._last_string = buffer[self._string_start:i]
+            elif ch == '"':
+                self._in_string = True
+                self._string_start = i + 1
+            elif ch in "{[":
+                if ch == "[" and self._array_depth is None and self._last_string == self.key and self._stack == ["{"]:
+                    self._array_depth = len(self._stack) + 1
+                elif ch == "{" and self._array_depth is not None and len(self._stack) == self._array_depth:
+                    self._item_start = i
+                self._stack.append(ch)
+            elif ch in "}]":
+                if self._stack:
+                    self._stack.pop()
+                if ch == "}" and self._item_start is not None and len(self._stack) == self._array_depth:
+                    items.append(json.loads(buffer[self._item_start:i + 1]))
+                    self._item_start = None
+                elif ch == "]" and self._array_depth is not None and len(self._stack) == self._array_depth - 1:
+                    self._array_depth = None
+            i += 1
+
+        # Descarta lo ya consumido (se conserva desde el objeto o string en curso)
+        keep = min(p for p in (self._item_start, self._string_start if self._in_string else None, i) if p is not None)
+        self._buffer = buffer[keep:]
+        self._pos = i - keep
+        if self._item_start is not None:
+            self._item_start -= keep
+        if self._in_string:
+            self._string_start -= keep
+        return items
@@ -1,6 +1,15 @@
 import io
+import json
+from collections import Counter
+from postgrest import APIError
 from supabase import create_client, Client
-from .config import SUPABASE_URL, SUPABASE_API_KEY, SUPABASE_BUCKET_NAME
+from .config import (
+    SUPABASE_URL, SUPABASE_API_KEY, SUPABASE_BUCKET_NAME, VECTOR_MATCH_THRESHOLD,
+    CHUNK_INSERT_BATCH_ROWS, CHUNK_INSERT_BATCH_KB, CHUNK_INSERT_CONCURRENCY, CHUNK_INSERT_MAX_RETRIES,
+    CHUNK_INSERT_BACKOFF_BASE_S, CHUNK_INSERT_BACKOFF_MAX_S,
+)
+from .chunk_writer import ChunkWriter
+from .metrics import trace, traced
 
 # 1. Inicialización del Cliente Supabase
 # Se crea una única instancia del cliente de Supabase para toda la aplicación, esto siguiendo el patrón singleton.
@@ -14,7 +23,9 @@ except Exception as e:
 # Funciones de storage de Supabase
 # api/supabase.py
 
-def upload_pdf_to_storage(user_id: str, file_name: str, file_content: io.BytesIO):
+@traced("supabase.upload_pdf_to_storage")
+def upload_pdf_to_storage(user_id: str, file_name: str, file_content: io.BytesIO, upsert: bool = False):
+    # upsert=True sobrescribe un archivo existente en la misma ruta (p. ej. al reemplazar un PDF)
     storage_path = f"{user_id}/{file_name}"
 
     try: 
@@ -25,7 +36,7 @@ def upload_pdf_to_storage(user_id: str, file_name: str, file_content: io.BytesIO
         bucket_client.upload(
             file=file_content.read(),
             path=storage_path,
-            file_options={"content-type": "application/pdf"}
+            file_options={"content-type": "application/pdf", "upsert": "true" if upsert else "false"}
         )
 
         # -----------------------------------------------------------
@@ -46,6 +57,7 @@ def upload_pdf_to_storage(user_id: str, file_name: str, file_content: io.BytesIO
         raise Exception("Fallo al subir el archivo a Supabase Storage.")
 
 #Funciones de Database (Supabase - PostgreSQL y pgvector)
+@traced("supabase.insert_material")
 def insert_material(user_id: str, title: str, pdf_url: str, raw_text: str):
     #Inserta el registro del documento principal en la tabla 'materials
     data, count = supabase.table("materials").insert({
@@ -60,44 +72,235 @@ def insert_material(user_id: str, title: str, pdf_url: str, raw_text: str):
         return data[1][0]['id'] # Retorna el ID del material recién creado
     return None
 
-def insert_chunks(material_id: int, chunks_to_insert: list):
-    # Inserta los fragmentos (chunk_text, hash y embedding) en la tabla 'material_chunks'.
-    # chunks_to_insert es una lista de diccionarios, cada uno con 'chunk_text', 'chunk_hash', 'embedding'
-    
-    # Obtenemos la cantidad de chunks que vamos a insertar
-    num_chunks = len(chunks_to_insert) # Guardamos el número
+@traced("supabase.update_material_raw_text")
+def update_material_raw_text(material_id: int, raw_text: str):
+    # Actualiza el texto completo de un material (la ingesta por streaming lo guarda al final)
+    supabase.table("materials").update({"raw_text": raw_text}).eq("id", material_id).execute()
 
-    # Añadimos el material_id a cada diccionario
-    data_to_insert = [{"material_id": material_id, **chunk} for chunk in chunks_to_insert]
-    
+@traced("supabase.update_material")
+def update_material(material_id: int, fields: dict):
+    # Actualiza columnas de un material (p. ej. pdf_url al reemplazar el PDF)
+    supabase.table("materials").update(fields).eq("id", material_id).execute()
+
+@traced("supabase.find_material_by_content_hash")
+def find_material_by_content_hash(content_hash: str):
+    # Material ya ingerido con el mismo PDF (sha256 de los bytes), o None.
+    # content_hash solo se guarda cuando la ingesta termina, así nunca se clona un material a medias
     try:
-        # Ejecutamos la inserción sin intentar capturar el recuento directamente
-        supabase.table('material_chunks').insert(data_to_insert).execute()
-        
-        # Devolvemos el número de elementos que SABEMOS que insertamos
-        return num_chunks # Devolvemos el entero
-    
+        response = (
+            supabase.table('materials')
+            .select('id, pdf_url')
+            .eq('content_hash', content_hash)
+            .order('id')
+            .limit(1)
+            .execute()
+        )
     except Exception as e:
-        # Manejo de errores en la inserción
-        print(f"Error al insertar chunks: {e}")
-        return 0 # Devuelve 0 en caso de fallo
+        # Sin la columna content_hash la deduplicación simplemente no se aplica
+        print(f"Error al buscar material por content_hash: {e}")
+        return None
+    return response.data[0] if response.data else None
+
+@traced("supabase.set_material_content_hash")
+def set_material_content_hash(material_id: int, content_hash: str | None):
+    try:
+        supabase.table("materials").update({"content_hash": content_hash}).eq("id", material_id).execute()
+        return 1
+    except Exception as e:
+        print(f"Error al guardar content_hash: {e}")
+        return 0
+
+@traced("supabase.is_pdf_shared")
+def is_pdf_shared(material_id: int):
+    # True si otro material apunta al mismo PDF en Storage (uploads deduplicados)
+    response = supabase.table('materials').select('pdf_url').eq('id', material_id).limit(1).execute()
+    if not response.data or not response.data[0].get('pdf_url'):
+        return False
+    others = (
+        supabase.table('materials')
+        .select('id')
+        .eq('pdf_url', response.data[0]['pdf_url'])
+        .neq('id', material_id)
+        .limit(1)
+        .execute()
+    )
+    return bool(others.data)
+
+@traced("supabase.clone_chunks")
+def clone_chunks(source_material_id: int, target_material_id: int):
+    """
+    Copia los chunks (con su embedding) de un material a otro dentro de Postgres con el RPC
+    clone_material_chunks, sin que los vectores pasen por la red ni por Python:
+
+        create or replace function clone_material_chunks(source_material_id bigint, target_material_id bigint)
+        returns integer language sql as $$
+          with copied as (
+            insert into material_chunks (material_id, chunk_text, chunk_hash, token_count, page_start, page_end, embedding)
+            select target_material_id, chunk_text, chunk_hash, token_count, page_start, page_end, embedding
+            from material_chunks where material_id = source_material_id order by id
+            returning 1
+          )
+          select count(*)::integer from copied;
+        $$;
+
+    Es una sola transacción: se copian todas las filas o ninguna.
+    Retorna las filas copiadas, o None si el RPC no está instalado (PGRST202).
+    """
+    try:
+        response = supabase.rpc('clone_material_chunks', {
+            'source_material_id': source_material_id,
+            'target_material_id': target_material_id,
+        }).execute()
+    except APIError as e:
+        if e.code == 'PGRST202':
+            return None
+        raise
+    return int(response.data or 0)
+
+@traced("supabase.get_material_page_count")
+def get_material_page_count(material_id: int):
+    # Última página con texto del material (page_end máximo de sus chunks)
+    response = (
+        supabase.table('material_chunks')
+        .select('page_end')
+        .eq('material_id', material_id)
+        .order('page_end', desc=True)
+        .limit(1)
+        .execute()
+    )
+    return (response.data[0]['page_end'] or 0) if response.data else 0
+
+@traced("supabase.get_chunks_for_clone")
+def get_chunks_for_clone(material_id: int, page_size: int = 1000):
+    # Todas las columnas de contenido de los chunks de un material (embedding incluido, tal cual
+    # llega de PostgREST: pgvector acepta el mismo texto "[...]" al insertarlo en otro material)
+    rows = []
+    start = 0
+    while True:
+        response = (
+            supabase.table('material_chunks')
+            .select('chunk_text, chunk_hash, token_count, page_start, page_end, embedding')
+            .eq('material_id', material_id)
+            .order('id')
+            .range(start, start + page_size - 1)
+            .execute()
+        )
+        page = response.data or []
+        rows.extend(page)
+        if len(page) < page_size:
+            break
+        start += page_size
+    return rows
+
+@traced("supabase.get_chunk_hashes")
+def get_chunk_hashes(material_id: int, page_size: int = 1000):
+    # Retorna [{'id', 'chunk_hash'}] de todos los chunks de un material (paginado)
+    rows = []
+    start = 0
+    while True:
+        response = (
+            supabase.table('material_chunks')
+            .select('id, chunk_hash')
+            .eq('material_id', material_id)
+            .order('id')
+            .range(start, start + page_size - 1)
+            .execute()
+        )
+        page = response.data or []
+        rows.extend(page)
+        if len(page) < page_size:
+            break
+        start += page_size
+    return rows
 
+@traced("supabase.delete_chunks")
+def delete_chunks(chunk_ids: list, batch_size: int = 500):
+    # Borra chunks por id en lotes (la URL de PostgREST tiene un límite de longitud)
+    deleted = 0
+    for i in range(0, len(chunk_ids), batch_size):
+        batch = chunk_ids[i:i + batch_size]
+        supabase.table('material_chunks').delete().in_('id', batch).execute()
+        deleted += len(batch)
+    return deleted
+
+@traced("supabase.insert_chunk_rows")
+def _insert_chunk_rows(rows: list):
+    # Un INSERT por lote. Solo se pide de vuelta el id de cada fila (no su texto ni su embedding):
+    # las filas devueltas son las que PostgREST escribió de verdad, en el orden del lote
+    response = supabase.table('material_chunks').insert(rows).select('id').execute()
+    return [row['id'] for row in response.data or []]
+
+@traced("supabase.count_chunk_hashes")
+def count_chunk_hashes(material_id: int, chunk_hashes: list, batch_size: int = 100):
+    # Cuántas filas tiene el material por chunk_hash (en lotes por el límite de longitud de la URL)
+    counts = Counter()
+    for i in range(0, len(chunk_hashes), batch_size):
+        response = (
+            supabase.table('material_chunks')
+            .select('chunk_hash')
+            .eq('material_id', material_id)
+            .in_('chunk_hash', chunk_hashes[i:i + batch_size])
+            .execute()
+        )
+        counts.update(row['chunk_hash'] for row in response.data or [])
+    return counts
+
+# Escritura masiva de chunks: lotes acotados, en paralelo y con reintentos idempotentes (api/chunk_writer.py)
+chunk_writer = ChunkWriter(
+    _insert_chunk_rows, count_chunk_hashes,
+    batch_rows=CHUNK_INSERT_BATCH_ROWS, batch_bytes=CHUNK_INSERT_BATCH_KB * 1024,
+    concurrency=CHUNK_INSERT_CONCURRENCY, max_retries=CHUNK_INSERT_MAX_RETRIES,
+    backoff_base_s=CHUNK_INSERT_BACKOFF_BASE_S, backoff_max_s=CHUNK_INSERT_BACKOFF_MAX_S,
+)
+
+@traced("supabase.insert_chunks")
+def insert_chunks(material_id: int, chunks_to_insert: list, existing: Counter | None = None, on_written=None):
+    # Inserta los fragmentos (chunk_text, hash y embedding) en la tabla 'material_chunks'.
+    # chunks_to_insert es una lista de diccionarios, cada uno con 'chunk_text', 'chunk_hash', 'embedding'
+    # (y opcionalmente 'token_count', 'page_start' / 'page_end')
+    # existing: conteo por chunk_hash de lo que el material ya tiene (ver ChunkWriter.write)
+    # on_written(filas, ids): se llama por cada lote escrito (ids=None si no se conocen)
+    # Retorna el número de filas que Supabase confirmó haber escrito (los lotes fallidos no cuentan)
+    report = chunk_writer.write(material_id, chunks_to_insert, existing, on_written)
+    if report["failed"]:
+        print(f"Error al insertar chunks: {report['failed']} de {len(chunks_to_insert)} no se escribieron")
+    return report["inserted"]
+
+@traced("supabase.get_chunks_without_embeddings")
 def get_chunks_without_embeddings(material_id: int):
     # Obtiene todos los chunks para un material dado cuyo campo 'embedding' es NULL
     response = (
         supabase.table('material_chunks')
-        .select('id, chunk_text')
+        .select('id, chunk_text, chunk_hash, page_start')
         .eq('material_id', material_id)
         .is_('embedding', None)  # Esta línea busca los valores NULL
         .execute()
     )
     
-    # El resultado de execute() tiene la estructura (data, count), data[1] contiene las filas
-    if response.data and response.data[1]:
-        # data[1] es la lista de chunks. Retornamos la lista de diccionarios.
-        return response.data[1] 
+    # response.data ya es la lista de filas (diccionarios)
+    if response.data:
+        return response.data
     return []
 
+@traced("supabase.upsert_chunk_embeddings")
+def upsert_chunk_embeddings(material_id: int, chunks: list, embeddings: list):
+    # Escribe los embeddings de un lote de chunks con UN solo upsert (en lugar de un update por fila).
+    # El upsert de PostgREST es un INSERT ... ON CONFLICT (id), así que enviamos también las
+    # columnas NOT NULL de la fila (material_id, chunk_text, chunk_hash) además del embedding.
+    rows = [
+        {
+            "id": ch["id"],
+            "material_id": material_id,
+            "chunk_text": ch["chunk_text"],
+            "chunk_hash": ch.get("chunk_hash"),
+            "embedding": emb,
+        }
+        for ch, emb in zip(chunks, embeddings)
+    ]
+    supabase.table('material_chunks').upsert(rows, on_conflict="id").execute()
+    return len(rows)
+
+@traced("supabase.vector_search")
 def vector_search(query_embedding: list, material_id: int, limit: int = 4):
     """
     Realiza la búsqueda de similitud vectorial (RAG) en la base de datos.
@@ -108,7 +311,7 @@ def vector_search(query_embedding: list, material_id: int, limit: int = 4):
     data, count = supabase.rpc('match_material_chunks', {
         'query_embedding': query_embedding,
         'match_material_id': material_id,
-        'match_threshold': 0.5, # Umbral de similitud opcional para filtrar
+        'match_threshold': VECTOR_MATCH_THRESHOLD, # Umbral de similitud opcional para filtrar
         'match_count': limit
     }).execute()
     
@@ -118,6 +321,106 @@ def vector_search(query_embedding: list, material_id: int, limit: int = 4):
         return [item['chunk_text'] for item in data[1]]
     return []
 
+@traced("supabase.vector_search_hits")
+def vector_search_hits(query_embedding: list, material_id: int, limit: int = 4):
+    """
+    Igual que vector_search pero devuelve las filas completas de match_material_chunks
+    (id, chunk_text, page_start, similarity) en lugar de solo el texto. Misma forma que la variante
+    async (supabase_async.vector_search_hits): la lista de filas, vacía si no hay coincidencias.
+    page_start lo usa el context builder para ordenar por posición en el documento (los ids no
+    siguen ese orden tras un reemplazo de PDF); el RPC tiene que devolverlo:
+
+        create or replace function match_material_chunks(query_embedding vector, match_material_id bigint,
+                                                          match_threshold float, match_count int)
+        returns table (id bigint, chunk_text text, page_start int, similarity float) language sql stable as $$
+          select id, chunk_text, page_start, 1 - (embedding <=> query_embedding) as similarity
+          from material_chunks
+          where material_id = match_material_id and 1 - (embedding <=> query_embedding) > match_threshold
+          order by embedding <=> query_embedding
+          limit match_count;
+        $$;
+
+    Con una versión anterior del RPC (sin page_start) se ordena por id, como antes.
+    """
+    response = supabase.rpc('match_material_chunks', {
+        'query_embedding': query_embedding,
+        'match_material_id': material_id,
+        'match_threshold': VECTOR_MATCH_THRESHOLD,
+        'match_count': limit
+    }).execute()
+    return response.data or []
+
+@traced("supabase.get_chunk_embeddings")
+def get_chunk_embeddings(material_id: int, page_size: int = 1000):
+    # Obtiene (id, chunk_text, page_start, embedding) de todos los chunks de un material que ya tienen embedding.
+    # Se pagina con range() porque PostgREST limita el número de filas por respuesta.
+    rows = []
+    start = 0
+    while True:
+        response = (
+            supabase.table('material_chunks')
+            .select('id, chunk_text, page_start, embedding')
+            .eq('material_id', material_id)
+            .not_.is_('embedding', None)
+            .order('id')
+            .range(start, start + page_size - 1)
+            .execute()
+        )
+        page = response.data or []
+        for row in page:
+            # pgvector llega por PostgREST como texto "[0.1,0.2,...]"
+            if isinstance(row.get('embedding'), str):
+                row['embedding'] = json.loads(row['embedding'])
+        rows.extend(page)
+        if len(page) < page_size:
+            break
+        start += page_size
+    return rows
+
+@traced("supabase.get_chunk_texts")
+def get_chunk_texts(material_id: int, page_size: int = 1000):
+    # Obtiene (id, chunk_text, page_start) de todos los chunks de un material, tengan o no embedding (índice léxico)
+    rows = []
+    start = 0
+    while True:
+        response = (
+            supabase.table('material_chunks')
+            .select('id, chunk_text, page_start')
+            .eq('material_id', material_id)
+            .order('id')
+            .range(start, start + page_size - 1)
+            .execute()
+        )
+        page = response.data or []
+        rows.extend(page)
+        if len(page) < page_size:
+            break
+        start += page_size
+    return rows
+
+@traced("supabase.get_material_owner")
+def get_material_owner(material_id: int):
+    # Retorna el user_id dueño de un material (o None si no existe)
+    response = supabase.table('materials').select('user_id').eq('id', material_id).limit(1).execute()
+    if response.data:
+        return response.data[0]['user_id']
+    return None
+
+@traced("supabase.get_user_material_ids")
+def get_user_material_ids(user_id: str):
+    # Ids de todos los materiales de un usuario (carga inicial del índice ANN)
+    response = supabase.table('materials').select('id').eq('user_id', user_id).order('id').execute()
+    return [row['id'] for row in response.data or []]
+
+@traced("supabase.get_chunks_by_ids")
+def get_chunks_by_ids(chunk_ids: list):
+    # Recupera el texto de varios chunks por id (p. ej. resultados del índice ANN)
+    if not chunk_ids:
+        return []
+    response = supabase.table('material_chunks').select('id, material_id, chunk_text').in_('id', list(chunk_ids)).execute()
+    return response.data or []
+
+@traced("supabase.get_raw_text")
 def get_raw_text(material_id: int):
     #Obtiene el texto sin procesar de un material.
     data, count = supabase.table('materials').select('raw_text').eq('id', material_id).single().execute()
@@ -128,11 +431,12 @@ def get_raw_text(material_id: int):
 
 def insert_tool(material_id: int, tool_type: str, data: dict):
     try:
-        supabase.table('tools').insert({
-            "material_id": material_id,
-            "tool_type": tool_type,
-            "data": data
-        }).execute()
+        with trace("supabase.insert_tool"):
+            supabase.table('tools').insert({
+                "material_id": material_id,
+                "tool_type": tool_type,
+                "data": data
+            }).execute()
         return 1 # Retornamos 1 porque siempre insertamos una herramienta a la vez
     except Exception as e:
         print(f"Error al guardar tool: {e}")
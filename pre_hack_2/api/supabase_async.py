@@ -0,0 +1,77 @@
+import asyncio
+import threading
+import weakref
+
+from supabase import acreate_client, AsyncClient
+from .config import SUPABASE_URL, SUPABASE_API_KEY, VECTOR_MATCH_THRESHOLD
+from .metrics import trace, traced
+
+# Cliente async de Supabase (HTTP no bloqueante) para el request path RAG.
+# A diferencia del cliente de api/supabase.py, acreate_client es una corrutina,
+# así que se crea la primera vez que se usa, ya dentro del event loop.
+# El cliente (su pool httpx) y el lock que protege su creación quedan atados al loop que los
+# creó, así que hay uno por event loop: otro loop (asyncio.run en benchmarks o scripts, portales
+# de anyio, tests) obtiene los suyos en lugar de reutilizar los del primero.
+# La ingesta (jobs, uploads) sigue usando el cliente síncrono desde hilos.
+
+_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncClient]" = weakref.WeakKeyDictionary()
+_client_locks: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Lock]" = weakref.WeakKeyDictionary()
+# Los diccionarios se comparten entre los hilos de cada loop
+_registry_lock = threading.Lock()
+
+
+async def get_async_client() -> AsyncClient:
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is not None:
+        return client
+    with _registry_lock:
+        lock = _client_locks.setdefault(loop, asyncio.Lock())
+    async with lock:
+        client = _clients.get(loop)
+        if client is None:
+            try:
+                client = await acreate_client(SUPABASE_URL, SUPABASE_API_KEY)
+            except Exception as e:
+                print(f"Error creating async Supabase client: {e}")
+                raise
+            with _registry_lock:
+                _clients[loop] = client
+    return client
+
+
+@traced("supabase.vector_search_hits")
+async def vector_search_hits(query_embedding: list, material_id: int, limit: int = 4):
+    # Mismo RPC y misma forma de retorno (lista de filas) que supabase.vector_search_hits, sin bloquear el event loop
+    client = await get_async_client()
+    response = await client.rpc('match_material_chunks', {
+        'query_embedding': query_embedding,
+        'match_material_id': material_id,
+        'match_threshold': VECTOR_MATCH_THRESHOLD,
+        'match_count': limit
+    }).execute()
+    return response.data or []
+
+
+@traced("supabase.get_chunks_by_ids")
+async def get_chunks_by_ids(chunk_ids: list):
+    if not chunk_ids:
+        return []
+    client = await get_async_client()
+    response = await client.table('material_chunks').select('id, material_id, chunk_text').in_('id', list(chunk_ids)).execute()
+    return response.data or []
+
+
+async def insert_tool(material_id: int, tool_type: str, data: dict):
+    try:
+        with trace("supabase.insert_tool"):
+            client = await get_async_client()
+            await client.table('tools').insert({
+                "material_id": material_id,
+                "tool_type": tool_type,
+                "data": data
+            }).execute()
+        return 1
+    except Exception as e:
+        print(f"Error al guardar tool: {e}")
+        return 0
@@ -1,4 +1,9 @@
 import re
+import hashlib
+
+from collections import deque
+
+from .config import CHUNKER, CHUNK_MAX_TOKENS, CHUNK_OVERLAP_TOKENS
 
 def split_text_simple(text: str, max_chars: int = 1200, overlap: int = 200) -> list[str]:
     """
@@ -28,4 +33,271 @@ def split_text_simple(text: str, max_chars: int = 1200, overlap: int = 200) -> l
         if start <= 0 or start >= text_length: 
             break
             
-    return chunks
\ No newline at end of file
+    return chunks
+
+def _iter_normalized(pages):
+    """
+    Normaliza los espacios de un iterable de (número_de_página, texto) página a página.
+    Concatenar los fragmentos generados equivale a re.sub(r'\\s+', ' ', "\\n".join(textos)).lstrip()
+    (el espacio final, si lo hay, lo quita quien consume).
+    """
+    first = True
+    last_char = ""
+    for page_number, page_text in pages:
+        piece = re.sub(r'\s+', ' ', page_text if first else "\n" + page_text)
+        if first:
+            piece = piece.lstrip()
+        elif last_char == " " and piece.startswith(" "):
+            piece = piece[1:]
+        if not piece and not first:
+            continue
+        if piece:
+            first = False
+            last_char = piece[-1]
+        yield page_number, piece
+
+
+def _page_at(page_starts: list, position: int) -> int:
+    # page_starts: [(posición absoluta, número de página)] ordenado por posición
+    page = page_starts[0][1]
+    for offset, number in page_starts:
+        if offset > position:
+            break
+        page = number
+    return page
+
+
+def iter_chunks(pages, max_chars: int = 1200, overlap: int = 200):
+    """
+    Versión incremental de split_text_simple.
+    Recibe un iterable de (número_de_página, texto) y genera los chunks a medida que
+    se completan, cruzando los límites de página. Produce los mismos chunks que
+    split_text_simple("\\n".join(textos)), pero solo mantiene en memoria el texto
+    pendiente del chunk actual (nunca el documento completo).
+
+    Cada chunk es un dict: {'chunk_text', 'page_start', 'page_end'}.
+    """
+    step = max_chars - overlap
+    buffer = ""          # texto normalizado aún no descartado
+    buffer_offset = 0    # posición absoluta (en el texto normalizado) de buffer[0]
+    start = 0            # inicio del próximo chunk (relativo a buffer)
+    page_starts = []     # [(posición absoluta, número de página)] de las páginas en el buffer
+
+    def _make_chunk(begin: int, end: int):
+        chunk = buffer[begin:end].strip()
+        if not chunk:
+            return None
+        return {
+            "chunk_text": chunk,
+            "page_start": _page_at(page_starts, buffer_offset + begin),
+            "page_end": _page_at(page_starts, buffer_offset + min(end, len(buffer)) - 1),
+        }
+
+    for page_number, piece in _iter_normalized(pages):
+        page_starts.append((buffer_offset + len(buffer), page_number))
+        buffer += piece
+
+        # Emitimos solo los chunks cuyo contenido ya no puede cambiar
+        # (queda al menos un carácter después de su final).
+        while len(buffer) > start + max_chars:
+            chunk = _make_chunk(start, start + max_chars)
+            if chunk:
+                yield chunk
+            if step <= 0:
+                return
+            start += step
+
+        # Descartamos el texto ya consumido y las páginas que quedaron atrás
+        if start > 0:
+            buffer = buffer[start:]
+            buffer_offset += start
+            start = 0
+            while len(page_starts) > 1 and page_starts[1][0] <= buffer_offset:
+                page_starts.pop(0)
+
+    # Final del documento: mismo criterio de corte que split_text_simple
+    buffer = buffer.rstrip()
+    while start < len(buffer):
+        chunk = _make_chunk(start, start + max_chars)
+        if chunk:
+            yield chunk
+        start += step
+        if step <= 0 or start >= len(buffer):
+            break
+
+
+# Tabla "gear" para el hash rodante del chunking por contenido (fija: los cortes deben ser estables entre ejecuciones)
+_GEAR = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:8], "little") for i in range(256)]
+_HASH_MASK = (1 << 64) - 1
+
+
+def iter_chunks_cdc(pages, max_chars: int = 1200, overlap: int = 200, min_chars: int | None = None, avg_chars: int | None = None):
+    """
+    Chunking definido por contenido (CDC) con un hash rodante tipo "gear".
+    Los cortes se eligen donde el hash de los últimos ~64 caracteres cumple una condición
+    (y se ajustan al siguiente espacio), así que dependen del contenido local y no de la posición:
+    insertar una frase en la página 2 solo cambia los chunks alrededor de la edición,
+    y el resto conserva su chunk_hash.
+
+    Se respetan los límites de split_text_simple: cada chunk tiene como máximo max_chars
+    caracteres, incluyendo los `overlap` caracteres finales del chunk anterior que se
+    anteponen como solapamiento. min_chars/avg_chars controlan el tamaño del cuerpo
+    (por defecto 1/3 y 2/3 de max_chars - overlap).
+
+    Misma entrada y salida que iter_chunks (streaming, con números de página).
+    """
+    body_max = max(1, max_chars - overlap)
+    min_body = min_chars or body_max // 3
+    avg_body = max(min_body + 1, avg_chars or body_max * 2 // 3)
+    # Probabilidad de corte 1/2^bits por carácter pasado el mínimo
+    cut_mask = (1 << max(1, (avg_body - min_body).bit_length() - 1)) - 1
+
+    buffer = ""          # texto normalizado desde (body_start - overlap)
+    buffer_offset = 0    # posición absoluta de buffer[0]
+    body_start = 0       # posición absoluta del inicio del cuerpo del chunk actual
+    page_starts = []
+    h = 0
+    pending_cut = False
+
+    def _make_chunk(end: int):
+        begin = max(buffer_offset, body_start - overlap)
+        chunk = buffer[begin - buffer_offset:end - buffer_offset].strip()
+        if not chunk:
+            return None
+        return {
+            "chunk_text": chunk,
+            "page_start": _page_at(page_starts, begin),
+            "page_end": _page_at(page_starts, end - 1),
+        }
+
+    for page_number, piece in _iter_normalized(pages):
+        page_starts.append((buffer_offset + len(buffer), page_number))
+        scan_from = len(buffer)
+        buffer += piece
+
+        cuts = []
+        for i in range(scan_from, len(buffer)):
+            char = buffer[i]
+            h = ((h << 1) + _GEAR[ord(char) & 0xFF]) & _HASH_MASK
+            position = buffer_offset + i
+            body_len = position - (cuts[-1] if cuts else body_start)
+            # El hash decide el punto de corte; el corte se hace en el siguiente espacio
+            if body_len >= min_body and (h & cut_mask) == 0:
+                pending_cut = True
+            if (pending_cut and char == " ") or body_len >= body_max:
+                cuts.append(position)
+                pending_cut = False
+
+        for cut in cuts:
+            chunk = _make_chunk(cut)
+            if chunk:
+                yield chunk
+            body_start = cut
+
+        # Solo conservamos el solapamiento y el cuerpo pendiente
+        keep_from = max(buffer_offset, body_start - overlap)
+        if keep_from > buffer_offset:
+            buffer = buffer[keep_from - buffer_offset:]
+            buffer_offset = keep_from
+            while len(page_starts) > 1 and page_starts[1][0] <= buffer_offset:
+                page_starts.pop(0)
+
+    # Último chunk: el cuerpo pendiente (si tiene contenido)
+    end = buffer_offset + len(buffer.rstrip())
+    if end > body_start and buffer[body_start - buffer_offset:].strip():
+        chunk = _make_chunk(end)
+        if chunk:
+            yield chunk
+
+
+# Aproximación local del tokenizador (SentencePiece de Gemini): cada secuencia alfanumérica
+# cuesta ~1 token por cada 4 caracteres y cada símbolo o signo de puntuación es un token.
+# No es exacta, pero sigue bien la diferencia entre prosa y contenido con fórmulas.
+_SUBTOKEN_RE = re.compile(r'\w+|[^\w\s]')
+_SEGMENT_RE = re.compile(r'\S+')
+
+
+def _segment_tokens(segment: str) -> int:
+    if segment.isalnum():
+        return (len(segment) + 3) // 4
+    return sum((len(t) + 3) // 4 if t[0].isalnum() or t[0] == "_" else 1 for t in _SUBTOKEN_RE.findall(segment))
+
+
+def estimate_tokens(text: str) -> int:
+    """Número aproximado de tokens de un texto (ver _segment_tokens)."""
+    return sum(_segment_tokens(m.group()) for m in _SEGMENT_RE.finditer(text))
+
+
+def iter_chunks_tokens(pages, max_tokens: int = CHUNK_MAX_TOKENS, overlap_tokens: int = CHUNK_OVERLAP_TOKENS):
+    """
+    Chunker por presupuesto de tokens en una sola pasada lineal.
+    Recorre las "palabras" (secuencias sin espacios) una vez, acumulando su costo estimado
+    en tokens; cuando la siguiente palabra excede max_tokens se emite el chunk (un único
+    slice del buffer) y se conservan al final las palabras que suman hasta overlap_tokens
+    como solapamiento del siguiente.
+
+    Misma entrada y salida que iter_chunks, y cada chunk incluye además 'token_count'.
+    """
+    overlap_tokens = min(overlap_tokens, max_tokens - 1)
+    buffer = ""
+    buffer_offset = 0
+    page_starts = []
+    words = deque()      # (inicio absoluto, fin absoluto, tokens) de las palabras del chunk actual
+    tokens = 0
+
+    def _make_chunk():
+        begin, end = words[0][0], words[-1][1]
+        return {
+            "chunk_text": buffer[begin - buffer_offset:end - buffer_offset],
+            "page_start": _page_at(page_starts, begin),
+            "page_end": _page_at(page_starts, end - 1),
+            "token_count": tokens,
+        }
+
+    for page_number, piece in _iter_normalized(pages):
+        piece_offset = buffer_offset + len(buffer)
+        page_starts.append((piece_offset, page_number))
+        buffer += piece
+
+        for match in _SEGMENT_RE.finditer(piece):
+            cost = _segment_tokens(match.group())
+            if words and tokens + cost > max_tokens:
+                yield _make_chunk()
+                # Solapamiento: nos quedamos con las últimas palabras hasta overlap_tokens
+                while words and (tokens > overlap_tokens or tokens + cost > max_tokens):
+                    tokens -= words.popleft()[2]
+            words.append((piece_offset + match.start(), piece_offset + match.end(), cost))
+            tokens += cost
+
+        # Descartamos del buffer todo lo anterior a la primera palabra pendiente
+        keep_from = words[0][0] if words else buffer_offset + len(buffer)
+        if keep_from > buffer_offset:
+            buffer = buffer[keep_from - buffer_offset:]
+            buffer_offset = keep_from
+            while len(page_starts) > 1 and page_starts[1][0] <= buffer_offset:
+                page_starts.pop(0)
+
+    if words:
+        yield _make_chunk()
+
+
+def chunk_pages(pages, chunker: str | None = None):
+    # Punto de entrada de la ingesta: elige el chunker configurado ("fixed", "cdc" o "tokens")
+    chunker = (chunker or CHUNKER).lower()
+    if chunker == "cdc":
+        return iter_chunks_cdc(pages)
+    if chunker == "tokens":
+        return iter_chunks_tokens(pages)
+    return iter_chunks(pages)
+
+
+def iter_batches(items, batch_size: int):
+    # Agrupa un iterable en listas de tamaño batch_size (la última puede ser más corta)
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
@@ -0,0 +1,408 @@
+import os
+import json
+import asyncio
+import threading
+
+import numpy as np
+
+from .config import (
+    EMBEDDING_DIM, VECTOR_SEARCH_BACKEND, VECTOR_MATCH_THRESHOLD, VECTOR_INDEX_DIR,
+    VECTOR_INDEX_STORAGE, VECTOR_INDEX_DIMS, VECTOR_RESCORE_FACTOR,
+)
+from . import supabase as supabase_db
+from . import supabase_async
+from .metrics import traced
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    # Normaliza cada fila a norma 1 para que el producto punto sea la similitud coseno
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (matrix / norms).astype(np.float32, copy=False)
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    # Top-k sin ordenar todo el arreglo: argpartition O(n) y luego se ordenan solo los k elegidos
+    if k <= 0 or scores.size == 0:
+        return np.empty(0, dtype=np.int64)
+    if k < scores.size:
+        candidates = np.argpartition(-scores, k - 1)[:k]
+    else:
+        candidates = np.arange(scores.size)
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+STORAGE_DTYPES = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+# Filas por bloque al puntuar una matriz comprimida: se convierten a float32 de a trozos
+# para usar BLAS sin materializar una copia float32 de toda la matriz
+_SCORE_BLOCK_ROWS = 4096
+
+
+def encode_vectors(matrix: np.ndarray, storage: str = "float32", dims: int = 0) -> tuple[np.ndarray, np.ndarray | None]:
+    """
+    Comprime vectores normalizados para el recorrido de búsqueda.
+    - dims: conserva solo las primeras `dims` dimensiones y vuelve a normalizar (0 = todas).
+    - storage "float16": media precisión; "int8": cuantización escalar simétrica por fila,
+      x ≈ scale * q con q en [-127, 127] (retorna también las escalas).
+    """
+    if dims and dims < matrix.shape[1]:
+        matrix = _normalize_rows(np.ascontiguousarray(matrix[:, :dims], dtype=np.float32))
+    if storage == "int8":
+        scales = np.abs(matrix).max(axis=1) / 127.0 if len(matrix) else np.empty(0, dtype=np.float32)
+        scales[scales == 0] = 1.0
+        quantized = np.rint(matrix / scales[:, None]).astype(np.int8)
+        return quantized, scales.astype(np.float32)
+    return matrix.astype(STORAGE_DTYPES[storage], copy=False), None
+
+
+class MaterialIndex:
+    """
+    Índice vectorial exacto de un único material.
+    Guarda los embeddings como una matriz float32 normalizada (n, dim), así
+    la similitud coseno contra una consulta es un único producto matriz-vector.
+
+    Con VECTOR_INDEX_STORAGE / VECTOR_INDEX_DIMS la matriz que se recorre se guarda
+    comprimida (float16 o int8, y/o solo las primeras dimensiones). Los top_k * rescore_factor
+    mejores candidatos se reordenan con los vectores completos (`full`, float32), que con
+    VECTOR_INDEX_DIR viven en disco (memory-map): solo se leen las filas de los candidatos.
+
+    `pages` (page_start de cada chunk, o None si no se conoce) viaja en los hits para que el
+    context builder ordene los chunks por su posición en el documento.
+    """
+
+    def __init__(self, ids: np.ndarray, texts: list[str], matrix: np.ndarray, scales: np.ndarray | None = None,
+                 full: np.ndarray | None = None, rescore_factor: int = VECTOR_RESCORE_FACTOR, dim: int | None = None,
+                 pages: np.ndarray | None = None):
+        # ids, textos, matriz, escalas, vectores completos y páginas se publican juntos en una sola
+        # asignación (ver upsert): una búsqueda concurrente ve la versión anterior o la nueva completa,
+        # nunca filas de una con ids, escalas o posiciones de rescoring de otra
+        self._data = (ids, texts, matrix, scales, full, pages)
+        self.rescore_factor = rescore_factor
+        # Dimensiones de los embeddings originales (matrix puede tener menos si se truncó)
+        self.dim = dim or (full.shape[1] if full is not None else matrix.shape[1])
+
+    @classmethod
+    def from_rows(cls, rows: list[dict], dim: int = EMBEDDING_DIM, storage: str = VECTOR_INDEX_STORAGE,
+                  dims: int = VECTOR_INDEX_DIMS, rescore_factor: int = VECTOR_RESCORE_FACTOR):
+        ids = np.array([r["id"] for r in rows], dtype=np.int64)
+        texts = [r["chunk_text"] for r in rows]
+        # Páginas solo si todas las filas la traen (si no, el context builder ordena por id)
+        known = all(r.get("page_start") is not None for r in rows)
+        pages = np.array([r["page_start"] for r in rows], dtype=np.int32) if known else None
+        if rows:
+            full = _normalize_rows(np.asarray([r["embedding"] for r in rows], dtype=np.float32))
+        else:
+            full = np.empty((0, dim), dtype=np.float32)
+        return cls.from_vectors(ids, texts, full, storage, dims, rescore_factor, pages)
+
+    @classmethod
+    def from_vectors(cls, ids: np.ndarray, texts: list[str], full: np.ndarray, storage: str = VECTOR_INDEX_STORAGE,
+                     dims: int = VECTOR_INDEX_DIMS, rescore_factor: int = VECTOR_RESCORE_FACTOR,
+                     pages: np.ndarray | None = None):
+        # full: vectores normalizados float32 con todas sus dimensiones
+        matrix, scales = encode_vectors(full, storage, dims)
+        compressed = storage != "float32" or matrix.shape[1] < full.shape[1]
+        keep_full = compressed and rescore_factor > 0
+        return cls(ids, texts, matrix, scales, full if keep_full else None, rescore_factor, full.shape[1], pages)
+
+    @property
+    def ids(self) -> np.ndarray:
+        return self._data[0]
+
+    @property
+    def texts(self) -> list[str]:
+        return self._data[1]
+
+    @property
+    def matrix(self) -> np.ndarray:
+        return self._data[2]
+
+    @property
+    def scales(self) -> np.ndarray | None:
+        return self._data[3]
+
+    @property
+    def full(self) -> np.ndarray | None:
+        return self._data[4]
+
+    @property
+    def pages(self) -> np.ndarray | None:
+        return self._data[5]
+
+    def __len__(self):
+        return len(self.texts)
+
+    @property
+    def storage(self) -> str:
+        return np.dtype(self.matrix.dtype).name
+
+    def full_vectors(self) -> np.ndarray | None:
+        # Vectores float32 con todas sus dimensiones (None si se guardó solo la versión comprimida)
+        if self.full is not None:
+            return self.full
+        if self.storage == "float32" and self.matrix.shape[1] == self.dim:
+            return self.matrix
+        return None
+
+    def matches(self, storage: str, dims: int) -> bool:
+        # ¿Está guardado con la configuración pedida? (p. ej. un índice en disco de otra configuración)
+        return self.storage == storage and self.matrix.shape[1] == (min(dims, self.dim) if dims else self.dim)
+
+    def nbytes(self) -> int:
+        # Memoria de la matriz que se recorre en cada búsqueda (la copia completa puede estar en disco)
+        return self.matrix.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    @staticmethod
+    def _scores(queries: np.ndarray, matrix: np.ndarray, scales: np.ndarray | None) -> np.ndarray:
+        # Similitud de cada consulta (filas de `queries`) contra cada chunk: matriz (consultas, chunks)
+        if matrix.dtype == np.float32:
+            return queries @ matrix.T
+        scores = np.empty((len(queries), len(matrix)), dtype=np.float32)
+        for start in range(0, len(matrix), _SCORE_BLOCK_ROWS):
+            block = matrix[start:start + _SCORE_BLOCK_ROWS]
+            scores[:, start:start + len(block)] = queries @ block.astype(np.float32).T
+        if scales is not None:
+            scores *= scales
+        return scores
+
+    @staticmethod
+    def _vector(i: int, matrix: np.ndarray, scales: np.ndarray | None, full: np.ndarray | None) -> np.ndarray:
+        if full is not None:
+            return np.asarray(full[i])
+        vector = np.asarray(matrix[i], dtype=np.float32)
+        return vector * scales[i] if scales is not None else vector
+
+    def search(self, query_embedding, match_threshold: float = VECTOR_MATCH_THRESHOLD, match_count: int = 4,
+               with_embeddings: bool = False) -> list[dict]:
+        # Misma semántica que match_material_chunks: similitud > umbral, ordenado de mayor a menor, máximo match_count
+        # with_embeddings: incluye el vector normalizado de cada chunk (lo usa el reranking MMR del context builder)
+        return self.search_many([query_embedding], match_threshold, match_count, with_embeddings)[0]
+
+    def search_many(self, query_embeddings, match_threshold: float = VECTOR_MATCH_THRESHOLD, match_count: int = 4,
+                    with_embeddings: bool = False) -> list[list[dict]]:
+        # Varias consultas contra el mismo material con un único producto matriz-matriz
+        # (la matriz del material se recorre una vez en lugar de una por consulta)
+        # Se lee una sola vez la versión publicada: un upsert concurrente no la modifica
+        ids, texts, matrix, scales, full, pages = self._data
+        if len(texts) == 0 or len(query_embeddings) == 0:
+            return [[] for _ in query_embeddings]
+        queries = _normalize_rows(np.asarray(query_embeddings, dtype=np.float32).reshape(len(query_embeddings), -1))
+        dims = matrix.shape[1]
+        # Consultas truncadas a las mismas dimensiones que la matriz (y renormalizadas)
+        scores = self._scores(_normalize_rows(np.ascontiguousarray(queries[:, :dims])) if dims < queries.shape[1] else queries,
+                              matrix, scales)
+
+        results = []
+        for query, row in zip(queries, scores):
+            if not query.any():
+                results.append([])
+                continue
+            if full is not None:
+                # Rescoring: los mejores candidatos de la matriz comprimida se reordenan con los vectores completos
+                candidates = np.sort(top_k_indices(row, match_count * max(1, self.rescore_factor)))
+                exact = np.asarray(full[candidates]) @ query
+                best = top_k_indices(exact, match_count)
+                order, similarities = candidates[best], exact[best]
+            else:
+                order = top_k_indices(row, match_count)
+                similarities = row[order]
+
+            hits = []
+            for i, similarity in zip(order, similarities):
+                if similarity <= match_threshold:
+                    break
+                hit = {"id": int(ids[i]), "chunk_text": texts[i], "similarity": float(similarity)}
+                if pages is not None:
+                    hit["page_start"] = int(pages[i])
+                if with_embeddings:
+                    hit["embedding"] = self._vector(i, matrix, scales, full)
+                hits.append(hit)
+            results.append(hits)
+        return results
+
+    def upsert(self, rows: list[dict]):
+        # Agrega chunks nuevos; si un id ya existe se reemplaza su vector (p. ej. al regenerar embeddings)
+        if not rows:
+            return
+        new = MaterialIndex.from_rows(rows, dim=self.dim, storage=self.storage, dims=self.matrix.shape[1],
+                                      rescore_factor=self.rescore_factor)
+        ids, texts, matrix, scales, full, pages = self._data
+        if len(texts):
+            # Los arreglos nuevos se arman aparte y se publican con una única asignación
+            keep = ~np.isin(ids, new.ids)
+            self._data = (np.concatenate([ids[keep], new.ids]),
+                          [t for t, k in zip(texts, keep) if k] + new.texts,
+                          np.vstack([matrix[keep], new.matrix]),
+                          np.concatenate([scales[keep], new.scales]) if scales is not None else None,
+                          np.vstack([full[keep], new.full]) if full is not None else None,
+                          np.concatenate([pages[keep], new.pages]) if pages is not None and new.pages is not None else None)
+        else:
+            self._data = new._data
+
+    def save(self, directory: str):
+        # Cada archivo se escribe aparte y se renombra: un índice cargado con memory-map desde
+        # estos mismos archivos sigue leyendo la versión anterior en lugar de una truncada
+        os.makedirs(directory, exist_ok=True)
+        ids, texts, matrix, scales, full, pages = self._data
+
+        def _write(name: str, write):
+            path = os.path.join(directory, name)
+            with open(path + ".tmp", "wb") as f:
+                write(f)
+            os.replace(path + ".tmp", path)
+
+        _write("matrix.npy", lambda f: np.save(f, np.ascontiguousarray(matrix)))
+        _write("ids.npy", lambda f: np.save(f, ids))
+        for name, array in (("scales.npy", scales), ("full.npy", full), ("pages.npy", pages)):
+            if array is not None:
+                _write(name, lambda f: np.save(f, np.ascontiguousarray(array)))
+            elif os.path.exists(os.path.join(directory, name)):
+                os.remove(os.path.join(directory, name))
+        _write("texts.json", lambda f: f.write(json.dumps(texts, ensure_ascii=False).encode("utf-8")))
+        _write("meta.json", lambda f: f.write(json.dumps({"dim": self.dim}).encode("utf-8")))
+
+    @classmethod
+    def load(cls, directory: str, mmap: bool = True):
+        # Con mmap la matriz no se copia a memoria: el SO pagina solo lo que se lee
+        # (la matriz comprimida se lee entera en cada búsqueda; la completa solo en las filas candidatas)
+        matrix = np.load(os.path.join(directory, "matrix.npy"), mmap_mode="r" if mmap else None)
+        ids = np.load(os.path.join(directory, "ids.npy"))
+        scales_path = os.path.join(directory, "scales.npy")
+        full_path = os.path.join(directory, "full.npy")
+        scales = np.load(scales_path) if os.path.exists(scales_path) else None
+        full = np.load(full_path, mmap_mode="r" if mmap else None) if os.path.exists(full_path) else None
+        # Índices guardados antes de las páginas: sin pages.npy (orden por id en el context builder)
+        pages_path = os.path.join(directory, "pages.npy")
+        pages = np.load(pages_path) if os.path.exists(pages_path) else None
+        with open(os.path.join(directory, "texts.json"), "r", encoding="utf-8") as f:
+            texts = json.load(f)
+        # Índices guardados antes de la compresión no tienen meta.json: matriz float32 completa
+        meta_path = os.path.join(directory, "meta.json")
+        dim = None
+        if os.path.exists(meta_path):
+            with open(meta_path, "r", encoding="utf-8") as f:
+                dim = json.load(f).get("dim")
+        return cls(ids, texts, matrix, scales, full, dim=dim, pages=pages)
+
+
+class LocalVectorStore:
+    """
+    Conjunto de índices por material, cargados bajo demanda desde Supabase
+    (o desde disco si VECTOR_INDEX_DIR está configurado).
+    """
+
+    def __init__(self, directory: str = ""):
+        self.directory = directory
+        self._indexes: dict[int, MaterialIndex] = {}
+        self._lock = threading.Lock()
+
+    def _material_dir(self, material_id: int) -> str:
+        return os.path.join(self.directory, str(material_id))
+
+    def get(self, material_id: int) -> MaterialIndex:
+        with self._lock:
+            index = self._indexes.get(material_id)
+            if index is not None:
+                return index
+            directory = self._material_dir(material_id)
+            rebuilt = False
+            if self.directory and os.path.exists(os.path.join(directory, "matrix.npy")):
+                index = MaterialIndex.load(directory)
+                if not index.matches(VECTOR_INDEX_STORAGE, VECTOR_INDEX_DIMS):
+                    # Guardado con otra configuración de compresión: se recodifica desde los vectores
+                    # completos si están en disco; si no, se vuelve a leer de Supabase
+                    full = index.full_vectors()
+                    index = (MaterialIndex.from_vectors(index.ids, index.texts, np.array(full), VECTOR_INDEX_STORAGE,
+                                                        VECTOR_INDEX_DIMS, pages=index.pages) if full is not None else None)
+                    rebuilt = True
+            else:
+                index = None
+            if index is None:
+                index = MaterialIndex.from_rows(supabase_db.get_chunk_embeddings(material_id),
+                                                storage=VECTOR_INDEX_STORAGE, dims=VECTOR_INDEX_DIMS)
+                rebuilt = True
+            if rebuilt and self.directory and len(index):
+                index.save(directory)
+                # Recargado con memory-map: los vectores completos (rescoring) quedan en disco
+                index = MaterialIndex.load(directory)
+            self._indexes[material_id] = index
+            return index
+
+    def append(self, material_id: int, chunks: list[dict], embeddings: list):
+        # Actualización incremental desde create_embeddings. Si el material aún no está
+        # cargado no hacemos nada: se leerá completo de Supabase en la primera búsqueda.
+        with self._lock:
+            index = self._indexes.get(material_id)
+            if index is None:
+                self._drop_disk_copy(material_id)
+                return
+            rows = [{"id": ch["id"], "chunk_text": ch["chunk_text"], "page_start": ch.get("page_start"), "embedding": emb}
+                    for ch, emb in zip(chunks, embeddings)]
+            index.upsert(rows)
+
+    def persist(self, material_id: int):
+        # Guarda en disco el índice actualizado (se llama una vez al final de create_embeddings)
+        with self._lock:
+            index = self._indexes.get(material_id)
+            if self.directory and index is not None and len(index):
+                index.save(self._material_dir(material_id))
+                self._indexes[material_id] = MaterialIndex.load(self._material_dir(material_id))
+
+    def invalidate(self, material_id: int):
+        with self._lock:
+            self._indexes.pop(material_id, None)
+            self._drop_disk_copy(material_id)
+
+    def _drop_disk_copy(self, material_id: int):
+        if not self.directory:
+            return
+        for name in ("matrix.npy", "ids.npy", "texts.json", "scales.npy", "full.npy", "pages.npy", "meta.json"):
+            try:
+                os.remove(os.path.join(self._material_dir(material_id), name))
+            except FileNotFoundError:
+                pass
+
+
+# Instancia única del índice local
+local_index = LocalVectorStore(VECTOR_INDEX_DIR)
+
+
+@traced("vector_search")
+def vector_search(query_embedding: list, material_id: int, limit: int = 4) -> list[str]:
+    # Punto de entrada de la búsqueda vectorial para las rutas: usa el backend configurado
+    if VECTOR_SEARCH_BACKEND == "local":
+        results = local_index.get(material_id).search(query_embedding, VECTOR_MATCH_THRESHOLD, limit)
+        return [r["chunk_text"] for r in results]
+    return supabase_db.vector_search(query_embedding, material_id, limit)
+
+
+def vector_search_hits(query_embedding: list, material_id: int, limit: int = 4) -> list[dict]:
+    # Como vector_search pero devuelve las filas completas (id, chunk_text, similarity, page_start y,
+    # con el backend local, también el embedding) para el context builder
+    if VECTOR_SEARCH_BACKEND == "local":
+        return local_index.get(material_id).search(query_embedding, VECTOR_MATCH_THRESHOLD, limit, with_embeddings=True)
+    return supabase_db.vector_search_hits(query_embedding, material_id, limit)
+
+
+@traced("vector_search")
+async def avector_search_hits(query_embedding: list, material_id: int, limit: int = 4) -> list[dict]:
+    # Variante async de vector_search_hits. El backend local corre en un hilo
+    # (la primera búsqueda de un material lo carga desde Supabase o disco).
+    if VECTOR_SEARCH_BACKEND == "local":
+        return await asyncio.to_thread(vector_search_hits, query_embedding, material_id, limit)
+    return await supabase_async.vector_search_hits(query_embedding, material_id, limit)
+
+
+def vector_search_hits_many(query_embeddings: list, material_id: int, limit: int = 4) -> list[list[dict]]:
+    # vector_search_hits para varias consultas del mismo material: con el backend local es
+    # un solo producto matriz-matriz; con Supabase, un RPC por consulta
+    if VECTOR_SEARCH_BACKEND == "local":
+        return local_index.get(material_id).search_many(query_embeddings, VECTOR_MATCH_THRESHOLD, limit, with_embeddings=True)
+    return [supabase_db.vector_search_hits(q, material_id, limit) for q in query_embeddings]
+
+
+@traced("vector_search_many")
+async def avector_search_hits_many(query_embeddings: list, material_id: int, limit: int = 4) -> list[list[dict]]:
+    if VECTOR_SEARCH_BACKEND == "local":
+        return await asyncio.to_thread(vector_search_hits_many, query_embeddings, material_id, limit)
+    return list(await asyncio.gather(*[supabase_async.vector_search_hits(q, material_id, limit) for q in query_embeddings]))
@@ -0,0 +1,92 @@
+"""
+Benchmark del índice ANN (IVF) contra la búsqueda exacta.
+
+Genera embeddings sintéticos agrupados (similares a chunks de varios materiales),
+mide recall@k y latencia p50/p99 por consulta para distintos valores de nprobe.
+
+Uso (desde pre_hack_2/):
+    python -m benchmarks.bench_ann --n 100000 --queries 200 --nlist 256
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+from api.ann_index import IVFIndex, _normalize
+from api.vector_index import top_k_indices
+
+
+def make_dataset(n: int, dim: int, clusters: int, noise: float, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim)).astype(np.float32)
+    labels = rng.integers(0, clusters, size=n)
+    vectors = centers[labels] + noise * rng.normal(size=(n, dim)).astype(np.float32)
+    return _normalize(vectors)
+
+
+def percentile_ms(samples: list[float], q: float) -> float:
+    return round(float(np.percentile(samples, q)) * 1000, 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n", type=int, default=100_000)
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--nlist", type=int, default=256)
+    parser.add_argument("--materials", type=int, default=1000)
+    parser.add_argument("--clusters", type=int, default=500)
+    parser.add_argument("--noise", type=float, default=1.5, help="dispersión alrededor de cada centro (más alto = más difícil)")
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32, 64])
+    args = parser.parse_args()
+
+    vectors = make_dataset(args.n + args.queries, args.dim, clusters=args.clusters, noise=args.noise)
+    data, queries = vectors[:args.n], vectors[args.n:]
+    material_ids = np.arange(args.n) % args.materials
+
+    index = IVFIndex(dim=args.dim, nlist=args.nlist)
+    start = time.perf_counter()
+    # Inserción incremental por lotes, como lo hace create_embeddings
+    for s in range(0, args.n, 100):
+        e = min(s + 100, args.n)
+        for m in np.unique(material_ids[s:e]):
+            mask = material_ids[s:e] == m
+            index.add(np.arange(s, e)[mask], data[s:e][mask], int(m), f"user-{m % 50}")
+    # El entrenamiento de los centroides corre en segundo plano: se cuenta dentro del build
+    index.wait_for_training()
+    build_s = time.perf_counter() - start
+
+    # Búsqueda exacta (referencia)
+    exact_ids, exact_times = [], []
+    for q in queries:
+        t = time.perf_counter()
+        exact_ids.append(set(top_k_indices(data @ q, args.k).tolist()))
+        exact_times.append(time.perf_counter() - t)
+
+    results = {
+        "n": args.n, "dim": args.dim, "k": args.k, "nlist": args.nlist,
+        "build_s": round(build_s, 2),
+        "exact": {"p50_ms": percentile_ms(exact_times, 50), "p99_ms": percentile_ms(exact_times, 99)},
+        "ivf": [],
+    }
+    for nprobe in args.nprobe:
+        recalls, times = [], []
+        for q, truth in zip(queries, exact_ids):
+            t = time.perf_counter()
+            hits = index.search(q, k=args.k, nprobe=nprobe)
+            times.append(time.perf_counter() - t)
+            recalls.append(len(truth & {h["id"] for h in hits}) / args.k)
+        results["ivf"].append({
+            "nprobe": nprobe,
+            f"recall@{args.k}": round(float(np.mean(recalls)), 4),
+            "p50_ms": percentile_ms(times, 50),
+            "p99_ms": percentile_ms(times, 99),
+        })
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
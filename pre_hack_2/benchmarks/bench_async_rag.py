@@ -0,0 +1,137 @@
+"""
+Prueba de carga del request path RAG (generate_flashcards) en un único worker:
+ruta síncrona en el threadpool (antes) vs ruta async de punta a punta (ahora).
+
+Gemini y Supabase se reemplazan por dobles que solo esperan la latencia configurada
+(time.sleep en la versión síncrona, asyncio.sleep en la async). Las peticiones pasan por
+FastAPI (httpx + ASGITransport), así que la ruta síncrona queda limitada por el threadpool
+de AnyIO (40 hilos por defecto) igual que en producción. Se mide cuántas peticiones llegan
+a estar esperando a Gemini a la vez y el throughput.
+
+Uso (desde pre_hack_2/):
+    python -m benchmarks.bench_async_rag --requests 400 --llm-latency 0.5
+"""
+import argparse
+import asyncio
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+import httpx
+from fastapi import FastAPI
+
+from api import gemini
+from api.routes import generate as generate_module
+
+
+class InFlight:
+    def __init__(self):
+        self.current = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        with self._lock:
+            self.current += 1
+            self.peak = max(self.peak, self.current)
+
+    def __exit__(self, *exc):
+        with self._lock:
+            self.current -= 1
+
+
+def install_fakes(llm_latency: float, embed_latency: float, db_latency: float) -> InFlight:
+    inflight = InFlight()
+    answer = json.dumps({"flashcards": [{"question": "¿Qué es la clorofila?", "answer": "Un pigmento."}]})
+    embedding = SimpleNamespace(embeddings=[SimpleNamespace(values=[0.1] * 8)])
+
+    class SyncModels:
+        def embed_content(self, model, contents):
+            time.sleep(embed_latency)
+            return embedding
+
+        def generate_content(self, model, contents, config):
+            with inflight:
+                time.sleep(llm_latency)
+            return SimpleNamespace(text=answer)
+
+    class AsyncModels:
+        async def embed_content(self, model, contents):
+            await asyncio.sleep(embed_latency)
+            return embedding
+
+        async def generate_content(self, model, contents, config):
+            with inflight:
+                await asyncio.sleep(llm_latency)
+            return SimpleNamespace(text=answer)
+
+    gemini.client = SimpleNamespace(models=SyncModels(), aio=SimpleNamespace(models=AsyncModels()))
+    gemini.embedding_cache = None
+
+    async def aretrieve_context(query, material_id, top_k=4, query_embedding=None, mode=None):
+        await asyncio.sleep(db_latency)
+        return {"context": "contexto", "selected": 4, "context_tokens": 900, "retrieval_mode": mode}
+
+    async def insert_tool(material_id, tool_type, data):
+        await asyncio.sleep(db_latency)
+        return 1
+
+    generate_module.aretrieve_context = aretrieve_context
+    # Se mide el camino con embedding (las consultas cortas irían solo por BM25, ver bench_retrieval_modes)
+    generate_module.choose_retrieval_mode = lambda query: "dense"
+    generate_module.insert_tool = insert_tool
+    generate_module.flashcards_cache.lookup = lambda *args: None
+    generate_module.flashcards_cache.store = lambda *args: None
+
+    app = FastAPI()
+    app.include_router(generate_module.router)
+
+    @app.post("/before/{material_id}")
+    def blocking_flashcards(material_id: int, query: str):
+        # Réplica del flujo anterior: todo síncrono dentro de un def (corre en el threadpool)
+        query_embedding = gemini.get_embedding(query)
+        time.sleep(db_latency)  # vector_search
+        flashcards = gemini.generate_flashcards(context="contexto", query=query)
+        time.sleep(db_latency)  # insert_tool
+        return {"flashcards": flashcards, "dims": len(query_embedding)}
+
+    return inflight, app
+
+
+async def run_mode(app, path: str, requests: int, inflight: InFlight) -> dict:
+    inflight.peak = 0
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        start = time.perf_counter()
+        responses = await asyncio.gather(*[
+            client.post(path.format(material_id=1), params={"query": f"consulta {i}"}) for i in range(requests)
+        ])
+        elapsed = time.perf_counter() - start
+    return {
+        "ok": sum(r.status_code == 200 for r in responses),
+        "peak_inflight_llm_calls": inflight.peak,
+        "total_s": round(elapsed, 3),
+        "requests_per_sec": round(requests / elapsed, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--llm-latency", type=float, default=0.5)
+    parser.add_argument("--embed-latency", type=float, default=0.05)
+    parser.add_argument("--db-latency", type=float, default=0.03)
+    args = parser.parse_args()
+
+    inflight, app = install_fakes(args.llm_latency, args.embed_latency, args.db_latency)
+    results = {
+        "requests": args.requests,
+        "before": asyncio.run(run_mode(app, "/before/{material_id}", args.requests, inflight)),
+        "after": asyncio.run(run_mode(app, "/material/{material_id}/generate_flashcards", args.requests, inflight)),
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+"""
+Benchmark del endpoint por lotes POST /flashcards/batch contra N llamadas a la ruta individual
+/material/{id}/generate_flashcards (una tras otra y todas a la vez).
+
+Gemini se reemplaza por un cliente en proceso: embed_content devuelve embeddings de bolsa de
+palabras (HashingEmbedder de bench_context) tras --embed-latency segundos y generate_content
+espera una latencia distinta por consulta (entre 0.5x y 1.5x de --llm-latency) y cuenta cuántas
+llamadas llegan a estar en vuelo. La recuperación es la real (índice vectorial local + BM25) sobre
+--materials documentos sintéticos; insert_tool espera --db-latency. El planificador de Gemini se
+desactiva para medir solo el flujo (con él, las llamadas además respetan GEMINI_*_RPM).
+Las consultas son preguntas largas, así que todas pasan por embedding (densa o híbrida según RETRIEVAL_MODE).
+
+Se reporta el tiempo total, el tiempo hasta el primer resultado, la petición individual más lenta
+y cuántas llamadas a embed_content se hicieron. Entre modos se vacían las cachés de consultas
+y de flashcards.
+
+Uso (desde pre_hack_2/):
+    python -m benchmarks.bench_batch_generation --topics 50 --materials 5 --llm-latency 1.0
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import zlib
+from types import SimpleNamespace
+
+import httpx
+from fastapi import FastAPI
+
+from api import gemini, vector_index, batch_generation
+from api.routes import generate as generate_module
+from api.gemini_scheduler import gemini_scheduler
+from api.lexical_index import lexical_index, BM25Index
+from api.query_cache import query_embedding_memo
+from api.response_cache import flashcards_cache
+from api.text_processing import iter_chunks
+from api.vector_index import local_index, MaterialIndex
+from benchmarks.bench_async_rag import InFlight
+from benchmarks.bench_context import HashingEmbedder, make_document
+
+
+def build_materials(num_materials: int, pages: int, seed: int) -> tuple[HashingEmbedder, dict]:
+    documents = {m: make_document(pages, 2, seed + m * 1000) for m in range(1, num_materials + 1)}
+    chunks = {m: list(iter_chunks(pages_)) for m, (pages_, _) in documents.items()}
+    embed = HashingEmbedder([c["chunk_text"] for material in chunks.values() for c in material])
+    next_id = 1
+    for material_id, material_chunks in chunks.items():
+        rows = [{"id": next_id + i, "chunk_text": c["chunk_text"]} for i, c in enumerate(material_chunks)]
+        next_id += len(rows)
+        local_index._indexes[material_id] = MaterialIndex.from_rows([{**r, "embedding": embed(r["chunk_text"])} for r in rows])
+        lexical_index._indexes[material_id] = BM25Index.from_rows(rows)
+    vector_index.VECTOR_SEARCH_BACKEND = "local"
+    vector_index.VECTOR_MATCH_THRESHOLD = 0.0
+    return embed, {m: facts for m, (_, facts) in documents.items()}
+
+
+def install_fakes(embed: HashingEmbedder, llm_latency: float, embed_latency: float, db_latency: float):
+    inflight = InFlight()
+    counters = {"embed_calls": 0, "embedded_texts": 0}
+    answer = json.dumps({"flashcards": [{"question": "¿Qué es la clorofila?", "answer": "Un pigmento."}]})
+
+    class AsyncModels:
+        async def embed_content(self, model, contents):
+            counters["embed_calls"] += 1
+            counters["embedded_texts"] += len(contents)
+            await asyncio.sleep(embed_latency)
+            return SimpleNamespace(embeddings=[SimpleNamespace(values=embed(text).tolist()) for text in contents])
+
+        async def generate_content(self, model, contents, config):
+            # Latencia estable por prompt: la misma consulta tarda lo mismo en los tres modos
+            prompt = contents[0]["parts"][0]["text"]
+            factor = 0.5 + (zlib.crc32(prompt.encode()) % 1000) / 1000
+            with inflight:
+                await asyncio.sleep(llm_latency * factor)
+            return SimpleNamespace(text=answer)
+
+    gemini.client = SimpleNamespace(aio=SimpleNamespace(models=AsyncModels()))
+    gemini.embedding_cache = None
+    gemini_scheduler.enabled = False
+
+    async def insert_tool(material_id, tool_type, data):
+        await asyncio.sleep(db_latency)
+        return 1
+
+    generate_module.insert_tool = insert_tool
+    batch_generation.insert_tool = insert_tool
+
+    app = FastAPI()
+    app.include_router(generate_module.router)
+    return app, inflight, counters
+
+
+def reset(materials: list[int], inflight: InFlight, counters: dict):
+    query_embedding_memo._entries.clear()
+    for material_id in materials:
+        flashcards_cache.invalidate_material(material_id)
+    inflight.peak = 0
+    counters["embed_calls"] = counters["embedded_texts"] = 0
+
+
+async def run_single(client: httpx.AsyncClient, items: list[dict], concurrent: bool) -> dict:
+    start = time.perf_counter()
+    latencies, finished = [], []
+
+    async def one(item: dict) -> int:
+        sent = time.perf_counter()
+        response = await client.post(f"/material/{item['material_id']}/generate_flashcards",
+                                     params={"query": item["query"], "num_flashcards": item["num_flashcards"]})
+        latencies.append(time.perf_counter() - sent)
+        finished.append(time.perf_counter() - start)
+        return response.status_code
+
+    if concurrent:
+        statuses = await asyncio.gather(*[one(item) for item in items])
+    else:
+        statuses = [await one(item) for item in items]
+    return {
+        "ok": sum(status == 200 for status in statuses),
+        "total_s": round(time.perf_counter() - start, 3),
+        "first_result_s": round(min(finished), 3),
+        "slowest_request_s": round(max(latencies), 3),
+    }
+
+
+async def run_batch(items: list[dict], concurrency: int) -> dict:
+    # Se itera el cuerpo de la respuesta directamente (como bench_streaming): ASGITransport de httpx
+    # acumula la respuesta completa y no dejaría ver cuándo llega cada resultado
+    start = time.perf_counter()
+    response = await generate_module.generate_flashcards_batch_route(
+        [generate_module.BatchFlashcardsItem(**item) for item in items], concurrency)
+    first, results, done = None, 0, {}
+    async for part in response.body_iterator:
+        if part.startswith("event: result"):
+            results += 1
+            first = first if first is not None else time.perf_counter() - start
+        elif part.startswith("event: done"):
+            done = json.loads(part.split("data: ", 1)[1])
+    return {
+        "ok": done.get("ok", 0),
+        "results": results,
+        "total_s": round(time.perf_counter() - start, 3),
+        "first_result_s": round(first, 3) if first is not None else None,
+    }
+
+
+async def run(args) -> dict:
+    embed, facts = build_materials(args.materials, args.pages, args.seed)
+    app, inflight, counters = install_fakes(embed, args.llm_latency, args.embed_latency, args.db_latency)
+    rng = random.Random(args.seed)
+    items = []
+    # Temas distintos (sin repetir material + hecho), así ninguna consulta sale de la caché
+    topics = rng.sample([(m, a) for m in facts for a in range(len(facts[m]))], args.topics)
+    for material_id, a in topics:
+        items.append({"material_id": material_id, "num_flashcards": 6, "top_k": 4,
+                      "query": f"qué se sabe del concepto clave{a} y de su propiedad{a} en el sistema{a}"})
+
+    results = {"topics": args.topics, "materials": args.materials, "llm_latency_s": args.llm_latency}
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        modes = [("single_sequential", lambda: run_single(client, items, concurrent=False)),
+                 ("single_concurrent", lambda: run_single(client, items, concurrent=True))]
+        modes += [(f"batch_concurrency_{c}", lambda c=c: run_batch(items, c)) for c in args.concurrency]
+        for name, measure in modes:
+            reset(list(facts), inflight, counters)
+            results[name] = {**await measure(), "embed_calls": counters["embed_calls"],
+                             "peak_inflight_llm_calls": inflight.peak}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--topics", type=int, default=50)
+    parser.add_argument("--materials", type=int, default=5)
+    parser.add_argument("--pages", type=int, default=100, help="Páginas por material")
+    parser.add_argument("--llm-latency", type=float, default=1.0, help="Segundos por generación (media)")
+    parser.add_argument("--embed-latency", type=float, default=0.1)
+    parser.add_argument("--db-latency", type=float, default=0.03)
+    parser.add_argument("--concurrency", type=lambda v: [int(c) for c in v.split(",")], default=[8, 50],
+                        help="Concurrencias de generación del lote a medir (separadas por coma)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+Benchmark de la escritura de chunks (insert_chunks) contra un PostgREST falso local.
+
+Compara el INSERT único anterior (todas las filas en una petición, devuelve len(chunks)
+pase lo que pase) con ChunkWriter: lotes acotados en filas/bytes, en serie y en paralelo,
+y en paralelo con fallos inyectados (503 antes del commit y respuestas perdidas después del
+commit). Para cada modo: filas que se dijo haber escrito, filas realmente guardadas,
+duplicados y filas/s.
+
+Uso (desde pre_hack_2/):
+    python -m benchmarks.bench_chunk_insert --chunks 5000 --concurrency 4
+"""
+import argparse
+import json
+import random
+import time
+from collections import Counter
+
+from postgrest import SyncPostgrestClient
+
+from api import supabase as supabase_module
+from api.config import CHUNK_INSERT_BATCH_ROWS, CHUNK_INSERT_BATCH_KB
+from api.chunk_writer import ChunkWriter
+from api.text_processing import estimate_tokens
+from benchmarks.fake_postgrest import FakePostgrestServer
+
+MATERIAL_ID = 1
+
+
+def make_chunks(count: int, chars: int, repeated_ratio: float, seed: int = 0) -> list[dict]:
+    rng = random.Random(seed)
+    words = [f"palabra{i}" for i in range(2000)]
+    footer = "Universidad de ejemplo - Apuntes de Biología - uso exclusivo del curso. " * (chars // 70)
+    chunks = []
+    for i in range(count):
+        # Una parte de los chunks se repite (pies de página): mismo chunk_hash en varias filas
+        text = footer if rng.random() < repeated_ratio else " ".join(rng.choice(words) for _ in range(chars // 9))
+        chunks.append({
+            "chunk_text": text,
+            "chunk_hash": f"{hash(text) & 0xFFFFFFFFFFFF:012x}",
+            "token_count": estimate_tokens(text),
+            "page_start": i // 4 + 1,
+            "page_end": i // 4 + 1,
+        })
+    return chunks
+
+
+def single_insert(rows: list[dict]) -> int:
+    # Comportamiento anterior de insert_chunks: una petición y len(chunks) como resultado
+    try:
+        supabase_module.supabase.table('material_chunks').insert(
+            [{"material_id": MATERIAL_ID, **row} for row in rows]).execute()
+        return len(rows)
+    except Exception as e:
+        print(f"(antes) Error al insertar chunks: {str(e)[:80]}")
+        return 0
+
+
+def run(server: FakePostgrestServer, chunks: list[dict], write) -> dict:
+    server.reset()
+    start = time.perf_counter()
+    reported = write(chunks)
+    elapsed = time.perf_counter() - start
+    stored = len(server.rows)
+    return {
+        "reported_rows": reported,
+        "stored_rows": stored,
+        "missing_rows": max(0, len(chunks) - stored),
+        "duplicate_rows": max(0, stored - len(chunks)),
+        "elapsed_s": round(elapsed, 3),
+        "rows_per_sec": round(stored / elapsed, 1) if elapsed > 0 else 0.0,
+        "server": dict(server.counts),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, default=5000)
+    parser.add_argument("--chars", type=int, default=1200)
+    parser.add_argument("--repeated", type=float, default=0.03, help="Fracción de chunks repetidos")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--batch-rows", type=int, default=CHUNK_INSERT_BATCH_ROWS)
+    parser.add_argument("--batch-kb", type=int, default=CHUNK_INSERT_BATCH_KB)
+    parser.add_argument("--max-body-mb", type=float, default=4.0, help="Límite de payload del servidor")
+    parser.add_argument("--error-rate", type=float, default=0.05)
+    parser.add_argument("--lost-rate", type=float, default=0.05)
+    args = parser.parse_args()
+
+    chunks = make_chunks(args.chunks, args.chars, args.repeated)
+    max_body = int(args.max_body_mb * 1024 * 1024)
+    results = {"chunks": len(chunks)}
+
+    def writer(concurrency: int) -> ChunkWriter:
+        return ChunkWriter(
+            supabase_module._insert_chunk_rows, supabase_module.count_chunk_hashes,
+            batch_rows=args.batch_rows, batch_bytes=args.batch_kb * 1024, concurrency=concurrency,
+            max_retries=4, backoff_base_s=0.05, backoff_max_s=0.5,
+        )
+
+    def write_with(chunk_writer: ChunkWriter):
+        return lambda rows: chunk_writer.write(MATERIAL_ID, rows, Counter())["inserted"]
+
+    with FakePostgrestServer(max_body_bytes=max_body) as server:
+        supabase_module.supabase = SyncPostgrestClient(server.base_url)
+        results["before_single_insert"] = run(server, chunks, single_insert)
+        results["before_single_insert_small_doc"] = run(server, chunks[:args.batch_rows], single_insert)
+        results["writer_sequential"] = run(server, chunks, write_with(writer(1)))
+        results["writer_parallel"] = run(server, chunks, write_with(writer(args.concurrency)))
+
+    with FakePostgrestServer(max_body_bytes=max_body, error_rate=args.error_rate, lost_rate=args.lost_rate, seed=1) as server:
+        supabase_module.supabase = SyncPostgrestClient(server.base_url)
+        results["before_small_doc_with_faults"] = run(
+            server, chunks[:args.batch_rows * 4],
+            lambda rows: sum(single_insert(rows[i:i + args.batch_rows]) for i in range(0, len(rows), args.batch_rows)))
+        results["writer_parallel_with_faults"] = run(server, chunks, write_with(writer(args.concurrency)))
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
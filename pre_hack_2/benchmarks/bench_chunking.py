@@ -0,0 +1,78 @@
+"""
+Micro-benchmark de throughput de los chunkers (MB/s de texto de entrada).
+
+Compara split_text_simple (implementación original, todo el texto en memoria) con los
+chunkers por streaming: "fixed" (iter_chunks), "cdc" (iter_chunks_cdc) y "tokens"
+(iter_chunks_tokens). También reporta los tokens estimados por chunk, para ver qué tan
+parejo llena cada modo el presupuesto del modelo de embeddings.
+
+Uso (desde pre_hack_2/):
+    python -m benchmarks.bench_chunking --pages 300 --repeat 3
+"""
+import argparse
+import json
+import statistics
+import time
+
+from api.text_processing import (
+    split_text_simple, iter_chunks, iter_chunks_cdc, iter_chunks_tokens, estimate_tokens,
+)
+from benchmarks.fixtures import make_text
+
+
+def make_pages(num_pages: int, words_per_page: int, math_ratio: float) -> list[tuple[int, str]]:
+    pages = []
+    for p in range(num_pages):
+        text = make_text(words_per_page, seed=p)
+        # Parte de las páginas con notación matemática densa (muchos tokens por carácter)
+        if p < num_pages * math_ratio:
+            text += " " + " ".join(f"∫_{i}^{i + 1} x^{i} dx = {i}/{i + 1}" for i in range(words_per_page // 8))
+        pages.append((p + 1, text))
+    return pages
+
+
+def run(name: str, chunker, pages, megabytes: float, repeat: int) -> dict:
+    best = float("inf")
+    chunks = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        chunks = chunker(pages)
+        best = min(best, time.perf_counter() - start)
+    tokens = [estimate_tokens(c) for c in chunks]
+    return {
+        "chunker": name,
+        "mb_per_s": round(megabytes / best, 2),
+        "chunks": len(chunks),
+        "tokens_mean": round(statistics.mean(tokens), 1),
+        "tokens_stdev": round(statistics.pstdev(tokens), 1),
+        "tokens_max": max(tokens),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=300)
+    parser.add_argument("--words-per-page", type=int, default=400)
+    parser.add_argument("--math-ratio", type=float, default=0.3)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    pages = make_pages(args.pages, args.words_per_page, args.math_ratio)
+    megabytes = sum(len(t.encode("utf-8")) for _, t in pages) / 1e6
+
+    chunkers = {
+        "split_text_simple": lambda pages: split_text_simple("\n".join(t for _, t in pages)),
+        "fixed": lambda pages: [c["chunk_text"] for c in iter_chunks(pages)],
+        "cdc": lambda pages: [c["chunk_text"] for c in iter_chunks_cdc(pages)],
+        "tokens": lambda pages: [c["chunk_text"] for c in iter_chunks_tokens(pages)],
+    }
+    results = {
+        "input_mb": round(megabytes, 2),
+        "pages": args.pages,
+        "results": [run(name, fn, pages, megabytes, args.repeat) for name, fn in chunkers.items()],
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
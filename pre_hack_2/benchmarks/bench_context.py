@@ -0,0 +1,112 @@
+"""
+Benchmark del armado de contexto RAG: top-k unido con "---" (antes) vs context builder (ahora).
+
+Se genera un documento sintético con "hechos" únicos sembrados en posiciones conocidas
+y párrafos repetidos (como los encabezados/resúmenes que se repiten en los apuntes).
+Los embeddings son bolsas de palabras con hashing y pesos IDF, así no se llama a Gemini.
+Cada consulta pregunta por dos hechos; el recall es la fracción de hechos pedidos
+cuyo texto aparece completo en el contexto final.
+
+Uso (desde pre_hack_2/):
+    python -m benchmarks.bench_context --pages 60 --queries 200 --top-k 4
+"""
+import argparse
+import json
+import random
+import re
+import statistics
+import zlib
+
+import numpy as np
+
+from api.context_builder import build_context, CONTEXT_SEPARATOR
+from api.text_processing import iter_chunks, estimate_tokens
+from api.vector_index import MaterialIndex
+from benchmarks.fixtures import make_text
+
+DIM = 4096
+
+
+class HashingEmbedder:
+    """Bolsa de palabras con hashing y pesos IDF (las palabras distintivas dominan, como en un embedding real)."""
+
+    def __init__(self, corpus: list[str]):
+        df = {}
+        for text in corpus:
+            for word in set(re.findall(r"\w+", text.lower())):
+                df[word] = df.get(word, 0) + 1
+        self.idf = {word: np.log((1 + len(corpus)) / (1 + count)) + 1.0 for word, count in df.items()}
+        self.default_idf = np.log(1 + len(corpus)) + 1.0
+
+    def __call__(self, text: str) -> np.ndarray:
+        vector = np.zeros(DIM, dtype=np.float32)
+        for word in re.findall(r"\w+", text.lower()):
+            vector[zlib.crc32(word.encode()) % DIM] += self.idf.get(word, self.default_idf)
+        return vector
+
+
+def make_document(num_pages: int, facts_per_page: int, seed: int):
+    rng = random.Random(seed)
+    repeated = make_text(60, seed=999_999)  # párrafo que se repite en varias páginas
+    facts = []
+    pages = []
+    for p in range(num_pages):
+        parts = [make_text(120, seed=seed + p)]
+        for f in range(facts_per_page):
+            fact_id = len(facts)
+            fact = f"el concepto clave{fact_id} se define como propiedad{fact_id} del sistema{fact_id}."
+            facts.append(fact)
+            parts.append(fact)
+            parts.append(make_text(rng.randint(60, 140), seed=seed + p * 31 + f))
+        if p % 3 == 0:
+            parts.append(repeated)
+        pages.append((p + 1, " ".join(parts)))
+    return pages, facts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=60)
+    parser.add_argument("--facts-per-page", type=int, default=2)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=4)
+    parser.add_argument("--budget", type=int, default=None, help="Presupuesto de tokens (por defecto CONTEXT_TOKEN_BUDGET)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    pages, facts = make_document(args.pages, args.facts_per_page, args.seed)
+    chunks = list(iter_chunks(pages))  # ventanas de 1200 caracteres con 200 de solapamiento
+    embed = HashingEmbedder([c["chunk_text"] for c in chunks])
+    index = MaterialIndex.from_rows([
+        {"id": i + 1, "chunk_text": c["chunk_text"], "embedding": embed(c["chunk_text"])}
+        for i, c in enumerate(chunks)
+    ])
+
+    rng = random.Random(args.seed)
+    budget_kwargs = {"token_budget": args.budget} if args.budget else {}
+    stats = {"before": {"tokens": [], "recall": []}, "after": {"tokens": [], "recall": []}}
+    for _ in range(args.queries):
+        asked = rng.sample(range(len(facts)), 2)
+        query = embed(" ".join(f"clave{a} propiedad{a} sistema{a}" for a in asked))
+
+        hits = index.search(query, match_threshold=-1.0, match_count=args.top_k * 3, with_embeddings=True)
+        before = CONTEXT_SEPARATOR.join(h["chunk_text"] for h in hits[:args.top_k])
+        after = build_context(hits, max_chunks=args.top_k, **budget_kwargs)["context"]
+
+        for name, context in (("before", before), ("after", after)):
+            stats[name]["tokens"].append(estimate_tokens(context))
+            stats[name]["recall"].append(sum(facts[a] in context for a in asked) / len(asked))
+
+    summary = {
+        name: {
+            "prompt_tokens_mean": round(statistics.mean(values["tokens"]), 1),
+            "prompt_tokens_p95": sorted(values["tokens"])[int(0.95 * (len(values["tokens"]) - 1))],
+            "recall": round(statistics.mean(values["recall"]), 4),
+        }
+        for name, values in stats.items()
+    }
+    print(json.dumps({"chunks": len(chunks), "facts": len(facts), "top_k": args.top_k, **summary}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Benchmark de la deduplicación de uploads: el mismo PDF subido por varios usuarios.
+
+La primera subida hace el trabajo completo (Storage, extracción, chunking, inserción y
+embeddings); las siguientes encuentran el material por el sha256 del archivo y copian sus
+chunks y embeddings, dentro de Postgres con el RPC clone_material_chunks o, si no está
+instalado, leyéndolos e insertándolos desde la API (se miden ambos casos).
+Supabase es un PostgREST falso local (benchmarks/fake_postgrest.py),
+Gemini un servidor falso (benchmarks/fake_gemini.py) y Storage una función que duerme
+la latencia configurada. Se mide el tiempo de ingest_pdf + embed_material (como un job) y
+las llamadas a Storage y a Gemini de cada subida.
+
+Uso (desde pre_hack_2/):
+    python -m benchmarks.bench_dedup --pages 60 --uploads 5
+"""
+import argparse
+import json
+import time
+
+from google import genai
+from google.genai import types
+from postgrest import SyncPostgrestClient
+
+from api import gemini, ingestion
+from api import supabase as supabase_module
+from api.gemini_scheduler import GeminiScheduler
+from benchmarks.fake_gemini import FakeGeminiServer
+from benchmarks.fake_postgrest import FakePostgrestServer
+from benchmarks.fixtures import make_document_pdf
+
+
+def clone_material_chunks(server: FakePostgrestServer, source_material_id: int, target_material_id: int) -> int:
+    # Equivalente en memoria del INSERT ... SELECT del RPC (ver api.supabase.clone_chunks)
+    rows = [row for row in server.rows if row["material_id"] == source_material_id]
+    for row in rows:
+        server.next_id["material_chunks"] += 1
+        server.rows.append({**row, "id": server.next_id["material_chunks"], "material_id": target_material_id})
+    return len(rows)
+
+
+def run_uploads(db: FakePostgrestServer, llm: FakeGeminiServer, pdf: bytes, uploads: int, storage_calls: list) -> dict:
+    results = []
+    for i in range(uploads):
+        storage_before, gemini_before = len(storage_calls), llm.counts["ok"]
+        start = time.perf_counter()
+        result = ingestion.ingest_pdf(pdf, f"user-{i}", "Apuntes de Biología", "biologia.pdf")
+        report = ingestion.embed_material(result["material_id"])
+        elapsed = time.perf_counter() - start
+        chunks = [row for row in db.rows if row["material_id"] == result["material_id"]]
+        results.append({
+            "material_id": result["material_id"],
+            "deduplicated_from": result.get("deduplicated_from"),
+            "chunks": result["chunks_count"],
+            "chunks_with_embedding": sum(row.get("embedding") is not None for row in chunks),
+            "embedded_now": report["processed"] if report else 0,
+            "storage_uploads": len(storage_calls) - storage_before,
+            "gemini_calls": llm.counts["ok"] - gemini_before,
+            "elapsed_s": round(elapsed, 3),
+        })
+    first, rest = results[0], results[1:]
+    dup_mean = sum(u["elapsed_s"] for u in rest) / len(rest) if rest else 0.0
+    return {
+        "uploads": results,
+        "first_upload_s": first["elapsed_s"],
+        "duplicate_upload_mean_s": round(dup_mean, 3),
+        "speedup": round(first["elapsed_s"] / dup_mean, 1) if dup_mean else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=60)
+    parser.add_argument("--uploads", type=int, default=5)
+    parser.add_argument("--storage-latency", type=float, default=0.5)
+    parser.add_argument("--embed-latency", type=float, default=0.3, help="Latencia de cada llamada batchEmbedContents")
+    args = parser.parse_args()
+
+    pdf = make_document_pdf(args.pages)
+    storage_calls = []
+
+    def upload_pdf_to_storage(user_id, file_name, file_content, upsert=False):
+        file_content.read()
+        storage_calls.append(file_name)
+        time.sleep(args.storage_latency)
+        return f"http://storage.local/materials/{user_id}/{file_name}"
+
+    ingestion.upload_pdf_to_storage = upload_pdf_to_storage
+    gemini.embedding_cache = None  # sin caché local: la primera subida paga todos los embeddings
+    gemini.gemini_scheduler = GeminiScheduler({}, {}, 10**6, 10**9, 0, 0, 0, enabled=False)
+
+    results = {"pages": args.pages, "pdf_bytes": len(pdf)}
+    with FakePostgrestServer(latency_s=0.01) as db, FakeGeminiServer(1000, latency_s=args.embed_latency) as llm:
+        supabase_module.supabase = SyncPostgrestClient(db.base_url)
+        gemini.client = genai.Client(api_key="fake", http_options=types.HttpOptions(base_url=llm.base_url))
+
+        db.rpcs["clone_material_chunks"] = clone_material_chunks
+        results["with_clone_rpc"] = run_uploads(db, llm, pdf, args.uploads, storage_calls)
+        db.reset()
+        db.rpcs.clear()
+        results["without_clone_rpc"] = run_uploads(db, llm, pdf, args.uploads, storage_calls)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+"""
+Benchmark de punta a punta sin servicios externos: la app completa (api.main.app) contra un
+Supabase falso (benchmarks/fake_postgrest.py: tablas, Storage y match_material_chunks) y un
+Gemini falso (benchmarks/fake_gemini.py: embeddings aleatorios con semilla por texto y
+flashcards JSON fijas), ambos servidores HTTP locales usados a través de los clientes reales
+(supabase-py sync y async, google-genai). Todo es determinista para una misma --seed.
+
+Fases, cada una con su concurrencia (peticiones en vuelo a la vez):
+  1. upload:     POST /api/upload_pdf con --materials PDFs distintos de --pages páginas
+  2. embeddings: POST /api/material/{id}/create_embeddings para cada material
+  3. generate:   --requests peticiones repartidas entre generate_flashcards, su variante
+                 /stream y feynman_feedback, con consultas distintas (sin aciertos de caché)
+
+Las peticiones pasan por FastAPI en proceso (httpx + ASGITransport), así que la latencia incluye
+middlewares, validación y serialización; las respuestas en streaming se miden completas.
+Por fase se reporta throughput, latencia p50/p99 (ms), errores, llamadas a los servicios falsos y
+el pico de memoria residente del proceso (ru_maxrss: incluye los servidores falsos, que corren en
+hilos del mismo proceso). El planificador de Gemini está desactivado salvo con --scheduler.
+La salida es JSON (también en --output) para comparar corridas y detectar regresiones.
+
+Uso (desde pre_hack_2/):
+    python -m benchmarks.bench_e2e --materials 8 --pages 30 --requests 200 --generate-concurrency 32
+"""
+import argparse
+import asyncio
+import json
+import resource
+import sys
+import time
+
+import httpx
+from google import genai
+from google.genai import types
+from supabase import create_client
+
+from api import gemini, supabase_async, vector_index
+from api import supabase as supabase_module
+from api.gemini_scheduler import gemini_scheduler
+from api.routes import generate as generate_module
+from benchmarks.fake_gemini import FakeGeminiServer
+from benchmarks.fake_postgrest import FakePostgrestServer
+from benchmarks.fixtures import make_document_pdf
+
+GENERATION_ROUTES = ("flashcards", "flashcards_stream", "feynman")
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss está en KB en Linux y en bytes en macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (2**20 if sys.platform == "darwin" else 2**10), 1)
+
+
+def _pct(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(p * len(values)))] * 1000, 2)
+
+
+async def run_phase(requests: list, concurrency: int, db: FakePostgrestServer, llm: FakeGeminiServer) -> tuple[dict, list]:
+    # `requests`: corrutinas sin argumentos que hacen una petición y retornan la respuesta httpx
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    latencies, responses = [], []
+    db_before, llm_before = dict(db.counts), dict(llm.counts)
+
+    async def one(send):
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                response = await send()
+            except Exception as e:
+                print(f"Error en la petición del benchmark: {e}")
+                response = None
+            latencies.append(time.perf_counter() - start)
+            return response
+
+    start = time.perf_counter()
+    responses = await asyncio.gather(*[one(send) for send in requests])
+    elapsed = time.perf_counter() - start
+    ok = [r for r in responses if r is not None and r.status_code == 200 and "event: error" not in r.text]
+    return {
+        "requests": len(requests),
+        "concurrency": concurrency,
+        "ok": len(ok),
+        "errors": len(requests) - len(ok),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(requests) / elapsed, 2) if elapsed > 0 else 0.0,
+        "latency_ms_p50": _pct(latencies, 0.5),
+        "latency_ms_p99": _pct(latencies, 0.99),
+        "latency_ms_max": _pct(latencies, 1.0),
+        "gemini_calls": llm.counts["ok"] - llm_before.get("ok", 0),
+        "db_selects": db.counts["selects"] - db_before.get("selects", 0),
+        "db_rpcs": db.counts["rpcs"] - db_before.get("rpcs", 0),
+        "db_committed_batches": db.counts["committed_batches"] - db_before.get("committed_batches", 0),
+        "peak_rss_mb": peak_rss_mb(),
+    }, responses
+
+
+def generation_request(client: httpx.AsyncClient, route: str, material_id: int, i: int):
+    query = f"explica el concepto {i} del material y su relación con la fotosíntesis"
+    if route == "flashcards":
+        return lambda: client.post(f"/api/material/{material_id}/generate_flashcards",
+                                   params={"query": query, "num_flashcards": 6})
+    if route == "flashcards_stream":
+        return lambda: client.post(f"/api/material/{material_id}/generate_flashcards/stream",
+                                   params={"query": query, "num_flashcards": 6})
+    return lambda: client.post(f"/api/material/{material_id}/feynman_feedback", params={"topic": f"concepto {i}"},
+                               json={"user_explanation": f"la clorofila captura la luz y la convierte en energía {i}"})
+
+
+async def run(args, db: FakePostgrestServer, llm: FakeGeminiServer) -> dict:
+    supabase_module.supabase = create_client(db.url, "fake-service-key")
+    supabase_module.SUPABASE_URL = db.url
+    # El cliente async se crea al primer uso en el loop de la corrida, contra el Supabase falso
+    supabase_async.SUPABASE_URL, supabase_async.SUPABASE_API_KEY = db.url, "fake-service-key"
+    gemini.client = genai.Client(api_key="fake", http_options=types.HttpOptions(base_url=llm.base_url))
+    # Sin caché de embeddings en disco: cada corrida paga (y mide) todas las llamadas a Gemini
+    gemini.embedding_cache = None
+    generate_module.embedding_cache = None
+    gemini_scheduler.enabled = args.scheduler
+    vector_index.VECTOR_SEARCH_BACKEND = args.vector_backend
+    # Los embeddings del Gemini falso son aleatorios (similitud ~0 entre consulta y chunks): sin bajar
+    # el umbral, la búsqueda densa (RETRIEVAL_MODE por defecto) no devuelve nada y todo termina en 404
+    vector_index.VECTOR_MATCH_THRESHOLD = supabase_async.VECTOR_MATCH_THRESHOLD = -1.0
+
+    from api.main import app
+
+    results = {
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "baseline_rss_mb": peak_rss_mb(),
+    }
+    pdfs = [make_document_pdf(args.pages, seed=args.seed + m) for m in range(args.materials)]
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        uploads = [
+            (lambda m=m: client.post("/api/upload_pdf", params={"user_id": f"user-{m}", "title": f"Material {m}"},
+                                     files={"file": (f"material-{m}.pdf", pdfs[m], "application/pdf")}))
+            for m in range(args.materials)
+        ]
+        results["upload"], responses = await run_phase(uploads, args.upload_concurrency, db, llm)
+        material_ids = [r.json()["material_id"] for r in responses if r is not None and r.status_code == 200]
+        results["upload"]["chunks"] = sum(r.json()["chunks_count"] for r in responses if r is not None and r.status_code == 200)
+        if not material_ids:
+            return results
+
+        embeddings = [(lambda m=m: client.post(f"/api/material/{m}/create_embeddings")) for m in material_ids]
+        results["embeddings"], _ = await run_phase(embeddings, args.embed_concurrency, db, llm)
+
+        generation = [
+            generation_request(client, GENERATION_ROUTES[i % len(GENERATION_ROUTES)], material_ids[i % len(material_ids)], i)
+            for i in range(args.requests)
+        ]
+        results["generate"], responses = await run_phase(generation, args.generate_concurrency, db, llm)
+        results["generate"]["by_route"] = {
+            route: sum(1 for i, r in enumerate(responses) if i % len(GENERATION_ROUTES) == n
+                       and r is not None and r.status_code == 200 and "event: error" not in r.text)
+            for n, route in enumerate(GENERATION_ROUTES)
+        }
+    results["peak_rss_mb"] = peak_rss_mb()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--materials", type=int, default=8)
+    parser.add_argument("--pages", type=int, default=30, help="Páginas por PDF")
+    parser.add_argument("--requests", type=int, default=200, help="Peticiones de generación")
+    parser.add_argument("--upload-concurrency", type=int, default=4)
+    parser.add_argument("--embed-concurrency", type=int, default=4)
+    parser.add_argument("--generate-concurrency", type=int, default=32)
+    parser.add_argument("--db-latency", type=float, default=0.01, help="Segundos por operación del Supabase falso")
+    parser.add_argument("--embed-latency", type=float, default=0.05, help="Segundos por llamada de embeddings")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="Segundos por generación")
+    parser.add_argument("--vector-backend", choices=("supabase", "local"), default=vector_index.VECTOR_SEARCH_BACKEND)
+    parser.add_argument("--scheduler", action="store_true", help="Pasar las llamadas a Gemini por el planificador")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Archivo donde guardar también el JSON de resultados")
+    args = parser.parse_args()
+
+    with FakePostgrestServer(latency_s=args.db_latency, seed=args.seed) as db, \
+            FakeGeminiServer(10**6, latency_s=args.embed_latency, generate_latency_s=args.llm_latency, seed=args.seed) as llm:
+        results = asyncio.run(run(args, db, llm))
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+Prueba del planificador de Gemini contra un Gemini falso local que devuelve 429.
+
+Mientras un trabajo bulk genera embeddings (embed_chunks_in_batches, varios lotes en
+paralelo), llegan consultas interactivas (embedding de la consulta + generación de
+flashcards). Se compara sin planificador (llamadas directas, sin reintentos) y con
+planificador (baldes RPM por modelo, reintentos con backoff y lanes de prioridad):
+lotes bulk perdidos, consultas interactivas fallidas y su latencia, y los 429 recibidos.
+
+Además comprueba el límite TPM con lotes más grandes que la capacidad del balde (un
+segundo de TPM): llamadas sin red de --tpm-batch-tokens tokens durante --tpm-seconds,
+y el ritmo sostenido de tokens/min concedidos, que no debe pasar de --tpm.
+
+Uso (desde pre_hack_2/):
+    python -m benchmarks.bench_gemini_scheduler --rps 20 --chunks 1500 --queries 30
+"""
+import argparse
+import asyncio
+import json
+import threading
+import time
+
+from google import genai
+from google.genai import types
+
+from api import gemini
+from api.config import EMBEDDING_MODEL, GENERATION_MODEL
+from api.gemini_scheduler import GeminiScheduler
+from benchmarks.fake_gemini import FakeGeminiServer
+
+
+async def interactive_load(queries: int, interval_s: float) -> list:
+    async def one(i: int):
+        await asyncio.sleep(i * interval_s)
+        start = time.perf_counter()
+        try:
+            embedding = await gemini.aget_embedding(f"consulta interactiva {i}", lane="interactive")
+            if not embedding:
+                return None
+            await gemini.agenerate_flashcards(context="contexto", query=f"consulta {i}", num_flashcards=3)
+            return time.perf_counter() - start
+        except Exception:
+            return None
+
+    return await asyncio.gather(*[one(i) for i in range(queries)])
+
+
+def run_mode(server: FakeGeminiServer, scheduler: GeminiScheduler, args) -> dict:
+    gemini.gemini_scheduler = scheduler
+    server.counts = dict.fromkeys(server.counts, 0)
+    chunks = [{"id": i, "chunk_text": f"fragmento {i} del material de estudio"} for i in range(args.chunks)]
+
+    bulk_report = {}
+
+    def bulk():
+        bulk_report.update(gemini.embed_chunks_in_batches(chunks, batch_size=args.batch_size, concurrency=args.concurrency))
+
+    thread = threading.Thread(target=bulk)
+    thread.start()
+    time.sleep(0.3)  # el trabajo bulk ya está saturando la cuota cuando llegan las consultas
+    latencies = asyncio.run(interactive_load(args.queries, args.interval))
+    thread.join()
+
+    ok = sorted(l for l in latencies if l is not None)
+    return {
+        "bulk": {
+            "embedded": bulk_report["processed"],
+            "failed_batches": len(bulk_report["failed_batches"]),
+            "elapsed_s": bulk_report["elapsed_s"],
+        },
+        "interactive": {
+            "ok": len(ok),
+            "failed": len(latencies) - len(ok),
+            "latency_s_p50": round(ok[len(ok) // 2], 3) if ok else None,
+            "latency_s_p95": round(ok[int(0.95 * (len(ok) - 1))], 3) if ok else None,
+        },
+        "server": dict(server.counts),
+        "scheduler": scheduler.stats()["lanes"] if scheduler.enabled else None,
+    }
+
+
+def tpm_check(args) -> dict:
+    # Un solo modelo con límite TPM y lotes que no caben en el balde: cada lote se cobra completo
+    scheduler = GeminiScheduler({}, {"modelo": args.tpm}, 10**6, args.tpm, 0, 0, 0)
+    grants = []
+    start = time.perf_counter()
+    while time.perf_counter() - start < args.tpm_seconds:
+        scheduler.call("modelo", lambda: grants.append(time.perf_counter()), tokens=args.tpm_batch_tokens)
+    # Ritmo entre la primera y la última concesión (la última se cobra a cuenta del minuto siguiente)
+    span = grants[-1] - grants[0]
+    sustained = (len(grants) - 1) * args.tpm_batch_tokens / span * 60 if span > 0 else None
+    return {
+        "tpm_limit": args.tpm,
+        "batch_tokens": args.tpm_batch_tokens,
+        "bucket_capacity": args.tpm / 60,
+        "batches": len(grants),
+        "tokens_per_min_sustained": round(sustained) if sustained else None,
+        # Margen del 1% por la resolución del reloj y del despachador
+        "within_limit": sustained is not None and sustained <= args.tpm * 1.01,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rps", type=float, default=20, help="Cuota del Gemini falso (peticiones/s por modelo)")
+    parser.add_argument("--error-rate", type=float, default=0.02, help="Fracción de respuestas 503")
+    parser.add_argument("--chunks", type=int, default=1500)
+    parser.add_argument("--batch-size", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--queries", type=int, default=30)
+    parser.add_argument("--interval", type=float, default=0.1)
+    parser.add_argument("--tpm", type=int, default=60000, help="Límite TPM de la comprobación de lotes grandes")
+    parser.add_argument("--tpm-batch-tokens", type=int, default=6000, help="Tokens por lote (mayor que --tpm / 60)")
+    parser.add_argument("--tpm-seconds", type=float, default=15)
+    args = parser.parse_args()
+
+    with FakeGeminiServer(args.rps, error_rate=args.error_rate) as server:
+        gemini.client = genai.Client(api_key="fake", http_options=types.HttpOptions(base_url=server.base_url))
+        gemini.embedding_cache = None
+        rpm = int(args.rps * 60 * 0.9)
+        limits = {EMBEDDING_MODEL: rpm, GENERATION_MODEL: rpm}
+        results = {
+            "without_scheduler": run_mode(server, GeminiScheduler({}, {}, rpm, 10**9, 0, 0, 0, enabled=False), args),
+            "with_scheduler": run_mode(server, GeminiScheduler(limits, {}, rpm, 10**9, 6, 0.2, 5.0), args),
+        }
+    results["tpm_large_batches"] = tpm_check(args)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Benchmark de la recuperación por modo: densa (embedding + índice vectorial), léxica (BM25),
+híbrida (ambas + RRF) y automática (híbrida, pero las consultas cortas solo por BM25).
+
+Mismo documento sintético que bench_context (hechos únicos sembrados en posiciones conocidas).
+El embedding de la consulta se simula con una bolsa de palabras con hashing más una espera
+de --embed-latency segundos (el ida y vuelta a Gemini); las búsquedas son las reales
+(aretrieve_hits con el índice vectorial local y el índice BM25 en memoria).
+Se mide la latencia por consulta y el recall: fracción de consultas cuyo hecho aparece
+en alguno de los top_k candidatos. Hay dos tipos de consulta: palabra clave ("clave17")
+y pregunta larga ("qué se sabe del concepto clave17 ...").
+
+Uso (desde pre_hack_2/):
+    python -m benchmarks.bench_retrieval_modes --pages 300 --queries 200 --embed-latency 0.12
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from api import context_builder, vector_index
+from api.lexical_index import lexical_index, BM25Index
+from api.vector_index import local_index, MaterialIndex
+from api.text_processing import iter_chunks
+from benchmarks.bench_context import HashingEmbedder, make_document
+
+MATERIAL_ID = 1
+MODES = ("dense", "lexical", "hybrid", "auto")
+
+
+def install_indexes(chunks: list[dict], embed: HashingEmbedder):
+    rows = [{"id": i + 1, "chunk_text": c["chunk_text"]} for i, c in enumerate(chunks)]
+    local_index._indexes[MATERIAL_ID] = MaterialIndex.from_rows([{**r, "embedding": embed(r["chunk_text"])} for r in rows])
+    lexical_index._indexes[MATERIAL_ID] = BM25Index.from_rows(rows)
+    vector_index.VECTOR_SEARCH_BACKEND = "local"
+    vector_index.VECTOR_MATCH_THRESHOLD = 0.0
+
+
+def install_fake_embedding(embed: HashingEmbedder, latency: float, counter: dict):
+    async def aget_query_embedding(query):
+        counter["calls"] += 1
+        await asyncio.sleep(latency)
+        return embed(query).tolist()
+
+    context_builder.aget_query_embedding = aget_query_embedding
+
+
+def _pct(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(p * len(values)))] * 1000, 2)
+
+
+async def run_mode(mode: str, queries: list[tuple[str, str]], limit: int, counter: dict) -> dict:
+    latencies, found = [], []
+    counter["calls"] = 0
+    for query, fact in queries:
+        start = time.perf_counter()
+        hits, _ = await context_builder.aretrieve_hits(query, MATERIAL_ID, limit, mode=None if mode == "auto" else mode)
+        latencies.append(time.perf_counter() - start)
+        found.append(any(fact in h["chunk_text"] for h in hits))
+    return {
+        "latency_ms_p50": _pct(latencies, 0.5),
+        "latency_ms_p95": _pct(latencies, 0.95),
+        "latency_ms_mean": round(sum(latencies) / len(latencies) * 1000, 2),
+        "recall": round(sum(found) / len(found), 4),
+        "embedding_calls": counter["calls"],
+    }
+
+
+async def run(args) -> dict:
+    pages, facts = make_document(args.pages, args.facts_per_page, args.seed)
+    chunks = list(iter_chunks(pages))
+    embed = HashingEmbedder([c["chunk_text"] for c in chunks])
+    install_indexes(chunks, embed)
+    counter = {"calls": 0}
+    install_fake_embedding(embed, args.embed_latency, counter)
+
+    rng = random.Random(args.seed)
+    asked = [rng.randrange(len(facts)) for _ in range(args.queries)]
+    query_sets = {
+        "keyword": [(f"clave{a}", facts[a]) for a in asked],
+        "question": [(f"qué se sabe del concepto clave{a} y de su propiedad{a} en el sistema{a}", facts[a]) for a in asked],
+    }
+
+    results = {"chunks": len(chunks), "queries": args.queries, "embed_latency_s": args.embed_latency}
+    for name, queries in query_sets.items():
+        results[name] = {mode: await run_mode(mode, queries, args.top_k, counter) for mode in MODES}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=300)
+    parser.add_argument("--facts-per-page", type=int, default=2)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=4)
+    parser.add_argument("--embed-latency", type=float, default=0.12, help="Segundos por embedding de consulta")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+Benchmark de time-to-first-byte: rutas bloqueantes vs rutas SSE (flashcards y Feynman).
+
+Gemini se reemplaza por un cliente async falso que "genera" la respuesta fragmento a fragmento
+con una latencia fija por fragmento; la recuperación y Supabase por funciones que duermen
+la latencia configurada. Se mide, para cada ruta, cuándo llega el primer byte, el primer
+contenido útil (primera flashcard / primer fragmento de feedback) y la respuesta completa.
+
+Uso (desde pre_hack_2/):
+    python -m benchmarks.bench_streaming --cards 6 --chunk-latency 0.08 --retrieval-latency 0.15
+"""
+import argparse
+import asyncio
+import json
+import time
+from types import SimpleNamespace
+
+from api import gemini
+from api.routes import generate as generate_module
+
+
+class FakeModels:
+    # Imita client.aio.models: la respuesta se "genera" fragmento a fragmento
+    def __init__(self, chunks: list[str], chunk_latency: float):
+        self.chunks = chunks
+        self.chunk_latency = chunk_latency
+
+    async def generate_content(self, model, contents, config):
+        await asyncio.sleep(self.chunk_latency * len(self.chunks))
+        return SimpleNamespace(text="".join(self.chunks))
+
+    async def generate_content_stream(self, model, contents, config):
+        async def chunks():
+            for chunk in self.chunks:
+                await asyncio.sleep(self.chunk_latency)
+                yield SimpleNamespace(text=chunk)
+        return chunks()
+
+
+def split_every(text: str, size: int) -> list[str]:
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def install_fakes(response_text: str, chunk_chars: int, chunk_latency: float, retrieval_latency: float, db_latency: float):
+    models = FakeModels(split_every(response_text, chunk_chars), chunk_latency)
+    gemini.client = SimpleNamespace(aio=SimpleNamespace(models=models))
+
+    async def aget_query_embedding(query):
+        await asyncio.sleep(retrieval_latency / 2)
+        return [0.1] * 8
+
+    async def aretrieve_context(query, material_id, top_k=4, query_embedding=None, mode=None):
+        await asyncio.sleep(retrieval_latency / 2)
+        return {"context": "contexto", "selected": 4, "context_tokens": 900, "retrieval_mode": mode}
+
+    async def insert_tool(material_id, tool_type, content):
+        await asyncio.sleep(db_latency)
+        return 1
+
+    generate_module.aget_query_embedding = aget_query_embedding
+    generate_module.aretrieve_context = aretrieve_context
+    # Se mide el camino con embedding (las consultas cortas irían solo por BM25, ver bench_retrieval_modes)
+    generate_module.choose_retrieval_mode = lambda query: "dense"
+    generate_module.insert_tool = insert_tool
+    generate_module.flashcards_cache.lookup = lambda *args: None
+
+
+async def measure_stream(response, content_event: str) -> dict:
+    start = time.perf_counter()
+    first_byte = first_content = None
+    async for part in response.body_iterator:
+        now = time.perf_counter() - start
+        first_byte = first_byte if first_byte is not None else now
+        if first_content is None and f"event: {content_event}" in part:
+            first_content = now
+    total = time.perf_counter() - start
+    return {"ttfb_s": round(first_byte, 3), "first_content_s": round(first_content or total, 3), "total_s": round(total, 3)}
+
+
+async def measure_blocking(call) -> dict:
+    start = time.perf_counter()
+    await call()
+    total = round(time.perf_counter() - start, 3)
+    # Sin streaming el primer byte y el primer contenido llegan junto con la respuesta completa
+    return {"ttfb_s": total, "first_content_s": total, "total_s": total}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cards", type=int, default=6)
+    parser.add_argument("--chunk-chars", type=int, default=40)
+    parser.add_argument("--chunk-latency", type=float, default=0.08)
+    parser.add_argument("--retrieval-latency", type=float, default=0.15)
+    parser.add_argument("--db-latency", type=float, default=0.05)
+    args = parser.parse_args()
+
+    flashcards = {"flashcards": [
+        {"question": f"¿Qué ocurre en la etapa {i} de la fotosíntesis?",
+         "answer": f"En la etapa {i} los cloroplastos transforman energía luminosa en energía química."}
+        for i in range(args.cards)
+    ]}
+    results = {}
+
+    install_fakes(json.dumps(flashcards, ensure_ascii=False), args.chunk_chars, args.chunk_latency,
+                  args.retrieval_latency, args.db_latency)
+    results["flashcards"] = {
+        "blocking": asyncio.run(measure_blocking(lambda: generate_module.generate_flashcards_route(1, "fotosíntesis", 4, args.cards))),
+        "stream": asyncio.run(measure_stream(
+            asyncio.run(generate_module.generate_flashcards_stream_route(1, "fotosíntesis", 4, args.cards)), "card")),
+    }
+
+    feedback = "Capturaste la idea principal, pero faltó mencionar el ciclo de Calvin en el estroma. " * 6
+    install_fakes(feedback, args.chunk_chars, args.chunk_latency, args.retrieval_latency, args.db_latency)
+    results["feynman"] = {
+        "blocking": asyncio.run(measure_blocking(lambda: generate_module.feynman_feedback_route(1, "fotosíntesis", "explicación"))),
+        "stream": asyncio.run(measure_stream(
+            asyncio.run(generate_module.feynman_feedback_stream_route(1, "fotosíntesis", "explicación")), "token")),
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+Benchmark de transcripción segmentada: tiempo total y tiempo hasta el primer segmento
+para una grabación larga según el número de workers de Whisper.
+
+El audio es sintético (tramos con voz y pausas), así que el texto no importa: se mide
+cuánto escala el tiempo de pared con los workers. Requiere openai-whisper y torch.
+La decodificación con ffmpeg se omite (se entrega el PCM directamente).
+
+Uso (desde pre_hack_2/):
+    python -m benchmarks.bench_transcription --seconds 300 --workers 1 2 4 --model tiny
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from api import speech
+from api.speech import TranscriptionService, split_on_silence
+from benchmarks.fixtures import make_speech_like_audio
+
+
+async def run_once(service: TranscriptionService, model: str) -> dict:
+    start = time.perf_counter()
+    first = None
+    segments = 0
+    async for _ in service.iter_segments(b"", model_name=model):
+        first = first if first is not None else time.perf_counter() - start
+        segments += 1
+    return {
+        "first_segment_s": round(first or 0.0, 2),
+        "total_s": round(time.perf_counter() - start, 2),
+        "segments": segments,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=300)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--model", default="tiny")
+    args = parser.parse_args()
+
+    audio = make_speech_like_audio(args.seconds)
+    speech.decode_audio = lambda content, sample_rate=speech.SAMPLE_RATE: audio
+
+    results = {"audio_s": round(len(audio) / speech.SAMPLE_RATE, 1), "segments": len(split_on_silence(audio)), "runs": []}
+    for workers in args.workers:
+        service = TranscriptionService(workers, queue_size=workers, queue_timeout_s=60, warm_models=[args.model],
+                                       max_model_memory_mb=4096, torch_threads=1)
+        service.start()
+        asyncio.run(run_once(service, args.model))  # calentamiento: todos los workers con el modelo cargado
+        results["runs"].append({"workers": workers, **asyncio.run(run_once(service, args.model))})
+        service.stop()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
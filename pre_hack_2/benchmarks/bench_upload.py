@@ -0,0 +1,118 @@
+"""
+Benchmark de subidas concurrentes a upload_pdf: flujo bloqueante (antes) vs no bloqueante (ahora).
+
+Supabase se reemplaza por funciones que duermen la latencia configurada, así se mide
+solo el efecto de sacar el trabajo del event loop y solapar Storage con la extracción.
+Además de la tasa de subidas, se mide el peor retraso del event loop (lo que esperaría
+cualquier otra petición atendida por el mismo worker).
+
+Uso (desde pre_hack_2/):
+    python -m benchmarks.bench_upload --uploads 16 --pages 40 --storage-latency 0.5
+"""
+import argparse
+import asyncio
+import hashlib
+import io
+import itertools
+import json
+import time
+
+from fastapi import UploadFile
+
+from api import ingestion
+from api.routes import upload as upload_module
+from api.pypdf_utils import extract_text_from_bytes
+from api.text_processing import split_text_simple
+from benchmarks.fixtures import make_document_pdf
+
+
+def install_fakes(storage_latency: float, db_latency: float):
+    def upload_pdf_to_storage(user_id, file_name, file_content):
+        file_content.read()
+        time.sleep(storage_latency)
+        return f"http://storage.local/{user_id}/{file_name}"
+
+    def insert_material(user_id, title, pdf_url, raw_text):
+        time.sleep(db_latency)
+        return 1
+
+    next_id = itertools.count(1)
+
+    def insert_chunks(material_id, chunks, existing=None, on_written=None):
+        # Como ChunkWriter: on_written(filas, ids) por cada lote escrito (aquí uno solo, con ids nuevos)
+        time.sleep(db_latency)
+        if on_written is not None:
+            on_written(chunks, [next(next_id) for _ in chunks])
+        return len(chunks)
+
+    ingestion.upload_pdf_to_storage = upload_pdf_to_storage
+    ingestion.insert_material = insert_material
+    ingestion.insert_chunks = insert_chunks
+    # Cada subida es un PDF "nuevo": sin deduplicación (ver bench_dedup)
+    ingestion.find_material_by_content_hash = lambda content_hash: None
+    ingestion.set_material_content_hash = lambda material_id, content_hash: 1
+    ingestion.update_material_raw_text = lambda material_id, raw_text: time.sleep(db_latency)
+    return upload_pdf_to_storage, insert_material, insert_chunks
+
+
+async def blocking_upload(fakes, user_id: str, title: str, file: UploadFile):
+    # Réplica del flujo original: todo se llama directamente dentro del async def
+    upload_pdf_to_storage, insert_material, insert_chunks = fakes
+    content = await file.read()
+    public_url = upload_pdf_to_storage(user_id, file.filename, io.BytesIO(content))
+    raw_text = extract_text_from_bytes(content)
+    material_id = insert_material(user_id, title, public_url, raw_text)
+    chunks = [{"chunk_text": c, "chunk_hash": hashlib.sha256(c.encode()).hexdigest()} for c in split_text_simple(raw_text)]
+    return {"material_id": material_id, "chunks_count": insert_chunks(material_id, chunks)}
+
+
+async def run_mode(handler, pdf: bytes, uploads: int) -> dict:
+    max_lag = 0.0
+    running = True
+
+    async def heartbeat():
+        nonlocal max_lag
+        while running:
+            t = time.perf_counter()
+            await asyncio.sleep(0.01)
+            max_lag = max(max_lag, time.perf_counter() - t - 0.01)
+
+    monitor = asyncio.create_task(heartbeat())
+    start = time.perf_counter()
+    await asyncio.gather(*[
+        handler("user", f"doc-{i}", UploadFile(io.BytesIO(pdf), filename=f"doc-{i}.pdf"))
+        for i in range(uploads)
+    ])
+    elapsed = time.perf_counter() - start
+    running = False
+    await monitor
+    return {
+        "total_s": round(elapsed, 3),
+        "uploads_per_sec": round(uploads / elapsed, 3),
+        "max_event_loop_lag_ms": round(max_lag * 1000, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--uploads", type=int, default=16)
+    parser.add_argument("--pages", type=int, default=40)
+    parser.add_argument("--storage-latency", type=float, default=0.5)
+    parser.add_argument("--db-latency", type=float, default=0.05)
+    args = parser.parse_args()
+
+    fakes = install_fakes(args.storage_latency, args.db_latency)
+    pdf = make_document_pdf(args.pages)
+
+    results = {
+        "uploads": args.uploads,
+        "pages": args.pages,
+        "pdf_bytes": len(pdf),
+        "before": asyncio.run(run_mode(lambda *a: blocking_upload(fakes, *a), pdf, args.uploads)),
+        "after": asyncio.run(run_mode(upload_module.upload_pdf, pdf, args.uploads)),
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Benchmark de la compresión del índice vectorial local (MaterialIndex): float32, float16, int8
+y truncado a las primeras dimensiones, con y sin rescoring con los vectores completos.
+
+Los embeddings son sintéticos: grupos temáticos (centroide + ruido) con varianza decreciente
+por dimensión, como los embeddings entrenados para poder truncarse (las primeras dimensiones
+concentran la información). Las consultas son chunks del corpus con ruido añadido.
+Para cada opción se reporta la memoria residente por millón de chunks (matriz que se recorre +
+escalas), lo que queda en disco para el rescoring, QPS (consultas secuenciales, un hilo) y
+recall@k contra la búsqueda exacta en float32. Los índices se guardan en un directorio temporal
+y se cargan con memory-map, como con VECTOR_INDEX_DIR.
+
+Uso (desde pre_hack_2/):
+    python -m benchmarks.bench_vector_storage --chunks 50000 --queries 300 --top-k 10
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from api.config import EMBEDDING_DIM
+from api.vector_index import MaterialIndex
+
+# nombre -> (storage, dims, rescore_factor)
+OPTIONS = {
+    "float32": ("float32", 0, 0),
+    "float16": ("float16", 0, 4),
+    "int8": ("int8", 0, 4),
+    "int8_no_rescore": ("int8", 0, 0),
+    "float32_256d": ("float32", 256, 4),
+    "float32_256d_no_rescore": ("float32", 256, 0),
+    "int8_256d": ("int8", 256, 4),
+    "int8_128d": ("int8", 128, 8),
+}
+
+
+def make_embeddings(n: int, dim: int, topics: int, seed: int) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    decay = np.exp(-np.arange(dim) / (dim / 4)).astype(np.float32)
+    centroids = rng.standard_normal((topics, dim)).astype(np.float32)
+    vectors = centroids[rng.integers(0, topics, n)] + 0.6 * rng.standard_normal((n, dim)).astype(np.float32)
+    vectors *= decay
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def measure(index: MaterialIndex, queries: np.ndarray, truth: list[set], k: int) -> dict:
+    index.search(queries[0], match_threshold=-1.0, match_count=k)  # calienta el page cache
+    found = 0
+    start = time.perf_counter()
+    for query, expected in zip(queries, truth):
+        hits = index.search(query, match_threshold=-1.0, match_count=k)
+        found += len(expected & {h["id"] for h in hits})
+    elapsed = time.perf_counter() - start
+    return {"qps": round(len(queries) / elapsed, 1), "recall_at_k": round(found / (k * len(queries)), 4)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, default=50000)
+    parser.add_argument("--queries", type=int, default=300)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--topics", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    vectors = make_embeddings(args.chunks, EMBEDDING_DIM, args.topics, args.seed)
+    ids = np.arange(1, args.chunks + 1, dtype=np.int64)
+    texts = [""] * args.chunks
+    rng = np.random.default_rng(args.seed + 1)
+    queries = vectors[rng.integers(0, args.chunks, args.queries)] + 0.02 * rng.standard_normal((args.queries, EMBEDDING_DIM))
+    queries = (queries / np.linalg.norm(queries, axis=1, keepdims=True)).astype(np.float32)
+    exact = queries @ vectors.T
+    truth = [set(ids[np.argpartition(-row, args.top_k)[:args.top_k]].tolist()) for row in exact]
+    del exact
+
+    results = {"chunks": args.chunks, "dim": EMBEDDING_DIM, "top_k": args.top_k, "options": {}}
+    per_million = 1_000_000 / args.chunks
+    with tempfile.TemporaryDirectory() as root:
+        for name, (storage, dims, rescore) in OPTIONS.items():
+            directory = os.path.join(root, name)
+            MaterialIndex.from_vectors(ids, texts, vectors, storage, dims, rescore).save(directory)
+            index = MaterialIndex.load(directory)
+            index.rescore_factor = rescore
+            disk = index.full.nbytes if index.full is not None else 0
+            results["options"][name] = {
+                "storage": storage,
+                "dims": index.matrix.shape[1],
+                "rescore_factor": rescore,
+                "memory_mb_per_million": round(index.nbytes() * per_million / 2**20, 1),
+                "rescore_disk_mb_per_million": round(disk * per_million / 2**20, 1),
+                **measure(index, queries, truth, args.top_k),
+            }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
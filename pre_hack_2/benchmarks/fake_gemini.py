@@ -0,0 +1,169 @@
+"""
+Servidor HTTP local que imita la API de Gemini (embedContent / generateContent /
+streamGenerateContent) con una cuota por segundo y por modelo: al pasarse responde 429
+RESOURCE_EXHAUSTED, como la API real. También puede devolver 503 al azar. Lo usan los
+benchmarks a través del SDK real (genai.Client con http_options.base_url apuntando a este servidor).
+
+Las respuestas son deterministas: cada texto recibe un embedding aleatorio normalizado con semilla
+(seed, crc32 del texto), las peticiones con salida JSON reciben tantas flashcards como pide el
+prompt ("exactamente N flashcards") y las demás un feedback de texto fijo. Los embeddings tardan
+latency_s y la generación generate_latency_s (por defecto, la misma).
+"""
+import re
+import json
+import zlib
+import random
+import threading
+import time
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+
+FEEDBACK_TEXT = (
+    "Capturaste la idea principal del concepto. Conviene precisar el papel de la clorofila en la fase "
+    "luminosa y mencionar el ciclo de Calvin, que el material describe como la etapa donde se fija el carbono."
+)
+
+
+class FakeGeminiServer:
+    def __init__(self, requests_per_second: float, latency_s: float = 0.02, error_rate: float = 0.0,
+                 dim: int = 768, seed: int = 0, generate_latency_s: float | None = None):
+        self.requests_per_second = requests_per_second
+        self.latency_s = latency_s
+        self.generate_latency_s = latency_s if generate_latency_s is None else generate_latency_s
+        self.seed = seed
+        self.error_rate = error_rate
+        self.dim = dim
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.windows: dict[str, deque] = {}
+        self.counts = {"ok": 0, "429": 0, "503": 0, "embedded_texts": 0, "generations": 0}
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler(), bind_and_activate=False)
+        self.server.daemon_threads = True
+        # Cola de conexiones pendientes amplia: con la de socketserver (5) las ráfagas concurrentes
+        # terminan en conexiones reseteadas en el cliente (httpx.ReadError)
+        self.server.request_queue_size = 512
+        self.server.server_bind()
+        self.server.server_activate()
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _admit(self, model: str) -> int:
+        # Cuota por modelo, ventana deslizante de 1 s: más de requests_per_second peticiones -> 429
+        now = time.monotonic()
+        with self.lock:
+            window = self.windows.setdefault(model, deque())
+            while window and now - window[0] > 1.0:
+                window.popleft()
+            if len(window) >= self.requests_per_second:
+                self.counts["429"] += 1
+                return 429
+            window.append(now)
+            if self.rng.random() < self.error_rate:
+                self.counts["503"] += 1
+                return 503
+            self.counts["ok"] += 1
+            return 200
+
+    def embedding(self, text: str) -> list[float]:
+        rng = np.random.default_rng([self.seed, zlib.crc32(text.encode())])
+        vector = rng.standard_normal(self.dim)
+        return (vector / np.linalg.norm(vector)).round(6).tolist()
+
+    def generation_text(self, body: dict) -> str:
+        prompt = " ".join(p.get("text", "") for c in body.get("contents", []) for p in c.get("parts", []))
+        if body.get("generationConfig", {}).get("responseMimeType") != "application/json":
+            return FEEDBACK_TEXT
+        match = re.search(r"exactamente (\d+) flashcards", prompt)
+        count = int(match.group(1)) if match else 6
+        return json.dumps({"flashcards": [
+            {"question": f"¿Qué describe el punto {i + 1} del material?",
+             "answer": f"El punto {i + 1} explica cómo la clorofila captura la energía luminosa en los cloroplastos."}
+            for i in range(count)
+        ]}, ensure_ascii=False)
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Cabeceras y cuerpo salen en escrituras separadas: sin esto Nagle + ACK retardado suman ~40 ms
+            disable_nagle_algorithm = True
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status: int, body: dict):
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _send_stream(self, text: str, usage: dict, pieces: int = 4):
+                # streamGenerateContent?alt=sse: el texto en varios eventos SSE
+                step = max(1, -(-len(text) // pieces))
+                events = []
+                for start in range(0, len(text), step):
+                    chunk = {"candidates": [{"content": {"role": "model", "parts": [{"text": text[start:start + step]}]}}]}
+                    if start + step >= len(text):
+                        chunk["candidates"][0]["finishReason"] = "STOP"
+                        chunk["usageMetadata"] = usage
+                    events.append(f"data: {json.dumps(chunk, ensure_ascii=False)}\r\n\r\n")
+                payload = "".join(events).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                status = fake._admit(self.path.rsplit("/", 1)[-1].split(":")[0])
+                if status != 200:
+                    reason = "RESOURCE_EXHAUSTED" if status == 429 else "UNAVAILABLE"
+                    self._send(status, {"error": {"code": status, "message": reason.lower(), "status": reason}})
+                    return
+                path = self.path.split("?", 1)[0]
+                if path.endswith(":batchEmbedContents"):
+                    time.sleep(fake.latency_s)
+                    texts = [" ".join(p.get("text", "") for p in r.get("content", {}).get("parts", []))
+                             for r in body.get("requests", [])]
+                    with fake.lock:
+                        fake.counts["embedded_texts"] += len(texts)
+                    self._send(200, {"embeddings": [{"values": fake.embedding(t)} for t in texts]})
+                elif path.endswith(":embedContent"):
+                    time.sleep(fake.latency_s)
+                    text = " ".join(p.get("text", "") for p in body.get("content", {}).get("parts", []))
+                    with fake.lock:
+                        fake.counts["embedded_texts"] += 1
+                    self._send(200, {"embedding": {"values": fake.embedding(text)}})
+                elif path.endswith(":generateContent") or path.endswith(":streamGenerateContent"):
+                    time.sleep(fake.generate_latency_s)
+                    text = fake.generation_text(body)
+                    with fake.lock:
+                        fake.counts["generations"] += 1
+                    usage = {"promptTokenCount": 100, "candidatesTokenCount": len(text) // 4,
+                             "totalTokenCount": 100 + len(text) // 4}
+                    if path.endswith(":generateContent"):
+                        self._send(200, {
+                            "candidates": [{"content": {"role": "model", "parts": [{"text": text}]}, "finishReason": "STOP"}],
+                            "usageMetadata": usage,
+                        })
+                    else:
+                        self._send_stream(text, usage)
+                else:
+                    self._send(404, {"error": {"code": 404, "message": "not found", "status": "NOT_FOUND"}})
+
+        return Handler
@@ -0,0 +1,302 @@
+"""
+Servidor HTTP local que imita la parte de la API REST de Supabase (PostgREST) que usa la API:
+tablas en memoria con INSERT y upsert (ids autoincrementales; Prefer: count=exact,
+return=minimal o representation, resolution=merge-duplicates con on_conflict), SELECT con
+select=, filtros eq/neq/in/is (y not.), order, limit/offset y .single(), UPDATE (PATCH),
+DELETE con los mismos filtros y RPC registrados en `rpcs` (los demás responden PGRST202).
+match_material_chunks viene registrado (similitud coseno en memoria, como el de pgvector).
+También imita Storage (/storage/v1/object/...): subida con x-upsert (sin él, un archivo existente
+responde 409 Duplicate) y descarga pública. `url` es la raíz para supabase.create_client y
+`base_url` la de PostgREST para el cliente de postgrest.
+
+Cada INSERT es atómico (todo el lote o nada) y tarda latency_s + per_row_s por fila, con a lo
+sumo max_connections escrituras a la vez (como el pool de conexiones de PostgREST). Se pueden
+inyectar fallos: 413 si el cuerpo supera max_body_bytes, 503 PGRST003 antes del commit
+(error_rate) y conexiones cortadas DESPUÉS del commit (lost_rate), el caso en que el cliente
+no sabe si el lote quedó escrito. Lo usan los benchmarks a través del cliente real de postgrest.
+"""
+import json
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qsl
+
+import numpy as np
+
+RESERVED_PARAMS = {"select", "order", "limit", "offset", "on_conflict", "columns"}
+
+
+def _matches(row: dict, column: str, expression: str) -> bool:
+    negate = expression.startswith("not.")
+    if negate:
+        expression = expression[4:]
+    operator, _, value = expression.partition(".")
+    current = row.get(column)
+    if operator == "eq":
+        result = str(current) == value
+    elif operator == "neq":
+        result = str(current) != value
+    elif operator == "in":
+        result = str(current) in {v.strip('"') for v in value.strip("()").split(",") if v}
+    elif operator == "is":
+        result = current is None if value == "null" else str(current).lower() == value
+    else:
+        raise ValueError(f"operador no soportado: {operator}")
+    return result != negate
+
+
+def match_material_chunks(server: "FakePostgrestServer", query_embedding, match_material_id: int,
+                          match_threshold: float, match_count: int) -> list[dict]:
+    # Equivalente en memoria del RPC de pgvector: 1 - distancia coseno, mayor que el umbral, de mayor a menor
+    rows = [row for row in server.rows if row.get("material_id") == match_material_id and row.get("embedding") is not None]
+    if not rows:
+        return []
+    matrix = np.asarray([json.loads(r["embedding"]) if isinstance(r["embedding"], str) else r["embedding"] for r in rows],
+                        dtype=np.float32)
+    query = np.asarray(json.loads(query_embedding) if isinstance(query_embedding, str) else query_embedding, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1) * (np.linalg.norm(query) or 1.0)
+    similarities = matrix @ query / np.where(norms == 0, 1.0, norms)
+    order = np.argsort(-similarities)[:match_count]
+    return [{"id": rows[i]["id"], "material_id": rows[i]["material_id"], "chunk_text": rows[i]["chunk_text"],
+             "page_start": rows[i].get("page_start"), "similarity": float(similarities[i])}
+            for i in order if similarities[i] > match_threshold]
+
+
+class FakePostgrestServer:
+    def __init__(self, latency_s: float = 0.02, per_row_s: float = 0.0002, max_connections: int = 8,
+                 max_body_bytes: int = 4 * 1024 * 1024, error_rate: float = 0.0, lost_rate: float = 0.0, seed: int = 0):
+        self.latency_s = latency_s
+        self.per_row_s = per_row_s
+        self.max_body_bytes = max_body_bytes
+        self.error_rate = error_rate
+        self.lost_rate = lost_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.connections = threading.BoundedSemaphore(max(1, max_connections))
+        self.tables: dict[str, list[dict]] = defaultdict(list)
+        self.next_id: Counter = Counter()
+        self.counts = Counter()
+        # Funciones RPC: nombre -> fn(servidor, **params), se ejecutan con el lock tomado
+        self.rpcs = {"match_material_chunks": match_material_chunks}
+        # Storage: "bucket/ruta" -> bytes
+        self.objects: dict[str, bytes] = {}
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler(), bind_and_activate=False)
+        self.server.daemon_threads = True
+        # Cola de conexiones pendientes amplia: con la de socketserver (5) las ráfagas concurrentes
+        # terminan en conexiones reseteadas en el cliente (httpx.ReadError)
+        self.server.request_queue_size = 512
+        self.server.server_bind()
+        self.server.server_activate()
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}/rest/v1"
+
+    @property
+    def rows(self) -> list[dict]:
+        return self.tables["material_chunks"]
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset(self):
+        with self.lock:
+            self.tables.clear()
+            self.next_id.clear()
+            self.counts.clear()
+            self.objects.clear()
+
+    def _fault(self) -> str | None:
+        with self.lock:
+            roll = self.rng.random()
+        if roll < self.error_rate:
+            return "error"
+        if roll < self.error_rate + self.lost_rate:
+            return "lost"
+        return None
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Cabeceras y cuerpo salen en escrituras separadas: sin esto Nagle + ACK retardado suman ~40 ms
+            disable_nagle_algorithm = True
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status: int, body=None, headers: dict | None = None, raw: bytes | None = None):
+                payload = raw if raw is not None else (json.dumps(body).encode() if body is not None else b"")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _parse(self):
+                parts = urlsplit(self.path)
+                table = parts.path.rsplit("/", 1)[-1]
+                params = parse_qsl(parts.query)
+                options = {key: value for key, value in params if key in RESERVED_PARAMS}
+                filters = [(key, value) for key, value in params if key not in RESERVED_PARAMS]
+                return table, options, filters
+
+            def _filtered(self, table: str, filters) -> list[dict]:
+                return [row for row in fake.tables[table] if all(_matches(row, c, e) for c, e in filters)]
+
+            def _reply_rows(self, status: int, rows: list[dict], options: dict):
+                prefer = self.headers.get("Prefer", "")
+                headers = {"Content-Range": f"*/{len(rows)}"} if "count=exact" in prefer else {}
+                if "return=minimal" in prefer:
+                    self._send(status, headers=headers)
+                    return
+                columns = [c.strip() for c in options.get("select", "*").split(",")]
+                if columns != ["*"]:
+                    rows = [{c: row.get(c) for c in columns} for row in rows]
+                if "vnd.pgrst.object" in self.headers.get("Accept", ""):
+                    if len(rows) != 1:
+                        self._send(406, {"code": "PGRST116", "message": "JSON object requested, multiple (or no) rows returned",
+                                         "details": None, "hint": None})
+                        return
+                    self._send(status, rows[0], headers)
+                    return
+                self._send(status, rows, headers)
+
+            def _call_rpc(self, name: str):
+                params = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                function = fake.rpcs.get(name)
+                if function is None:
+                    self._send(404, {"code": "PGRST202", "message": f"Could not find the function public.{name}",
+                                     "details": None, "hint": None})
+                    return
+                time.sleep(fake.latency_s)
+                with fake.lock:
+                    fake.counts["rpcs"] += 1
+                    result = function(fake, **params)
+                self._send(200, result)
+
+            def _storage_upload(self):
+                key = urlsplit(self.path).path.split("/storage/v1/object/", 1)[1]
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                time.sleep(fake.latency_s)
+                with fake.lock:
+                    if key in fake.objects and self.headers.get("x-upsert", "false") != "true":
+                        self._send(400, {"statusCode": "409", "error": "Duplicate", "message": "The resource already exists"})
+                        return
+                    # Se guarda el cuerpo multipart tal cual: basta para medir y para servir la descarga
+                    fake.objects[key] = body
+                    fake.counts["storage_uploads"] += 1
+                self._send(200, {"Key": key, "Id": key})
+
+            def do_POST(self):
+                if "/storage/v1/object/" in self.path:
+                    self._storage_upload()
+                    return
+                if "/rpc/" in self.path:
+                    self._call_rpc(urlsplit(self.path).path.rsplit("/", 1)[-1])
+                    return
+                table, options, _ = self._parse()
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length)
+                if length > fake.max_body_bytes:
+                    # Como un gateway delante de PostgREST: cuerpo HTML, no JSON
+                    with fake.lock:
+                        fake.counts["413"] += 1
+                    self._send(413, raw=b"<html>413 Request Entity Too Large</html>")
+                    return
+                rows = json.loads(body)
+                rows = rows if isinstance(rows, list) else [rows]
+                fault = fake._fault()
+                with fake.connections:
+                    time.sleep(fake.latency_s + fake.per_row_s * len(rows))
+                    if fault == "error":
+                        with fake.lock:
+                            fake.counts["503"] += 1
+                        self._send(503, {"code": "PGRST003", "message": "Timed out acquiring connection from connection pool.",
+                                         "details": None, "hint": None})
+                        return
+                    with fake.lock:
+                        stored = []
+                        # Upsert (Prefer: resolution=merge-duplicates): se actualiza la fila con la misma clave
+                        conflict = options.get("on_conflict") if "merge-duplicates" in self.headers.get("Prefer", "") else None
+                        keys = [c.strip() for c in conflict.split(",")] if conflict else []
+                        index = {tuple(str(r.get(k)) for k in keys): r for r in fake.tables[table]} if keys else {}
+                        for row in rows:
+                            existing = index.get(tuple(str(row.get(k)) for k in keys)) if keys else None
+                            if existing is not None:
+                                existing.update(row)
+                                stored.append(existing)
+                                continue
+                            fake.next_id[table] += 1
+                            stored.append({"id": fake.next_id[table], **row})
+                            fake.tables[table].append(stored[-1])
+                        fake.counts["committed_batches"] += 1
+                if fault == "lost":
+                    # El lote ya está escrito pero la respuesta no llega: se corta la conexión
+                    with fake.lock:
+                        fake.counts["lost_responses"] += 1
+                    self.close_connection = True
+                    self.connection.close()
+                    return
+                self._reply_rows(201, stored, options)
+
+            def do_GET(self):
+                if "/storage/v1/object/public/" in self.path:
+                    key = urlsplit(self.path).path.split("/storage/v1/object/public/", 1)[1]
+                    with fake.lock:
+                        body = fake.objects.get(key)
+                    if body is None:
+                        self._send(404, {"statusCode": "404", "error": "not_found", "message": "Object not found"})
+                    else:
+                        self._send(200, raw=body)
+                    return
+                table, options, filters = self._parse()
+                time.sleep(fake.latency_s)
+                with fake.lock:
+                    fake.counts["selects"] += 1
+                    rows = self._filtered(table, filters)
+                for item in reversed(options.get("order", "").split(",") if options.get("order") else []):
+                    column, _, direction = item.partition(".")
+                    rows.sort(key=lambda row: (row.get(column) is None, row.get(column)), reverse=direction.startswith("desc"))
+                offset = int(options.get("offset", 0))
+                limit = int(options["limit"]) if "limit" in options else None
+                rows = rows[offset:offset + limit if limit is not None else None]
+                self._reply_rows(200, rows, options)
+
+            def do_PATCH(self):
+                table, options, filters = self._parse()
+                changes = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                time.sleep(fake.latency_s)
+                with fake.lock:
+                    rows = self._filtered(table, filters)
+                    for row in rows:
+                        row.update(changes)
+                self._reply_rows(200, rows, options)
+
+            def do_DELETE(self):
+                table, options, filters = self._parse()
+                # El cliente manda un cuerpo ("{}"): se consume para no romper la conexión keep-alive
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                time.sleep(fake.latency_s)
+                with fake.lock:
+                    rows = self._filtered(table, filters)
+                    removed = {id(row) for row in rows}
+                    fake.tables[table] = [row for row in fake.tables[table] if id(row) not in removed]
+                self._reply_rows(200, rows, options)
+
+        return Handler
@@ -0,0 +1,70 @@
+"""
+Datos sintéticos compartidos por los benchmarks (PDFs y texto de ejemplo).
+"""
+import random
+
+import numpy as np
+
+_WORDS = (
+    "la fotosíntesis convierte energía luminosa en energía química mediante clorofila "
+    "los cloroplastos contienen tilacoides donde ocurre la fase luminosa y el ciclo de calvin "
+    "fija dióxido de carbono en el estroma la derivada mide la tasa de cambio de una función "
+    "la integral definida calcula el área bajo la curva entre dos límites el teorema fundamental "
+    "del cálculo relaciona ambas operaciones la célula es la unidad básica de la vida"
+).split()
+
+
+def make_text(num_words: int, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    words = [rng.choice(_WORDS) for _ in range(num_words)]
+    # Un punto cada ~12 palabras para que parezca prosa
+    return " ".join(w + ("." if i % 12 == 11 else "") for i, w in enumerate(words))
+
+
+def make_pdf(pages: list[str]) -> bytes:
+    """Construye un PDF mínimo (una fuente Type1, texto en líneas de 90 caracteres) sin dependencias."""
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>"]
+    n = len(pages)
+    kids = " ".join(f"{3 + 2 * i} 0 R" for i in range(n))
+    objects.append(f"<< /Type /Pages /Kids [{kids}] /Count {n} >>".encode())
+    font_id = 3 + 2 * n
+    for i, text in enumerate(pages):
+        safe = text.encode("latin-1", "replace").decode("latin-1").replace("\\", "").replace("(", "").replace(")", "")
+        lines = [safe[j:j + 90] for j in range(0, len(safe), 90)]
+        body = ("BT /F1 10 Tf 20 800 Td 12 TL " + " ".join(f"({line}) '" for line in lines) + " ET").encode("latin-1")
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 842] "
+            f"/Resources << /Font << /F1 {font_id} 0 R >> >> /Contents {4 + 2 * i} 0 R >>".encode()
+        )
+        objects.append(b"<< /Length %d >>\nstream\n" % len(body) + body + b"\nendstream")
+    objects.append(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>")
+
+    out = b"%PDF-1.4\n"
+    offsets = []
+    for i, obj in enumerate(objects):
+        offsets.append(len(out))
+        out += f"{i + 1} 0 obj\n".encode() + obj + b"\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    out += b"".join(f"{o:010d} 00000 n \n".encode() for o in offsets)
+    out += f"trailer << /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF".encode()
+    return out
+
+
+def make_document_pdf(num_pages: int, words_per_page: int = 350, seed: int = 0) -> bytes:
+    return make_pdf([make_text(words_per_page, seed=seed * 100_000 + p) for p in range(num_pages)])
+
+
+def make_speech_like_audio(seconds: float, sample_rate: int = 16000, seed: int = 0) -> np.ndarray:
+    """Audio PCM float32 que alterna tramos "hablados" (tono modulado con ruido) y pausas de ruido de fondo."""
+    rng = np.random.default_rng(seed)
+    parts = []
+    total = 0.0
+    while total < seconds:
+        talk, pause = rng.uniform(2, 8), rng.uniform(0.4, 1.2)
+        n = int(talk * sample_rate)
+        tone = np.sin(2 * np.pi * rng.uniform(120, 300) * np.arange(n) / sample_rate)
+        parts.append(0.3 * tone * (1 + 0.5 * rng.standard_normal(n)))
+        parts.append(0.005 * rng.standard_normal(int(pause * sample_rate)))
+        total += talk + pause
+    return np.concatenate(parts).astype(np.float32)